@@ -4,19 +4,42 @@ import os
 # 環境変数の読み込み (Configのインポート前に実行する必要があります)
 load_dotenv()
 
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import MEDIUMTEXT
+from sqlalchemy.exc import IntegrityError
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from flask_mail import Mail, Message
 from config import Config
 from datetime import datetime, timedelta
 import json
+import hashlib
+import math
 import shutil
-import bcrypt
+import threading
+import time
 import secrets
-import stripe
 import sys
-import requests
+import mimetypes
+import base64
+import bisect
+import fnmatch
+from functools import lru_cache
+import search
+import thumbnails
+import jobs
+import archive
+import passwords
+import mailer
+import remote
+import webhooks
+import metrics
+import querylog
+
+# stripe / flask_mail / requests / bcrypt は読み込みが重い割に
+# 一部のAPIでしか使わないため、利用箇所で遅延インポートする
+# (CGIの1リクエストやデスクトップ版の起動時間を短縮するため)。
+# shutil は Flask が tempfile 経由で読み込み済み、smtplib (mailer.py) は 1ms 未満なので通常どおり読み込む
 
 class PrefixMiddleware(object):
     def __init__(self, app, prefix=''):
@@ -39,15 +62,13 @@ def is_desktop_app():
 def proxy_auth_to_remote(endpoint, data, params=None):
     """リモートサーバーに認証リクエストをプロキシする"""
     try:
-        remote_base = app.config['REMOTE_SERVER_URL'].rstrip('/')
-        remote_url = f"{remote_base}{endpoint}"
-        headers = {'X-Internal-Auth': app.config['SECRET_KEY']}
-        
+        client = get_remote_client()
+
         # status確認などのGETリクエストにも対応
         if not data and endpoint.endswith('status'):
-            response = requests.get(remote_url, params=params, headers=headers, timeout=15)
+            response = client.request('GET', endpoint, params=params)
         else:
-            response = requests.post(remote_url, json=data, headers=headers, timeout=15)
+            response = client.request('POST', endpoint, json=data)
         
         # JSONとして解析を試みる
         try:
@@ -55,8 +76,11 @@ def proxy_auth_to_remote(endpoint, data, params=None):
         except Exception:
             # 解析失敗時はステータスコードを添えてエラーを返す
             error_msg = f'認証サーバーが不正なレスポンスを返しました (Status: {response.status_code})'
-            print(f"Proxy Error: {error_msg} URL: {remote_url}")
+            print(f"Proxy Error: {error_msg} URL: {client.base_url}{endpoint}")
             return {'error': error_msg}, response.status_code if response.status_code != 200 else 500
+    except remote.CircuitOpen:
+        # 落ちているリモートを待たずにすぐ返す
+        return {'error': '認証サーバーに接続できません。しばらくしてからもう一度お試しください'}, 503
     except Exception as e:
         return {'error': f'認証サーバーに接続できません: {str(e)}'}, 500
 def resource_path(relative_path):
@@ -67,7 +91,6 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 
 app = Flask(__name__, 
@@ -77,10 +100,63 @@ app.config.from_object(Config)
 app.wsgi_app = PrefixMiddleware(app.wsgi_app, prefix='/note')
 Config.init_app(app)
 
+# リクエストの計測 (/metrics で公開する)。応答本文の送信完了まで計るため一番外側の WSGI ミドルウェアにする
+request_metrics = metrics.RequestMetrics(
+    metrics_dir=app.config['METRICS_DIR'],
+    log_sample_rate=app.config['ACCESS_LOG_SAMPLE_RATE'],
+    slow_seconds=app.config['ACCESS_LOG_SLOW_SECONDS']
+)
+app.wsgi_app = request_metrics.middleware(app.wsgi_app)
+
 db = SQLAlchemy(app)
+
+# SQL の実行回数・時間の記録 (メトリクスへの加算、遅い文と N+1 の疑いのログ)
+query_log = querylog.QueryLog(
+    slow_seconds=app.config['SLOW_QUERY_SECONDS'],
+    repeat_threshold=app.config['N_PLUS_ONE_THRESHOLD'],
+    on_query=metrics.add_db_time
+)
+query_log.install()
+
 login_manager = LoginManager(app)
 login_manager.login_message = None  # ログインメッセージを表示しない
-mail = Mail(app)
+_stripe = None
+_mail = None
+
+def get_stripe():
+    """stripe モジュールを初回利用時に読み込み、APIキーを設定して返す"""
+    global _stripe
+    if _stripe is None:
+        import stripe
+        stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+        _stripe = stripe
+    return _stripe
+
+def get_mail():
+    """Flask-Mail を初回利用時に初期化して返す"""
+    global _mail
+    if _mail is None:
+        from flask_mail import Mail
+        _mail = Mail(app)
+    return _mail
+
+_remote_client = None
+
+def get_remote_client():
+    """リモートの認証サーバー用のクライアントを初回利用時に作って返す (接続はプロセス内で使い回す)"""
+    global _remote_client
+    if _remote_client is None:
+        _remote_client = remote.RemoteClient(
+            app.config['REMOTE_SERVER_URL'],
+            headers={'X-Internal-Auth': app.config['SECRET_KEY']},
+            connect_timeout=app.config['REMOTE_CONNECT_TIMEOUT'],
+            read_timeout=app.config['REMOTE_READ_TIMEOUT'],
+            retries=app.config['REMOTE_RETRIES'],
+            pool_size=app.config['REMOTE_POOL_SIZE'],
+            failure_threshold=app.config['REMOTE_CIRCUIT_FAILURES'],
+            reset_timeout=app.config['REMOTE_CIRCUIT_RESET_SECONDS']
+        )
+    return _remote_client
 
 
 # データベースモデル
@@ -95,6 +171,8 @@ class Tab(db.Model):
 
 class Page(db.Model):
     __tablename__ = 'pages'
+    # タブのページを並び順で取得する
+    __table_args__ = (db.Index('ix_pages_tab_order', 'tab_id', 'order_index'),)
     id = db.Column(db.Integer, primary_key=True)
     tab_id = db.Column(db.Integer, db.ForeignKey('tabs.id'), nullable=False)
     name = db.Column(db.String(255), nullable=False)
@@ -105,12 +183,15 @@ class Page(db.Model):
 
 class Section(db.Model):
     __tablename__ = 'sections'
+    # ページのセクションを並び順で取得する (ページ表示・ページ/タブ削除・検索の絞り込み)
+    __table_args__ = (db.Index('ix_sections_page_order', 'page_id', 'order_index'),)
     id = db.Column(db.Integer, primary_key=True)
     page_id = db.Column(db.Integer, db.ForeignKey('pages.id'), nullable=False)
     name = db.Column(db.String(255), nullable=True)
     content_type = db.Column(db.String(50), nullable=False)  # 'text', 'file', 'link'
     content_data = db.Column(db.Text, nullable=True)  # JSON形式で保存
     memo = db.Column(db.Text, nullable=True)  # メモ欄
+    content_version = db.Column(db.Integer, default=0)  # 差分保存用の内容バージョン
     order_index = db.Column(db.Integer, default=0)
     width = db.Column(db.Integer, default=300)
     height = db.Column(db.Integer, default=200)
@@ -119,6 +200,12 @@ class Section(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class TreeVersion(db.Model):
+    """タブ/ページツリーの版数 (ワーカー間でスナップショットの鮮度を判定する)"""
+    __tablename__ = 'tree_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 # ユーザー認証モデル
 class User(db.Model):
     __tablename__ = 'users'
@@ -131,13 +218,14 @@ class User(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Stripe サブスクリプション管理
-    stripe_customer_id = db.Column(db.String(255), nullable=True)
+    stripe_customer_id = db.Column(db.String(255), nullable=True, index=True)
     stripe_subscription_id = db.Column(db.String(255), nullable=True)
     subscription_status = db.Column(db.String(50), default='trialing') # 'trialing', 'active', 'canceled', 'expired'
     trial_end = db.Column(db.DateTime, nullable=True)
     current_period_end = db.Column(db.DateTime, nullable=True)
     cancel_at_period_end = db.Column(db.Boolean, default=False)
     remote_user_id = db.Column(db.Integer, nullable=True) # リモートサーバー側のユーザーID
+    stripe_event_created = db.Column(db.Integer, nullable=True) # 最後に反映した Stripe イベントの作成時刻 (UNIX秒)
     
     # Flask-Loginに必要なメソッド
     @property
@@ -156,7 +244,7 @@ class EmailVerificationToken(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), nullable=False, index=True)
     token = db.Column(db.String(255), unique=True, nullable=False, index=True)
-    expires_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
     used = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -167,7 +255,7 @@ class StorageLocation(db.Model):
     name = db.Column(db.String(255), nullable=False)
     storage_type = db.Column(db.String(50), nullable=False)  # 'local', 'onedrive', 'googledrive', 'icloud'
     path = db.Column(db.String(1000), nullable=False)
-    is_active = db.Column(db.Boolean, default=True)
+    is_active = db.Column(db.Boolean, default=True, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class PasswordResetToken(db.Model):
@@ -175,24 +263,168 @@ class PasswordResetToken(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), nullable=False, index=True)
     token = db.Column(db.String(255), unique=True, nullable=False, index=True)
-    expires_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
     used = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class StripeEvent(db.Model):
+    """受信した Stripe Webhook イベントの台帳 (webhooks.py の反映スレッドが反映する)"""
+    __tablename__ = 'stripe_events'
+    __table_args__ = (db.Index('ix_stripe_events_status_created', 'status', 'created'),)
+    id = db.Column(db.String(255), primary_key=True)  # Stripe のイベントID
+    type = db.Column(db.String(100), nullable=False)
+    customer_id = db.Column(db.String(255), nullable=True, index=True)
+    created = db.Column(db.Integer, nullable=False)  # Stripe 上の作成時刻 (UNIX秒)
+    # イベント本文 (MySQL の TEXT は 64KB までなので MEDIUMTEXT にする)
+    payload = db.Column(db.Text().with_variant(MEDIUMTEXT(), 'mysql'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=webhooks.EVENT_PENDING)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    applied_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MailOutbox(db.Model):
+    """送信待ち・送信済みのメール (mailer.py の送信スレッドが送る)"""
+    __tablename__ = 'mail_outbox'
+    __table_args__ = (db.Index('ix_mail_outbox_status_next', 'status', 'next_attempt_at'),)
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)  # verification, password_reset, test
+    status = db.Column(db.String(20), nullable=False, default=mailer.MAIL_QUEUED)
+    sender = db.Column(db.String(255), nullable=True)  # None なら MAIL_DEFAULT_SENDER
+    recipients = db.Column(db.Text, nullable=False)  # JSON の配列
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=True)
+    html = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        # 宛先やメール本文は返さない (ID を知っていれば誰でも状態を確認できるため)
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts or 0,
+            'last_error': self.last_error,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None,
+        }
+
+class UploadBlob(db.Model):
+    """アップロードされたファイルの実体 (内容のSHA-256で1つだけ保存する)"""
+    __tablename__ = 'upload_blobs'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    path = db.Column(db.String(1000), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # 最後にアップロードされた時刻。参照が無くてもこの時刻から UPLOAD_BLOB_GRACE の間は削除しない
+    # (アップロード後にクライアントがセクションへ登録するまでの猶予)
+    last_uploaded_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class UploadRef(db.Model):
+    """セクションからアップロード実体への参照 (参照が無くなった実体だけを削除する)"""
+    __tablename__ = 'upload_refs'
+    id = db.Column(db.Integer, primary_key=True)
+    section_id = db.Column(db.Integer, nullable=False, index=True)
+    blob_sha256 = db.Column(db.String(64), nullable=False, index=True)
+
+class UploadSession(db.Model):
+    """再開可能な分割アップロードのセッション"""
+    __tablename__ = 'upload_sessions'
+    id = db.Column(db.String(64), primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    total_chunks = db.Column(db.Integer, nullable=False)
+    part_path = db.Column(db.String(1000), nullable=False)
+    target_section_id = db.Column(db.Integer, nullable=True)  # ストレージセクションへ保存する場合
+    sha256 = db.Column(db.String(64), nullable=True)  # クライアントが申告した完成後のハッシュ
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class UploadChunk(db.Model):
+    """分割アップロードで受信済みのチャンク (並列に届いても競合しないよう1行ずつ記録する)"""
+    __tablename__ = 'upload_chunks'
+    session_id = db.Column(db.String(64), primary_key=True)
+    chunk_index = db.Column(db.Integer, primary_key=True)
+
+class FileJob(db.Model):
+    """バックグラウンドで実行するファイル操作 (コピー・移動・解凍) のジョブ"""
+    __tablename__ = 'file_jobs'
+    # 止まった待機中・実行中ジョブの検出 (mark_stale_jobs)
+    __table_args__ = (db.Index('ix_file_jobs_status_updated', 'status', 'updated_at'),)
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # copy, move, extract
+    status = db.Column(db.String(20), nullable=False, default=jobs.JOB_QUEUED)
+    section_id = db.Column(db.Integer, nullable=True)  # 操作元のセクション
+    target_section_id = db.Column(db.Integer, nullable=True)
+    filename = db.Column(db.String(1000), nullable=False)
+    bytes_total = db.Column(db.BigInteger, default=0)
+    bytes_done = db.Column(db.BigInteger, default=0)
+    files_total = db.Column(db.Integer, default=0)
+    files_done = db.Column(db.Integer, default=0)
+    cancel_requested = db.Column(db.Boolean, default=False, nullable=False)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    # プロセスごと止まったときに削除する書きかけのコピー先・展開先
+    cleanup_path = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'section_id': self.section_id,
+            'target_section_id': self.target_section_id,
+            'filename': self.filename,
+            'bytes_total': self.bytes_total or 0,
+            'bytes_done': self.bytes_done or 0,
+            'files_total': self.files_total or 0,
+            'files_done': self.files_done or 0,
+            'cancel_requested': bool(self.cancel_requested),
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
 # Flask-Loginのユーザーローダー
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 @app.before_request
-def log_request_info():
-    if request.path.startswith('/api/') or request.path.startswith('/note/api/'):
-        print(f"--- API Request: {request.path} ---")
-        print(f"Cookies: {request.cookies.keys()}")
-        if 'remember_token' in request.cookies:
-            print("Found remember_token in cookies")
-        if 'session' in request.cookies:
-            print("Found session in cookies")
+def record_request_endpoint():
+    # メトリクスのラベル (URL そのものではなくビュー関数名にして種類を抑える)
+    request.environ['wownote.endpoint'] = request.endpoint or 'unmatched'
+    query_log.begin_request(request.environ['wownote.endpoint'])
+
+@app.teardown_request
+def finish_query_log(exc):
+    query_log.end_request()
+
+def is_internal_request():
+    """ローカル (プロキシを経由しない) からの取得、またはサーバー間の内部認証付きのリクエストなら True"""
+    is_local = request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+    return is_local or request.headers.get('X-Internal-Auth') == app.config['SECRET_KEY']
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 形式のメトリクス (ローカルからの取得、またはサーバー間の内部認証のみ)"""
+    if not is_internal_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    return request_metrics.collect().render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @login_manager.unauthorized_handler
 def unauthorized():
@@ -271,26 +503,92 @@ def verify_email_page():
 <body>リダイレクト中...</body>
 </html>'''
 
+# ==================== タブ/ページツリーのスナップショット ====================
+# GET /api/tabs のレスポンスをプロセス内にキャッシュし、tree_version の版数が
+# 変わったときだけ1本のJOINクエリで組み立て直す
+
+_tree_snapshot = None
+_tree_snapshot_lock = threading.Lock()
+
+def get_tree_version():
+    """現在のツリー版数を取得 (行はマイグレーションで作成済み)
+
+    マイグレーション 15 の適用前や手動の復元で行が無い場合は、版数 0 の行を作り直して 0 を返す
+    (他のプロセスが同時に作った場合はそちらを使う)。GET /api/tabs から呼ぶので、ここでコミットしてよい。
+    """
+    row = db.session.get(TreeVersion, 1)
+    if row is not None:
+        return row.version
+    try:
+        with db.session.begin_nested():
+            db.session.add(TreeVersion(id=1, version=0))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    return 0
+
+def bump_tree_version():
+    """タブ/ページの変更時に版数を進める (呼び出し元の commit で確定する)"""
+    db.session.query(TreeVersion).filter_by(id=1).update(
+        {TreeVersion.version: TreeVersion.version + 1}, synchronize_session=False)
+
+def build_tree_snapshot():
+    """タブとページを1回のクエリで取得してツリーを組み立てる"""
+    rows = db.session.query(
+        Tab.id, Tab.name, Tab.order_index,
+        Page.id, Page.name, Page.order_index
+    ).outerjoin(Page, Page.tab_id == Tab.id).order_by(
+        Tab.order_index, Tab.id, Page.order_index, Page.id
+    ).all()
+
+    tree = []
+    tabs_by_id = {}
+    for tab_id, tab_name, tab_order, page_id, page_name, page_order in rows:
+        tab = tabs_by_id.get(tab_id)
+        if tab is None:
+            tab = {'id': tab_id, 'name': tab_name, 'order_index': tab_order, 'pages': []}
+            tabs_by_id[tab_id] = tab
+            tree.append(tab)
+        if page_id is not None:
+            tab['pages'].append({'id': page_id, 'name': page_name, 'order_index': page_order})
+    return tree
+
+def get_tree_snapshot():
+    """版数が変わっていなければキャッシュ済みのスナップショットを返す"""
+    global _tree_snapshot
+    version = get_tree_version()
+    snapshot = _tree_snapshot
+    if snapshot is not None and snapshot['version'] == version:
+        return snapshot
+
+    with _tree_snapshot_lock:
+        snapshot = _tree_snapshot
+        if snapshot is None or snapshot['version'] != version:
+            body = json.dumps(build_tree_snapshot(), ensure_ascii=False, separators=(',', ':'))
+            snapshot = {
+                'version': version,
+                'body': body,
+                'etag': hashlib.sha1(body.encode('utf-8')).hexdigest()[:20],
+            }
+            _tree_snapshot = snapshot
+        return snapshot
+
 # タブ関連のAPI
 @app.route('/api/tabs', methods=['GET'])
 def get_tabs():
-    tabs = Tab.query.order_by(Tab.order_index).all()
-    return jsonify([{
-        'id': tab.id,
-        'name': tab.name,
-        'order_index': tab.order_index,
-        'pages': [{
-            'id': page.id,
-            'name': page.name,
-            'order_index': page.order_index
-        } for page in tab.pages]
-    } for tab in tabs])
+    snapshot = get_tree_snapshot()
+    response = app.response_class(snapshot['body'], mimetype='application/json')
+    response.set_etag(snapshot['etag'])
+    # ブラウザにキャッシュさせつつ毎回 If-None-Match で再検証させる
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/tabs', methods=['POST'])
 def create_tab():
     data = request.json
     tab = Tab(name=data['name'], order_index=data.get('order_index', 0))
     db.session.add(tab)
+    bump_tree_version()
     db.session.commit()
     return jsonify({'id': tab.id, 'name': tab.name, 'order_index': tab.order_index}), 201
 
@@ -303,14 +601,25 @@ def update_tab(tab_id):
     if 'order_index' in data:
         tab.order_index = data['order_index']
     tab.updated_at = datetime.utcnow()
+    bump_tree_version()
     db.session.commit()
     return jsonify({'id': tab.id, 'name': tab.name, 'order_index': tab.order_index})
 
 @app.route('/api/tabs/<int:tab_id>', methods=['DELETE'])
 def delete_tab(tab_id):
     tab = Tab.query.get_or_404(tab_id)
-    db.session.delete(tab)
+    page_ids = [page_id for (page_id,) in db.session.query(Page.id).filter_by(tab_id=tab_id).all()]
+    search.unindex_sections(db.session.connection(), page_ids=page_ids)
+    released = release_upload_refs(page_ids=page_ids)
+    # ORM のカスケードはページごとにセクションを読み込む (N+1) ため、配下はまとめて削除する
+    if page_ids:
+        Section.query.filter(Section.page_id.in_(page_ids)).delete(synchronize_session=False)
+        Page.query.filter(Page.id.in_(page_ids)).delete(synchronize_session=False)
+    db.session.expunge(tab)
+    Tab.query.filter_by(id=tab_id).delete(synchronize_session=False)
+    bump_tree_version()
     db.session.commit()
+    collect_unreferenced_blobs(released)
     return jsonify({'message': 'Tab deleted'}), 200
 
 # ページ関連のAPI
@@ -319,6 +628,7 @@ def create_page():
     data = request.json
     page = Page(tab_id=data['tab_id'], name=data['name'], order_index=data.get('order_index', 0))
     db.session.add(page)
+    bump_tree_version()
     db.session.commit()
     return jsonify({'id': page.id, 'name': page.name, 'tab_id': page.tab_id, 'order_index': page.order_index}), 201
 
@@ -336,6 +646,7 @@ def get_page(page_id):
             'content_type': section.content_type,
             'content_data': json.loads(section.content_data) if section.content_data else None,
             'memo': section.memo,
+            'content_version': section.content_version or 0,
             'order_index': section.order_index,
             'width': section.width,
             'height': section.height,
@@ -353,14 +664,19 @@ def update_page(page_id):
     if 'order_index' in data:
         page.order_index = data['order_index']
     page.updated_at = datetime.utcnow()
+    bump_tree_version()
     db.session.commit()
     return jsonify({'id': page.id, 'name': page.name, 'order_index': page.order_index})
 
 @app.route('/api/pages/<int:page_id>', methods=['DELETE'])
 def delete_page(page_id):
     page = Page.query.get_or_404(page_id)
+    search.unindex_sections(db.session.connection(), page_ids=[page_id])
+    released = release_upload_refs(page_ids=[page_id])
     db.session.delete(page)
+    bump_tree_version()
     db.session.commit()
+    collect_unreferenced_blobs(released)
     return jsonify({'message': 'Page deleted'}), 200
 
 # セクション関連のAPI
@@ -380,6 +696,9 @@ def create_section():
         position_y=data.get('position_y', 0)
     )
     db.session.add(section)
+    db.session.flush()
+    search.index_section(db.session.connection(), section.id, section.name, section.content_data, section.memo)
+    sync_upload_refs(section.id, section.content_data)
     db.session.commit()
     return jsonify({
         'id': section.id,
@@ -387,6 +706,7 @@ def create_section():
         'content_type': section.content_type,
         'content_data': json.loads(section.content_data) if section.content_data else None,
         'memo': section.memo,
+        'content_version': section.content_version or 0,
         'order_index': section.order_index,
         'width': section.width,
         'height': section.height,
@@ -406,6 +726,8 @@ def update_section(section_id):
         section.content_data = json.dumps(data['content_data'])
     if 'memo' in data:
         section.memo = data['memo']
+    if 'content_data' in data or 'memo' in data:
+        section.content_version = (section.content_version or 0) + 1
     if 'width' in data:
         section.width = data['width']
     if 'height' in data:
@@ -417,13 +739,18 @@ def update_section(section_id):
     if 'order_index' in data:
         section.order_index = data['order_index']
     section.updated_at = datetime.utcnow()
+    if 'name' in data or 'content_data' in data or 'memo' in data:
+        search.index_section(db.session.connection(), section.id, section.name, section.content_data, section.memo)
+    released = sync_upload_refs(section.id, section.content_data) if 'content_data' in data else set()
     db.session.commit()
+    collect_unreferenced_blobs(released)
     return jsonify({
         'id': section.id,
         'name': section.name,
         'content_type': section.content_type,
         'content_data': json.loads(section.content_data) if section.content_data else None,
         'memo': section.memo,
+        'content_version': section.content_version or 0,
         'order_index': section.order_index,
         'width': section.width,
         'height': section.height,
@@ -431,22 +758,417 @@ def update_section(section_id):
         'position_y': section.position_y
     })
 
+# 一括更新で受け付けるカラム (ドラッグ・リサイズ・重なり順・名前変更)
+BATCH_SECTION_INT_FIELDS = ('position_x', 'position_y', 'width', 'height', 'order_index')
+# INTEGER カラムに入る範囲
+BATCH_SECTION_INT_MAX = 2 ** 31 - 1
+
+@app.route('/api/sections/batch', methods=['POST'])
+def batch_update_sections():
+    """複数セクションの位置・サイズ・重なり順を1トランザクションで更新する
+
+    リクエスト: {"updates": [{"id": 1, "position_x": 10, "position_y": 20}, ...]}
+    同じカラムの組み合わせを持つ更新ごとに1回の一括UPDATEを発行する。
+    """
+    data = request.get_json(silent=True) or {}
+    updates = data.get('updates')
+    if not isinstance(updates, list):
+        return jsonify({'error': 'updates must be a list'}), 400
+
+    errors = {}
+    rows_by_id = {}
+    for item in updates:
+        # bool は int の派生なので True / False を id として受け付けないよう除外する
+        if not isinstance(item, dict) or not isinstance(item.get('id'), int) or isinstance(item['id'], bool):
+            return jsonify({'error': 'Each update needs an integer id'}), 400
+        section_id = item['id']
+        row = rows_by_id.setdefault(section_id, {'id': section_id})
+        for key, value in item.items():
+            if key == 'id':
+                continue
+            if key == 'name':
+                if value is not None and not isinstance(value, str):
+                    errors[section_id] = 'invalid value for name'
+                    break
+                row[key] = value
+            elif key in BATCH_SECTION_INT_FIELDS:
+                # 座標はブラウザから小数で届くことがあるので整数に丸める
+                # (JSON の NaN / Infinity も Flask は受け付けるので、有限の値だけを通す)
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) \
+                        or abs(value) > BATCH_SECTION_INT_MAX:
+                    errors[section_id] = f'invalid value for {key}'
+                    break
+                row[key] = int(round(value))
+            else:
+                errors[section_id] = f'unsupported field: {key}'
+                break
+
+    for section_id in errors:
+        rows_by_id.pop(section_id, None)
+
+    existing_ids = set()
+    if rows_by_id:
+        existing_ids = {section_id for (section_id,) in db.session.query(Section.id).filter(
+            Section.id.in_(list(rows_by_id.keys()))).all()}
+    for section_id in list(rows_by_id):
+        if section_id not in existing_ids:
+            errors[section_id] = 'not found'
+            del rows_by_id[section_id]
+
+    # カラムの組み合わせごとにまとめ、主キー指定の executemany で更新する
+    now = datetime.utcnow()
+    groups = {}
+    for row in rows_by_id.values():
+        row['updated_at'] = now
+        groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+
+    try:
+        for rows in groups.values():
+            db.session.execute(db.update(Section), rows)
+        # 名前が変わったセクションは検索データも更新する
+        renamed_ids = [section_id for section_id, row in rows_by_id.items() if 'name' in row]
+        if renamed_ids:
+            for row in db.session.query(Section.id, Section.name, Section.content_data, Section.memo).filter(
+                    Section.id.in_(renamed_ids)).all():
+                search.index_section(db.session.connection(), *row)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({
+        'updated': sorted(rows_by_id.keys()),
+        'errors': {str(section_id): reason for section_id, reason in errors.items()}
+    })
+
+class TextPatchError(ValueError):
+    """差分の適用に失敗した場合の例外"""
+
+def apply_text_ops(text, ops):
+    """offset/delete/insert 形式の編集操作をテキストに適用する
+
+    offset はブラウザの文字列と同じ UTF-16 コード単位で数え、
+    操作は配列の順に、直前の操作を適用した結果に対して適用する。
+    """
+    units = bytearray((text or '').encode('utf-16-le'))
+    for op in ops:
+        try:
+            offset = int(op.get('offset', 0))
+            delete = int(op.get('delete', 0))
+            insert = op.get('insert', '') or ''
+        except (AttributeError, TypeError, ValueError):
+            raise TextPatchError('不正な編集操作です')
+        if not isinstance(insert, str) or offset < 0 or delete < 0 or (offset + delete) * 2 > len(units):
+            raise TextPatchError('編集操作の範囲が不正です')
+        # サロゲートペアの片側だけを含む操作も、適用後に揃えば受け付ける
+        units[offset * 2:(offset + delete) * 2] = insert.encode('utf-16-le', 'surrogatepass')
+    try:
+        return units.decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise TextPatchError('サロゲートペアの途中で分割されています')
+
+@app.route('/api/sections/<int:section_id>/content', methods=['PATCH'])
+def patch_section_content(section_id):
+    """テキスト系セクションの内容を差分で更新する (自動保存用)
+
+    リクエスト: {"field": "text" | "memo", "base_version": n,
+                 "ops": [{"offset": 0, "delete": 0, "insert": "..."}]}
+    base_version が現在のバージョンと一致しない場合は 409 を返すので、
+    クライアントは PUT で全文を送り直す。
+    """
+    section = Section.query.get_or_404(section_id)
+    data = request.get_json(silent=True) or {}
+    field = data.get('field', 'text')
+    ops = data.get('ops')
+    if field not in ('text', 'memo') or not isinstance(ops, list):
+        return jsonify({'error': 'Invalid patch'}), 400
+
+    current_version = section.content_version or 0
+    if data.get('base_version') != current_version:
+        return jsonify({'error': 'Version conflict', 'content_version': current_version}), 409
+
+    try:
+        if field == 'memo':
+            values = {Section.memo: apply_text_ops(section.memo, ops)}
+        else:
+            if section.content_type not in ('text', 'notepad'):
+                return jsonify({'error': 'Not a text section'}), 400
+            content = json.loads(section.content_data) if section.content_data else {}
+            if not isinstance(content, dict):
+                content = {}
+            content['text'] = apply_text_ops(content.get('text'), ops)
+            values = {Section.content_data: json.dumps(content)}
+    except TextPatchError as e:
+        return jsonify({'error': str(e), 'content_version': current_version}), 422
+
+    # 同時に届いた別の差分と競合しないよう、バージョンを条件にして更新する
+    values[Section.content_version] = current_version + 1
+    values[Section.updated_at] = datetime.utcnow()
+    updated = Section.query.filter(
+        Section.id == section_id,
+        db.func.coalesce(Section.content_version, 0) == current_version
+    ).update(values, synchronize_session=False)
+    if updated:
+        search.index_section(
+            db.session.connection(), section_id, section.name,
+            values.get(Section.content_data, section.content_data),
+            values.get(Section.memo, section.memo))
+    db.session.commit()
+    if not updated:
+        db.session.expire(section)
+        return jsonify({'error': 'Version conflict', 'content_version': section.content_version or 0}), 409
+    return jsonify({'id': section_id, 'content_version': current_version + 1})
+
 @app.route('/api/sections/<int:section_id>', methods=['DELETE'])
 def delete_section(section_id):
     section = Section.query.get_or_404(section_id)
-    # ファイルの場合は物理ファイルも削除
+    # 旧形式 (アップロードストア導入前) のファイルは物理ファイルも削除
     if section.content_type == 'file' and section.content_data:
         try:
             content = json.loads(section.content_data)
             file_path = content.get('file_path')
-            if file_path and os.path.exists(file_path):
+            if file_path and blob_hash_from_path(file_path) is None and os.path.exists(file_path):
                 os.remove(file_path)
         except:
             pass
+    released = release_upload_refs(section_ids=[section_id])
+    search.unindex_sections(db.session.connection(), section_ids=[section_id])
     db.session.delete(section)
     db.session.commit()
+    collect_unreferenced_blobs(released)
     return jsonify({'message': 'Section deleted'}), 200
 
+# 全文検索API
+@app.route('/api/search', methods=['GET'])
+def search_sections():
+    """セクション名・本文・メモを全文検索する (関連度順、ページ単位で返す)"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(100, max(1, int(request.args.get('per_page', 20))))
+    except ValueError:
+        return jsonify({'error': 'Invalid page parameters'}), 400
+
+    results, has_more = search.search_sections(
+        db.session.connection(), query, limit=per_page, offset=(page - 1) * per_page)
+    return jsonify({
+        'query': query,
+        'page': page,
+        'per_page': per_page,
+        'has_more': has_more,
+        'results': results
+    })
+
+# ==================== アップロードストア ====================
+# /api/upload のファイルは内容のSHA-256をファイル名にして uploads/blobs/ に1つだけ保存し、
+# セクションごとの参照 (upload_refs) が無くなったときに削除する
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def get_blob_root():
+    return os.path.join(os.path.abspath(app.config['UPLOAD_FOLDER']), 'blobs')
+
+def blob_hash_from_path(file_path):
+    """アップロードストア内のパスなら SHA-256 を返す (それ以外は None)"""
+    if not file_path:
+        return None
+    blob_root = get_blob_root()
+    abs_path = os.path.abspath(file_path)
+    if not abs_path.startswith(blob_root + os.sep):
+        return None
+    name = os.path.splitext(os.path.basename(abs_path))[0]
+    return name if len(name) == 64 else None
+
+def store_upload_blob(stream, filename):
+    """ストリームをハッシュしながら一時ファイルに書き出し、内容アドレスの位置に配置する"""
+    import tempfile
+    blob_root = get_blob_root()
+    tmp_dir = os.path.join(blob_root, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with metrics.track_file_io(), os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        return place_upload_blob(tmp_path, sha256, size, filename)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def place_upload_blob(tmp_path, sha256, size, filename):
+    """書き込み済みの一時ファイルを内容アドレスの位置へ移動し、UploadBlob を返す
+
+    行の登録 (または last_uploaded_at の更新) を先にコミットしてからファイルを置くので、
+    参照の無い古い実体を削除している最中でも、置いたファイルが消されることはない。
+    """
+    now = datetime.utcnow()
+    blob = db.session.get(UploadBlob, sha256)
+    if blob is not None:
+        # 既存の実体: 猶予期間を延ばす (削除と競合して行が消えていれば登録し直す)
+        updated = UploadBlob.query.filter_by(sha256=sha256).update(
+            {UploadBlob.last_uploaded_at: now}, synchronize_session=False)
+        db.session.commit()
+        if not updated:
+            blob = None
+    if blob is None:
+        ext = os.path.splitext(filename or '')[1].lower()[:16]
+        blob = UploadBlob(sha256=sha256, path=os.path.join(get_blob_root(), sha256[:2], sha256 + ext),
+                          size=size, last_uploaded_at=now)
+        db.session.add(blob)
+        try:
+            db.session.commit()
+        except Exception:
+            # 別のワーカーが同じ内容を同時に登録した場合
+            db.session.rollback()
+            blob = db.session.get(UploadBlob, sha256)
+            if blob is None:
+                raise
+    blob_path = blob.path
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    # 同じ内容なので、既存の実体があっても rename で置き換えてよい (同時アップロードでも安全)
+    os.replace(tmp_path, blob_path)
+    return blob
+
+def sync_upload_refs(section_id, content_data):
+    """セクションの content_data が指すアップロード実体への参照を張り替える
+
+    参照が外れた実体の SHA-256 を返すので、commit 後に collect_unreferenced_blobs に渡す。
+    """
+    wanted = set()
+    if content_data:
+        try:
+            content = json.loads(content_data) if isinstance(content_data, str) else content_data
+        except ValueError:
+            content = None
+        if isinstance(content, dict):
+            sha256 = blob_hash_from_path(content.get('file_path'))
+            if sha256:
+                wanted.add(sha256)
+
+    current = {ref.blob_sha256: ref for ref in UploadRef.query.filter_by(section_id=section_id).all()}
+    for sha256 in wanted - set(current):
+        db.session.add(UploadRef(section_id=section_id, blob_sha256=sha256))
+    released = set(current) - wanted
+    for sha256 in released:
+        db.session.delete(current[sha256])
+    return released
+
+def release_upload_refs(section_ids=None, page_ids=None):
+    """削除されるセクション (またはページ配下の全セクション) の参照を外す"""
+    query = UploadRef.query
+    if page_ids:
+        query = query.filter(UploadRef.section_id.in_(
+            db.session.query(Section.id).filter(Section.page_id.in_(page_ids))))
+    elif section_ids:
+        query = query.filter(UploadRef.section_id.in_(section_ids))
+    else:
+        return set()
+    released = {sha256 for (sha256,) in query.with_entities(UploadRef.blob_sha256).all()}
+    query.delete(synchronize_session=False)
+    return released
+
+def collect_unreferenced_blobs(sha256s):
+    """どのセクションからも参照されず、猶予期間を過ぎた実体を削除する (commit 後に呼ぶ)"""
+    for sha256 in sha256s or ():
+        try:
+            blob = db.session.get(UploadBlob, sha256)
+            if blob is None:
+                continue
+            blob_path = blob.path
+            # 参照が無く猶予期間を過ぎていることを条件に行を消し、消せた場合だけ物理ファイルを削除する
+            deleted = UploadBlob.query.filter(
+                UploadBlob.sha256 == sha256,
+                UploadBlob.last_uploaded_at < datetime.utcnow() - app.config['UPLOAD_BLOB_GRACE'],
+                ~db.session.query(UploadRef.id).filter(UploadRef.blob_sha256 == sha256).exists()
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            if deleted:
+                discard_blob_file(sha256, blob_path)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Blob cleanup error ({sha256}): {e}")
+
+def discard_blob_file(sha256, blob_path):
+    """行を削除した実体のファイルを消す
+
+    同じ内容が同時にアップロードされていると、行が登録し直されてファイルが置き直されることがある。
+    先に別名へ移してから行を確かめ、登録し直されていればファイルを戻す。
+    """
+    trash_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.deleted"
+    try:
+        os.rename(blob_path, trash_path)
+    except FileNotFoundError:
+        return
+    db.session.expire_all()
+    if db.session.get(UploadBlob, sha256) is not None and not os.path.exists(blob_path):
+        os.rename(trash_path, blob_path)
+    else:
+        os.remove(trash_path)
+
+_blob_sweep_lock = threading.Lock()
+_blob_sweep_last = None
+
+def sweep_unreferenced_blobs(limit=200):
+    """参照されないまま猶予期間を過ぎた実体 (アップロードしたがセクションに登録されなかったもの) を削除する"""
+    stale = db.session.query(UploadBlob.sha256).filter(
+        UploadBlob.last_uploaded_at < datetime.utcnow() - app.config['UPLOAD_BLOB_GRACE'],
+        ~db.session.query(UploadRef.id).filter(UploadRef.blob_sha256 == UploadBlob.sha256).exists()
+    ).limit(limit).all()
+    collect_unreferenced_blobs(sha256 for (sha256,) in stale)
+    return len(stale)
+
+def maybe_sweep_unreferenced_blobs():
+    """前回から UPLOAD_BLOB_SWEEP_INTERVAL 以上経っていれば sweep_unreferenced_blobs を実行する (プロセスごと)"""
+    global _blob_sweep_last
+    now = time.monotonic()
+    with _blob_sweep_lock:
+        if _blob_sweep_last is not None and now - _blob_sweep_last < app.config['UPLOAD_BLOB_SWEEP_INTERVAL']:
+            return
+        _blob_sweep_last = now
+    try:
+        swept = sweep_unreferenced_blobs()
+        if swept:
+            print(f"[UPLOAD] Swept {swept} unreferenced blob(s)")
+    except Exception as e:
+        db.session.rollback()
+        print(f"[UPLOAD] Blob sweep failed: {e}")
+
+def allocate_unique_path(directory, filename):
+    """同名ファイルがあれば _1, _2 ... を付けた名前で空ファイルを作成し、(パス, fd) を返す
+
+    O_EXCL で作成するので、複数のワーカーが同時に保存しても同じ名前を取り合わない。
+    """
+    name, ext = os.path.splitext(filename)
+    counter = 0
+    while True:
+        candidate = filename if counter == 0 else f"{name}_{counter}{ext}"
+        filepath = os.path.join(directory, candidate)
+        try:
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+        except FileExistsError:
+            counter += 1
+            continue
+        return filepath, fd
+
+def save_to_unique_path(stream, directory, filename):
+    """重複しない名前を確保してストリームを保存する"""
+    filepath, fd = allocate_unique_path(directory, filename)
+    with metrics.track_file_io(), os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(stream, f, UPLOAD_CHUNK_SIZE)
+    return filepath
+
 # ファイルアップロード
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
@@ -457,37 +1179,300 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     
-    # ストレージ場所の取得（デフォルトはローカル）
+    # ストレージ場所が指定された場合はそのフォルダに元のファイル名で保存する
     storage_location_id = request.form.get('storage_location_id', None)
     if storage_location_id:
         storage = StorageLocation.query.get(storage_location_id)
         if storage and storage.is_active:
-            upload_path = storage.path
-        else:
-            upload_path = app.config['UPLOAD_FOLDER']
-    else:
-        upload_path = app.config['UPLOAD_FOLDER']
-    
-    os.makedirs(upload_path, exist_ok=True)
-    
-    # ファイル名の重複を避ける
-    filename = file.filename
-    filepath = os.path.join(upload_path, filename)
-    counter = 1
-    while os.path.exists(filepath):
-        name, ext = os.path.splitext(filename)
-        filepath = os.path.join(upload_path, f"{name}_{counter}{ext}")
-        counter += 1
+            os.makedirs(storage.path, exist_ok=True)
+            filepath = save_to_unique_path(file.stream, storage.path, os.path.basename(file.filename))
+            return jsonify({
+                'filename': os.path.basename(filepath),
+                'file_path': filepath,
+                'file_size': os.path.getsize(filepath),
+                'file_type': file.content_type
+            }), 201
     
-    file.save(filepath)
+    # それ以外はアップロードストアに内容アドレスで保存する (同じ内容は1つだけ)
+    blob = store_upload_blob(file.stream, file.filename)
+    maybe_sweep_unreferenced_blobs()
     
     return jsonify({
-        'filename': os.path.basename(filepath),
-        'file_path': filepath,
-        'file_size': os.path.getsize(filepath),
-        'file_type': file.content_type
+        'filename': os.path.basename(file.filename),
+        'file_path': blob.path,
+        'file_size': blob.size,
+        'file_type': file.content_type,
+        'file_hash': blob.sha256
     }), 201
 
+# ==================== 分割アップロード ====================
+# 1. POST   /api/uploads/sessions                      セッション作成 (ファイル名・サイズ)
+# 2. PUT    /api/uploads/sessions/<id>/chunks/<n>      チャンク送信 (本文はバイナリ、並列送信可)
+# 3. GET    /api/uploads/sessions/<id>                 未受信チャンクの確認 (中断後の再開用)
+# 4. POST   /api/uploads/sessions/<id>/complete        完成 (ハッシュを照合して配置)
+# チャンクは保存先と同じディレクトリに確保した一時ファイルのオフセットへ直接書き込むため、
+# 完成時は rename するだけで済む。
+
+def get_storage_section_path(section):
+    """ストレージセクションのフォルダパスを返す (存在しない場合は None)"""
+    content_data = json.loads(section.content_data) if section.content_data else {}
+    path = content_data.get('path')
+    if path:
+        path = os.path.expanduser(path)
+    if not path or not os.path.exists(path):
+        return None
+    return path
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_upload_session(upload_id):
+    session = db.session.get(UploadSession, upload_id)
+    if session is None or session.expires_at < datetime.utcnow():
+        return None
+    return session
+
+def received_chunk_indexes(upload_id):
+    return {index for (index,) in db.session.query(UploadChunk.chunk_index).filter_by(session_id=upload_id).all()}
+
+def discard_upload_session(session):
+    if os.path.exists(session.part_path):
+        os.remove(session.part_path)
+    UploadChunk.query.filter_by(session_id=session.id).delete(synchronize_session=False)
+    db.session.delete(session)
+
+@app.route('/api/uploads/sessions', methods=['POST'])
+def create_upload_session():
+    data = request.get_json(silent=True) or {}
+    filename = os.path.basename(str(data.get('filename') or ''))
+    size = data.get('size')
+    if not filename or not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'filename and size are required'}), 400
+    if size > app.config['CHUNKED_UPLOAD_MAX_SIZE']:
+        return jsonify({'error': 'File too large'}), 413
+    purge_expired_upload_sessions()
+    maybe_sweep_unreferenced_blobs()
+
+    chunk_size = app.config['CHUNKED_UPLOAD_CHUNK_SIZE']
+    if isinstance(data.get('chunk_size'), int):
+        # 1MB から MAX_CONTENT_LENGTH の範囲でクライアントの指定を受け付ける
+        chunk_size = min(max(data['chunk_size'], 1024 * 1024), app.config['MAX_CONTENT_LENGTH'])
+
+    target_section_id = data.get('section_id')
+    if target_section_id is not None:
+        section = Section.query.get_or_404(target_section_id)
+        if section.content_type != 'storage':
+            return jsonify({'error': 'Not a storage section'}), 400
+        part_dir = get_storage_section_path(section)
+        if part_dir is None:
+            return jsonify({'error': 'Path not found'}), 404
+    else:
+        part_dir = os.path.join(get_blob_root(), 'tmp')
+        os.makedirs(part_dir, exist_ok=True)
+
+    upload_id = secrets.token_hex(16)
+    part_path = os.path.join(part_dir, f".{upload_id}.wownote-part")
+    # 最終サイズで確保しておき、各チャンクは自分のオフセットに書き込む
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+
+    session = UploadSession(
+        id=upload_id,
+        filename=filename,
+        size=size,
+        chunk_size=chunk_size,
+        total_chunks=max(1, -(-size // chunk_size)),
+        part_path=part_path,
+        target_section_id=target_section_id,
+        sha256=(data.get('sha256') or '').lower() or None,
+        expires_at=datetime.utcnow() + app.config['CHUNKED_UPLOAD_EXPIRY']
+    )
+    db.session.add(session)
+    db.session.commit()
+    return jsonify({
+        'upload_id': upload_id,
+        'chunk_size': session.chunk_size,
+        'total_chunks': session.total_chunks
+    }), 201
+
+@app.route('/api/uploads/sessions/<upload_id>', methods=['GET'])
+def get_upload_session_status(upload_id):
+    session = get_upload_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    received = received_chunk_indexes(upload_id)
+    return jsonify({
+        'upload_id': upload_id,
+        'filename': session.filename,
+        'size': session.size,
+        'chunk_size': session.chunk_size,
+        'total_chunks': session.total_chunks,
+        'missing': [i for i in range(session.total_chunks) if i not in received]
+    })
+
+@app.route('/api/uploads/sessions/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    session = get_upload_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    if index < 0 or index >= session.total_chunks:
+        return jsonify({'error': 'Invalid chunk index'}), 400
+
+    offset = index * session.chunk_size
+    expected = min(session.chunk_size, session.size - offset)
+    expected_hash = (request.headers.get('X-Chunk-SHA256') or '').lower()
+    digest = hashlib.sha256() if expected_hash else None
+
+    # multipart を使わず本文をそのままオフセットへ書き込む (一時ファイルへのスプールやコピーをしない)
+    written = 0
+    with metrics.track_file_io(), open(session.part_path, 'r+b') as f:
+        f.seek(offset)
+        while written < expected:
+            chunk = request.stream.read(min(UPLOAD_CHUNK_SIZE, expected - written))
+            if not chunk:
+                break
+            f.write(chunk)
+            if digest:
+                digest.update(chunk)
+            written += len(chunk)
+    if written != expected or request.stream.read(1):
+        return jsonify({'error': f'Chunk size mismatch (expected {expected} bytes)'}), 400
+    if digest and digest.hexdigest() != expected_hash:
+        return jsonify({'error': 'Chunk checksum mismatch'}), 422
+
+    # 同じチャンクの再送は成功として扱う
+    if db.session.get(UploadChunk, (upload_id, index)) is None:
+        db.session.add(UploadChunk(session_id=upload_id, chunk_index=index))
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+    return jsonify({'upload_id': upload_id, 'index': index, 'received': written})
+
+@app.route('/api/uploads/sessions/<upload_id>/complete', methods=['POST'])
+def complete_upload_session(upload_id):
+    session = get_upload_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    received = received_chunk_indexes(upload_id)
+    missing = [i for i in range(session.total_chunks) if i not in received]
+    if missing and session.size > 0:
+        return jsonify({'error': 'Missing chunks', 'missing': missing}), 409
+
+    data = request.get_json(silent=True) or {}
+    expected_hash = (data.get('sha256') or session.sha256 or '').lower()
+
+    # 同じセッションの complete が重なっても一時ファイルに触れるのは1つだけになるよう、
+    # 先にセッションの行を条件付きで削除して取り合い、取れなかった側は 409 にする
+    db.session.expunge(session)
+    claimed = UploadSession.query.filter_by(id=upload_id).delete(synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return jsonify({'error': 'Upload is already being completed'}), 409
+
+    try:
+        if session.target_section_id is None:
+            # アップロードストアに配置する (キーとなるハッシュはここで計算する)
+            sha256 = hash_file(session.part_path)
+            if expected_hash and sha256 != expected_hash:
+                restore_upload_session(session)
+                return jsonify({'error': 'Checksum mismatch', 'sha256': sha256}), 422
+            blob = place_upload_blob(session.part_path, sha256, session.size, session.filename)
+            result = {
+                'filename': session.filename,
+                'file_path': blob.path,
+                'file_size': blob.size,
+                'file_type': data.get('file_type'),
+                'file_hash': blob.sha256
+            }
+        else:
+            if expected_hash:
+                sha256 = hash_file(session.part_path)
+                if sha256 != expected_hash:
+                    restore_upload_session(session)
+                    return jsonify({'error': 'Checksum mismatch', 'sha256': sha256}), 422
+            # 同名ファイルがあれば別名にして確保し、一時ファイルで置き換える (同じディレクトリなので rename のみ)
+            directory = os.path.dirname(session.part_path)
+            final_path, fd = allocate_unique_path(directory, session.filename)
+            os.close(fd)
+            os.replace(session.part_path, final_path)
+            result = {
+                'filename': os.path.basename(final_path),
+                'file_path': final_path,
+                'file_size': session.size
+            }
+    except Exception:
+        # 一時ファイルが残っていれば、やり直せるようにセッションを戻す
+        db.session.rollback()
+        if os.path.exists(session.part_path):
+            restore_upload_session(session)
+        raise
+
+    UploadChunk.query.filter_by(session_id=upload_id).delete(synchronize_session=False)
+    db.session.commit()
+    return jsonify(result), 201
+
+def restore_upload_session(session):
+    """complete のために削除したセッションの行を戻す (チャンクの行は残してある)"""
+    sa.orm.make_transient(session)
+    db.session.add(session)
+    db.session.commit()
+
+@app.route('/api/uploads/sessions/<upload_id>', methods=['DELETE'])
+def abort_upload_session(upload_id):
+    session = db.session.get(UploadSession, upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    discard_upload_session(session)
+    db.session.commit()
+    return jsonify({'message': 'Upload aborted'}), 200
+
+def purge_expired_upload_sessions():
+    """期限切れの分割アップロードを削除する"""
+    for session in UploadSession.query.filter(UploadSession.expires_at < datetime.utcnow()).all():
+        discard_upload_session(session)
+    db.session.commit()
+
+# ==================== ファイル配信 ====================
+# プレビューを開くたびにファイル全体を再取得しないよう、強いETagと Last-Modified を付け、
+# If-None-Match / If-Modified-Since には 304、Range には 206 で応答する (werkzeug の conditional 送信)。
+# 本体の送信は wsgi.file_wrapper (gunicorn では sendfile) または X-Sendfile に任せる。
+
+@lru_cache(maxsize=1024)
+def guess_mimetype(filename):
+    """拡張子からMIMEタイプを推測する (結果をキャッシュ)"""
+    if filename.lower().endswith('.pdf'):
+        return 'application/pdf'
+    return mimetypes.guess_type(filename)[0]
+
+def file_etag(stat_result):
+    """inode・サイズ・更新時刻から強いETagを作る"""
+    return f"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+
+def send_file_conditional(file_path, download_name=None, as_attachment=False, etag=None):
+    """ETag・Last-Modified・Range に対応したファイル送信"""
+    stat_result = os.stat(file_path)
+    name = download_name or os.path.basename(file_path)
+    response = send_file(
+        file_path,
+        mimetype=guess_mimetype(name),
+        as_attachment=as_attachment,
+        download_name=name,
+        conditional=True,
+        etag=etag or file_etag(stat_result),
+        last_modified=stat_result.st_mtime,
+        max_age=0
+    )
+    # キャッシュは保持しつつ、毎回サーバーに再検証させる
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response
+
 @app.route('/api/files/<int:section_id>')
 def get_file(section_id):
     section = Section.query.get_or_404(section_id)
@@ -508,13 +1493,273 @@ def get_file(section_id):
         if not (abs_file_path.startswith(upload_folder) or abs_file_path.startswith(storage_base)):
             return jsonify({'error': 'Access denied'}), 403
         
-        return send_file(file_path, as_attachment=False, download_name=content.get('filename', 'file'))
+        # アップロードストアの実体は内容のハッシュをそのままETagにできる
+        return send_file_conditional(
+            file_path,
+            download_name=content.get('filename', 'file'),
+            etag=blob_hash_from_path(file_path)
+        )
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ==================== ストレージ一覧キャッシュ ====================
+# ページ描画のたびに同じフォルダを走査しないよう、(セクション, フォルダ) ごとに一覧を保持し、
+# フォルダ自体の更新時刻が変わっていなければ stat 1回でそのまま返す。
+# (フォルダ内ファイルの上書きだけではフォルダの更新時刻は変わらないため、サイズ等はその分古くなり得る)
+STORAGE_LISTING_CACHE_SIZE = 256
+# 更新時刻の分解能より新しいフォルダはキャッシュしない (同じ時刻内の追加を見逃さないため)
+STORAGE_LISTING_SETTLE_SECONDS = 2
+
+_storage_listing_cache = {}
+_storage_listing_lock = threading.Lock()
+
+def iter_storage_entries(path):
+    """os.scandir でフォルダ内のエントリを列挙順に返す (DirEntry にキャッシュされた stat を使う)"""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # 分割アップロード中の一時ファイルは表示しない
+            if entry.name.endswith('.wownote-part'):
+                continue
+            try:
+                is_dir = entry.is_dir()
+                stats = entry.stat()
+            except OSError:
+                # リンク切れなど、読めないエントリは飛ばす
+                continue
+            yield {
+                'name': entry.name,
+                'size': stats.st_size if not is_dir else 0,
+                'updated_at': datetime.fromtimestamp(stats.st_mtime).isoformat(),
+                'is_directory': is_dir
+            }
+
+def sort_storage_items(items):
+    """フォルダを先に、名前順に並べる"""
+    items.sort(key=lambda x: (not x['is_directory'], x['name'].lower()))
+    return items
+
+def scan_storage_dir(path):
+    """os.scandir 1回でフォルダ内の一覧を作る (フォルダを先に、名前順)"""
+    with metrics.track_file_io():
+        return sort_storage_items(list(iter_storage_entries(path)))
+
+def storage_dir_signature(path):
+    dir_stat = os.stat(path)
+    return (dir_stat.st_ino, dir_stat.st_mtime_ns), dir_stat.st_mtime
+
+def store_storage_listing(key, signature, dir_mtime, items):
+    if time.time() - dir_mtime < STORAGE_LISTING_SETTLE_SECONDS:
+        return
+    with _storage_listing_lock:
+        if len(_storage_listing_cache) >= STORAGE_LISTING_CACHE_SIZE:
+            # 一番古く登録されたものから捨てる
+            _storage_listing_cache.pop(next(iter(_storage_listing_cache)), None)
+        _storage_listing_cache[key] = (signature, items)
+
+def get_cached_storage_listing(section_id, path, signature):
+    cached = _storage_listing_cache.get((section_id, path))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    return None
+
+def get_storage_listing(section_id, path):
+    """フォルダの更新時刻で検証しつつ、キャッシュ済みの一覧を返す"""
+    signature, dir_mtime = storage_dir_signature(path)
+    items = get_cached_storage_listing(section_id, path, signature)
+    if items is not None:
+        return items
+
+    items = scan_storage_dir(path)
+    store_storage_listing((section_id, path), signature, dir_mtime, items)
+    return items
+
+# ==================== ストレージ一覧のページング ====================
+# 大きなフォルダでも1回の応答を小さく保つため、並び順のキーをカーソルにしたページングと、
+# 列挙しながら1行ずつ返す NDJSON 形式を用意する。
+# フォルダは常にファイルより先に並び、同じキーの中は名前順になる。
+
+STORAGE_SORT_KEYS = {
+    'name': lambda item: item['name'].lower(),
+    'size': lambda item: item['size'],
+    'mtime': lambda item: item['updated_at'],
+    'type': lambda item: os.path.splitext(item['name'])[1].lower(),
+}
+STORAGE_PAGE_MAX = 1000
+
+_storage_sorted_views = {}
+
+class StorageListingError(ValueError):
+    """一覧のパラメータ (並び順・カーソル) が不正"""
+
+def storage_item_key(item, sort):
+    return (STORAGE_SORT_KEYS[sort](item), item['name'].lower(), item['name'])
+
+def get_sorted_storage_view(section_id, path, items, sort):
+    """並び順ごとに (フォルダ, ファイル) それぞれ昇順に並べたキーと要素を返す (一覧が同じ間は使い回す)"""
+    view_key = (section_id, path, sort)
+    cached = _storage_sorted_views.get(view_key)
+    if cached is not None and cached[0] is items:
+        return cached[1]
+
+    groups = []
+    for is_dir in (True, False):
+        keyed = sorted((storage_item_key(item, sort), item) for item in items if item['is_directory'] == is_dir)
+        groups.append(([k for k, _ in keyed], [item for _, item in keyed]))
+    with _storage_listing_lock:
+        if len(_storage_sorted_views) >= STORAGE_LISTING_CACHE_SIZE:
+            _storage_sorted_views.pop(next(iter(_storage_sorted_views)), None)
+        _storage_sorted_views[view_key] = (items, groups)
+    return groups
+
+def encode_storage_cursor(item, sort):
+    payload = [sort, 1 if item['is_directory'] else 0] + list(storage_item_key(item, sort))
+    return base64.urlsafe_b64encode(json.dumps(payload, ensure_ascii=False).encode('utf-8')).decode('ascii')
+
+def decode_storage_cursor(cursor, sort):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        cursor_sort, is_dir, key = payload[0], bool(payload[1]), tuple(payload[2:5])
+    except (ValueError, TypeError, IndexError):
+        raise StorageListingError('Invalid cursor')
+    if cursor_sort != sort or len(key) != 3:
+        raise StorageListingError('Cursor does not match sort')
+    return is_dir, key
+
+def match_storage_filter(name, prefix, pattern):
+    """名前の前方一致 / ワイルドカード (大文字小文字を区別しない) で絞り込む"""
+    lowered = name.lower()
+    if prefix and not lowered.startswith(prefix):
+        return False
+    if pattern and not fnmatch.fnmatchcase(lowered, pattern):
+        return False
+    return True
+
+def page_storage_listing(groups, sort, descending, cursor, limit, prefix, pattern):
+    """カーソルの次から limit 件を返す ((要素リスト, 次のカーソル))"""
+    start_dir, start_key = (None, None)
+    if cursor:
+        start_dir, start_key = decode_storage_cursor(cursor, sort)
+
+    page = []
+    for is_dir, (keys, group_items) in zip((True, False), groups):
+        if start_dir is False and is_dir:
+            # カーソルが既にファイル側にある
+            continue
+        if start_dir == is_dir:
+            try:
+                if descending:
+                    indexes = range(bisect.bisect_left(keys, start_key) - 1, -1, -1)
+                else:
+                    indexes = range(bisect.bisect_right(keys, start_key), len(keys))
+            except TypeError:
+                raise StorageListingError('Invalid cursor')
+        else:
+            indexes = range(len(keys) - 1, -1, -1) if descending else range(len(keys))
+
+        for index in indexes:
+            item = group_items[index]
+            if not match_storage_filter(item['name'], prefix, pattern):
+                continue
+            if len(page) == limit:
+                # もう1件あるので、最後に返した要素をカーソルにする
+                return page, encode_storage_cursor(page[-1], sort)
+            page.append(item)
+    return page, None
+
+def stream_storage_listing(section_id, path, prefix, pattern):
+    """フォルダを列挙しながら1エントリ1行のJSONを返す (並び順は列挙順)"""
+    signature, dir_mtime = storage_dir_signature(path)
+    cached = get_cached_storage_listing(section_id, path, signature)
+    if cached is not None:
+        for item in cached:
+            if match_storage_filter(item['name'], prefix, pattern):
+                yield json.dumps(item, ensure_ascii=False) + '\n'
+        return
+
+    items = []
+    for item in iter_storage_entries(path):
+        items.append(item)
+        if match_storage_filter(item['name'], prefix, pattern):
+            yield json.dumps(item, ensure_ascii=False) + '\n'
+    # 最後まで列挙できたら次回の一覧用にキャッシュしておく
+    store_storage_listing((section_id, path), signature, dir_mtime, sort_storage_items(items))
+
+# ==================== サムネイル ====================
+# 画像セクションとストレージのグリッド表示は原寸画像ではなくこちらの縮小画像を読み込む
+
+thumbnail_cache = thumbnails.ThumbnailCache(
+    app.config['THUMBNAIL_CACHE_FOLDER'],
+    app.config['THUMBNAIL_CACHE_MAX_BYTES'],
+    workers=app.config['THUMBNAIL_WORKERS']
+)
+
+def send_thumbnail(source_path, download_name):
+    """?size= の大きさのサムネイルを返す (作れない形式の場合は元ファイルを返す)"""
+    try:
+        size = int(request.args.get('size', thumbnails.DEFAULT_THUMBNAIL_SIZE))
+    except ValueError:
+        size = 0
+    if size not in thumbnails.THUMBNAIL_SIZES:
+        return jsonify({'error': f'size must be one of {list(thumbnails.THUMBNAIL_SIZES)}'}), 400
+
+    if not thumbnails.is_thumbnail_source(download_name):
+        return send_file_conditional(source_path, download_name=download_name)
+    try:
+        with metrics.track_file_io():
+            thumb_path, key = thumbnail_cache.get(source_path, size)
+    except thumbnails.ThumbnailUnavailable as e:
+        print(f"[THUMBNAIL] Fallback to original for {source_path}: {e}")
+        return send_file_conditional(source_path, download_name=download_name)
+    except thumbnails.ThumbnailTimeout:
+        return jsonify({'error': 'Thumbnail is being generated'}), 503, {'Retry-After': '2'}
+    return send_file_conditional(thumb_path, etag=key)
+
+@app.route('/api/files/<int:section_id>/thumbnail')
+def get_file_thumbnail(section_id):
+    section = Section.query.get_or_404(section_id)
+    if section.content_type not in ['file', 'image'] or not section.content_data:
+        return jsonify({'error': 'Not a file or image section'}), 400
+
+    content = json.loads(section.content_data)
+    file_path = content.get('file_path')
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'File not found'}), 404
+
+    # セキュリティのため、パスを検証 (get_file と同じ)
+    upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    storage_base = os.path.abspath(app.config['STORAGE_BASE_PATH'])
+    abs_file_path = os.path.abspath(file_path)
+    if not (abs_file_path.startswith(upload_folder) or abs_file_path.startswith(storage_base)):
+        return jsonify({'error': 'Access denied'}), 403
+
+    return send_thumbnail(file_path, content.get('filename') or os.path.basename(file_path))
+
+@app.route('/api/sections/<int:section_id>/thumbnails/<path:filename>')
+def get_section_file_thumbnail(section_id, filename):
+    section = Section.query.get_or_404(section_id)
+    if section.content_type != 'storage':
+        return jsonify({'error': 'Not a storage section'}), 400
+
+    path = get_storage_section_path(section)
+    if not path:
+        return jsonify({'error': 'Path not found'}), 404
+    file_path = os.path.join(path, filename)
+    if not os.path.isfile(file_path):
+        return jsonify({'error': f'File not found: {filename}'}), 404
+
+    return send_thumbnail(file_path, os.path.basename(filename))
+
 # セクション内のファイル操作API
 @app.route('/api/sections/<int:section_id>/files', methods=['GET'])
 def list_section_files(section_id):
+    """ストレージセクションのファイル一覧
+
+    limit・prefix・glob が無い場合は従来どおり全件の配列を返す (sort・order があればその順に並べる)。
+      limit, cursor         : ページング ({items, next_cursor} を返す)
+      sort, order           : name / size / mtime / type, asc / desc
+      prefix, glob          : 名前の前方一致 / ワイルドカードで絞り込み
+      format=ndjson         : 列挙しながら1行1エントリで返す (sort は無視)
+    """
     section = Section.query.get_or_404(section_id)
     if section.content_type != 'storage':
         return jsonify({'error': 'Not a storage section'}), 400
@@ -529,23 +1774,41 @@ def list_section_files(section_id):
         if not path or not os.path.exists(path):
             return jsonify({'error': f'Path not found: {path}'}), 404
             
-        items = []
-        for item_name in os.listdir(path):
-            item_path = os.path.join(path, item_name)
-            stats = os.stat(item_path)
-            is_dir = os.path.isdir(item_path)
-            
-            items.append({
-                'name': item_name,
-                'size': stats.st_size if not is_dir else 0,
-                'updated_at': datetime.fromtimestamp(stats.st_mtime).isoformat(),
-                'is_directory': is_dir
-            })
-        
-        # フォルダを先に、ファイルを後に並べる
-        items.sort(key=lambda x: (not x['is_directory'], x['name'].lower()))
-        
-        return jsonify(items)
+        prefix = request.args.get('prefix', '').lower()
+        pattern = request.args.get('glob', '').lower()
+        if request.args.get('format') == 'ndjson':
+            return app.response_class(
+                stream_with_context(stream_storage_listing(section_id, path, prefix, pattern)),
+                mimetype='application/x-ndjson',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+        items = get_storage_listing(section_id, path)
+        sorted_requested = 'sort' in request.args or 'order' in request.args
+        if 'limit' not in request.args and not (prefix or pattern) and not sorted_requested:
+            return jsonify(items)
+
+        sort = request.args.get('sort', 'name')
+        if sort not in STORAGE_SORT_KEYS:
+            return jsonify({'error': f'Invalid sort: {sort}'}), 400
+        descending = request.args.get('order', 'asc') == 'desc'
+        if 'limit' not in request.args and not (prefix or pattern):
+            # 従来の配列のまま、フォルダ → ファイルの順にそれぞれ並べて返す
+            groups = get_sorted_storage_view(section_id, path, items, sort)
+            return jsonify([item for _, group_items in groups
+                            for item in (reversed(group_items) if descending else group_items)])
+        try:
+            limit = min(STORAGE_PAGE_MAX, max(1, int(request.args.get('limit', STORAGE_PAGE_MAX))))
+        except ValueError:
+            return jsonify({'error': 'Invalid limit'}), 400
+
+        groups = get_sorted_storage_view(section_id, path, items, sort)
+        try:
+            page, next_cursor = page_storage_listing(
+                groups, sort, descending, request.args.get('cursor'), limit, prefix, pattern)
+        except StorageListingError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'items': page, 'next_cursor': next_cursor})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -572,7 +1835,8 @@ def upload_section_file(section_id):
         if file.filename == '':
             return jsonify({'error': 'No selected file'}), 400
             
-        file.save(os.path.join(path, file.filename))
+        with metrics.track_file_io():
+            file.save(os.path.join(path, file.filename))
         
         return jsonify({'message': 'File uploaded successfully'})
     except Exception as e:
@@ -624,20 +1888,111 @@ def download_section_file(section_id, filename):
         if not os.path.exists(file_path):
             return jsonify({'error': f'File not found: {filename}'}), 404
         
-        # MIMEタイプを推測
-        import mimetypes
-        mimetype, _ = mimetypes.guess_type(filename)
-        
-        # PDFの場合は明示的にMIMEタイプを設定
-        if filename.lower().endswith('.pdf'):
-            mimetype = 'application/pdf'
-            
         as_attachment = request.args.get('download', '0') == '1'
         
-        return send_file(file_path, as_attachment=as_attachment, mimetype=mimetype)
+        return send_file_conditional(file_path, download_name=os.path.basename(filename), as_attachment=as_attachment)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ==================== バックグラウンドジョブ ====================
+# コピー・移動・解凍はリクエストの中で実行せず、ジョブIDを返してワーカーで実行する。
+# 画面は GET /api/jobs/<id> をポーリングして進捗を表示する。
+
+file_job_runner = jobs.JobRunner(lambda: db.engine, workers=app.config['FILE_JOB_WORKERS'])
+
+def inline_job_size_error(measure):
+    """CGI で実行するには大きすぎるジョブならエラーの応答を返す (measure() は処理するバイト数)
+
+    CGI ではリクエストの中でジョブを実行するので、Webサーバーのタイムアウトで途中で止められないよう大きさを制限する。
+    常駐サーバーでは measure() を呼ばずに None を返す。
+    """
+    if not app.config['FILE_JOBS_INLINE']:
+        return None
+    limit = app.config['FILE_JOB_INLINE_MAX_BYTES']
+    if measure() > limit:
+        return jsonify({'error': f'Too large to process in CGI mode (limit {limit} bytes). '
+                                 'Run the server mode (server.sh) for large copy, move or extract jobs.'}), 413
+    return None
+
+def start_file_job(kind, section_id, filename, func, *args, target_section_id=None):
+    """ジョブを登録してワーカーに渡す (CGI ではこのリクエストの中で実行してから返す)"""
+    job = FileJob(
+        id=secrets.token_hex(16),
+        kind=kind,
+        status=jobs.JOB_QUEUED,
+        section_id=section_id,
+        target_section_id=target_section_id,
+        filename=filename
+    )
+    db.session.add(job)
+    # ワーカーが行を読めるよう、渡す前にコミットしておく
+    db.session.commit()
+    if app.config['FILE_JOBS_INLINE']:
+        file_job_runner.run_inline(job.id, func, *args)
+        db.session.refresh(job)
+    else:
+        file_job_runner.submit(job.id, func, *args)
+    return job
+
+def mark_stale_jobs(job_id=None):
+    """受け持つプロセスが止まった待機中・実行中のジョブを失敗扱いにし、書きかけのコピー先を削除する
+
+    受け持つプロセスは待機中のジョブも含めてハートビートで updated_at を更新するので、
+    更新の途絶えたジョブはプロセスごと止まったもの (max_requests での入れ替え・reload・異常終了) とみなす。
+    ハートビートが直前に届いていれば書き換えないよう、状態と更新時刻を条件にした UPDATE で行い、
+    書き換えられたジョブの cleanup_path だけを削除する。
+    """
+    now = datetime.utcnow()
+    cutoff = now - app.config['FILE_JOB_STALE_AFTER']
+    active = (jobs.JOB_QUEUED, jobs.JOB_RUNNING)
+    query = db.session.query(FileJob.id, FileJob.cleanup_path).filter(FileJob.status.in_(active),
+                                                                      FileJob.updated_at < cutoff)
+    if job_id is not None:
+        query = query.filter(FileJob.id == job_id)
+    stale = query.all()
+    if not stale:
+        return
+    failed_paths = []
+    for stale_id, cleanup_path in stale:
+        marked = FileJob.query.filter(FileJob.id == stale_id, FileJob.status.in_(active),
+                                      FileJob.updated_at < cutoff).update(
+            {FileJob.status: jobs.JOB_FAILED, FileJob.error: 'Interrupted', FileJob.cleanup_path: None,
+             FileJob.finished_at: now, FileJob.updated_at: now}, synchronize_session=False)
+        if marked and cleanup_path:
+            failed_paths.append(cleanup_path)
+    db.session.commit()
+    for path in failed_paths:
+        jobs.remove_path(path)
+
+@app.route('/api/jobs', methods=['GET'])
+def list_file_jobs():
+    """最近のジョブ (?active=1 で未完了のものだけ)"""
+    mark_stale_jobs()
+    query = FileJob.query
+    if request.args.get('active') == '1':
+        query = query.filter(FileJob.status.notin_(jobs.FINISHED_STATUSES))
+    job_list = query.order_by(FileJob.created_at.desc()).limit(50).all()
+    return jsonify([job.to_dict() for job in job_list])
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_file_job(job_id):
+    mark_stale_jobs(job_id)
+    job = db.session.get(FileJob, job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_file_job(job_id):
+    """キャンセルを要求する (実行中のジョブは次の進捗更新で中断し、途中の結果を片付ける)"""
+    job = db.session.get(FileJob, job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status not in jobs.FINISHED_STATUSES:
+        job.cancel_requested = True
+        db.session.commit()
+    return jsonify(job.to_dict()), 202
+
 @app.route('/api/sections/<int:source_section_id>/files/<path:filename>/move', methods=['POST'])
 def move_section_file(source_section_id, filename):
     source_section = Section.query.get_or_404(source_section_id)
@@ -685,10 +2040,15 @@ def move_section_file(source_section_id, filename):
             target_file = os.path.join(dir_name, f"{name}_{counter}{ext}")
             counter += 1
 
-        # ファイルを移動
-        shutil.move(source_file, target_file)
-        
-        return jsonify({'message': 'File moved successfully'}), 200
+        # ファイルを移動 (別デバイスへの移動はコピーになるためバックグラウンドで行う)
+        error = inline_job_size_error(
+            lambda: 0 if os.stat(source_file).st_dev == os.stat(target_path).st_dev
+            else jobs.measure_path(source_file)[0])
+        if error:
+            return error
+        job = start_file_job('move', source_section_id, filename, jobs.move_path, source_file, target_file,
+                             target_section_id=target_section.id)
+        return jsonify({'message': 'Move started', 'job': job.to_dict()}), 202
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -739,18 +2099,89 @@ def copy_section_file(source_section_id, filename):
             target_file = os.path.join(dir_name, f"{name}_{counter}{ext}")
             counter += 1
 
-        # ファイル・フォルダをコピー
-        if os.path.isdir(source_file):
-            import shutil
-            shutil.copytree(source_file, target_file)
-        else:
-            import shutil
-            shutil.copy2(source_file, target_file)
-        
-        return jsonify({'message': 'File/Folder copied successfully'}), 200
+        # ファイル・フォルダをコピー (バックグラウンドで行う)
+        error = inline_job_size_error(lambda: jobs.measure_path(source_file)[0])
+        if error:
+            return error
+        job = start_file_job('copy', source_section_id, filename, jobs.copy_path, source_file, target_file,
+                             target_section_id=target_section.id)
+        return jsonify({'message': 'Copy started', 'job': job.to_dict()}), 202
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ==================== ZIPでまとめてダウンロード ====================
+# ストレージのフォルダ、またはページ内のファイル/画像セクションを、一時ファイルを作らずにZIPにしながら送る
+
+def zip_download_response(entries, download_name):
+    from urllib.parse import quote
+    response = app.response_class(
+        stream_with_context(archive.stream_zip(archive.unique_arcnames(entries))),
+        mimetype='application/zip'
+    )
+    # 日本語のファイル名は filename* で渡す (古いブラウザ向けに ASCII の filename も付ける)
+    response.headers['Content-Disposition'] = (
+        f"attachment; filename=\"archive.zip\"; filename*=UTF-8''{quote(download_name)}")
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/sections/<int:section_id>/archive', methods=['GET'])
+def download_section_archive(section_id):
+    """ストレージセクションのフォルダ (?path= でサブフォルダ) をZIPでダウンロードする"""
+    section = Section.query.get_or_404(section_id)
+    if section.content_type != 'storage':
+        return jsonify({'error': 'Not a storage section'}), 400
+
+    root = get_storage_section_path(section)
+    if not root:
+        return jsonify({'error': 'Path not found'}), 404
+    root = os.path.realpath(root)
+    folder = os.path.realpath(os.path.join(root, request.args.get('path', '')))
+    if folder != root and not folder.startswith(root + os.sep):
+        return jsonify({'error': 'Access denied'}), 403
+    if not os.path.isdir(folder):
+        return jsonify({'error': 'Folder not found'}), 404
+
+    entries = archive.iter_folder_entries(folder, skip_suffixes=('.wownote-part',))
+    return zip_download_response(entries, (os.path.basename(folder) or 'storage') + '.zip')
+
+@app.route('/api/pages/<int:page_id>/archive', methods=['GET'])
+def download_page_archive(page_id):
+    """ページ内のファイル/画像セクションの添付ファイルをまとめてZIPでダウンロードする"""
+    page = Page.query.get_or_404(page_id)
+    rows = db.session.query(Section.id, Section.name, Section.content_data).filter(
+        Section.page_id == page_id,
+        Section.content_type.in_(['file', 'image'])
+    ).order_by(Section.id).all()
+
+    upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    storage_base = os.path.abspath(app.config['STORAGE_BASE_PATH'])
+    entries = []
+    for section_id, section_name, content_data in rows:
+        try:
+            content = json.loads(content_data) if content_data else {}
+        except ValueError:
+            continue
+        file_path = content.get('file_path')
+        if not file_path:
+            continue
+        # get_file と同じく、アップロード先とストレージ以外のファイルは含めない
+        abs_file_path = os.path.abspath(file_path)
+        if not (abs_file_path.startswith(upload_folder) or abs_file_path.startswith(storage_base)):
+            continue
+        if not os.path.isfile(abs_file_path):
+            continue
+        filename = os.path.basename(content.get('filename') or section_name or os.path.basename(file_path))
+        entries.append((filename, abs_file_path))
+
+    if not entries:
+        return jsonify({'error': 'No files on this page'}), 404
+    return zip_download_response(entries, f"{page.name or 'page'}.zip")
+
+def extract_zip_job(progress, zip_file_path, path, limits, subfolder):
+    return archive.extract_zip(progress, zip_file_path, path, limits, subfolder=subfolder,
+                               workers=app.config['ZIP_EXTRACT_WORKERS'])
+
 @app.route('/api/sections/<int:section_id>/files/<path:filename>/extract', methods=['POST'])
 def extract_zip_file(section_id, filename):
     section = Section.query.get_or_404(section_id)
@@ -774,13 +2205,35 @@ def extract_zip_file(section_id, filename):
             
         if not filename.lower().endswith('.zip'):
             return jsonify({'error': 'Not a ZIP file'}), 400
-            
-        # ZIPファイルを解凍
-        import zipfile
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            zip_ref.extractall(path)
-        
-        return jsonify({'message': 'ZIP file extracted successfully'}), 200
+
+        # {"subfolder": true} ならZIPと同じ名前の新しいフォルダに、文字列ならその名前のフォルダに展開する
+        data = request.get_json(silent=True) or {}
+        subfolder = data.get('subfolder')
+        if subfolder is True:
+            subfolder = os.path.splitext(os.path.basename(filename))[0]
+        elif subfolder:
+            subfolder = os.path.basename(str(subfolder).strip())
+            if subfolder in ('', '.', '..'):
+                return jsonify({'error': 'Invalid subfolder name'}), 400
+
+        # 上限・パスの検査はセントラルディレクトリを読むだけなので、ここで済ませてすぐにエラーを返す
+        limits = archive.ExtractLimits(
+            max_total_size=app.config['ZIP_EXTRACT_MAX_SIZE'],
+            max_entries=app.config['ZIP_EXTRACT_MAX_ENTRIES'],
+            max_ratio=app.config['ZIP_EXTRACT_MAX_RATIO']
+        )
+        try:
+            _, _, total_size = archive.inspect_zip(zip_file_path, path, limits)
+        except archive.ArchiveError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # ZIPファイルを解凍 (バックグラウンドで行う)
+        error = inline_job_size_error(lambda: total_size)
+        if error:
+            return error
+        job = start_file_job('extract', section_id, filename, extract_zip_job, zip_file_path, path, limits,
+                             subfolder)
+        return jsonify({'message': 'Extraction started', 'job': job.to_dict()}), 202
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1062,16 +2515,88 @@ def generate_verification_token():
     """メール認証用のトークンを生成"""
     return secrets.token_urlsafe(32)
 
+# ==================== メール送信キュー ====================
+# リクエストの中では SMTP に接続せず、mail_outbox に積んで送信スレッドに任せる (mailer.py)
+mail_sender = mailer.MailSender(
+    app, lambda: db.engine, get_mail,
+    batch_size=app.config['MAIL_OUTBOX_BATCH_SIZE'],
+    max_attempts=app.config['MAIL_MAX_ATTEMPTS'],
+    retry_base=app.config['MAIL_RETRY_BASE_SECONDS'],
+    retry_max=app.config['MAIL_RETRY_MAX_SECONDS'],
+    idle_timeout=app.config['MAIL_SMTP_IDLE_SECONDS'],
+    check_interval=app.config['MAIL_OUTBOX_CHECK_SECONDS']
+)
+
+def enqueue_mail(kind, subject, recipients, body=None, html=None, sender=None):
+    """メールを送信キューに積んでコミットし、送信スレッドを起こす
+
+    セッションに追加済みの変更 (トークンなど) も同じトランザクションでコミットされる。
+    """
+    mail = MailOutbox(
+        id=mailer.new_mail_id(),
+        kind=kind,
+        status=mailer.MAIL_QUEUED,
+        sender=sender,
+        recipients=json.dumps(recipients, ensure_ascii=False),
+        subject=subject,
+        body=body,
+        html=html
+    )
+    db.session.add(mail)
+    db.session.commit()
+    mail_sender.wake()
+    return mail
+
+@app.before_request
+def resume_mail_sender():
+    # 再送の予定時刻を過ぎていれば送信スレッドを起こす
+    # (ふだんはメモリ上の時刻を比べるだけで、MAIL_OUTBOX_CHECK_SECONDS ごとにテーブルを確かめる)
+    mail_sender.wake_if_due()
+
+@app.route('/api/mail/outbox/<mail_id>', methods=['GET'])
+def get_mail_status(mail_id):
+    """送信キューに積んだメールの配信状況"""
+    mail = db.session.get(MailOutbox, mail_id)
+    if mail is None:
+        return jsonify({'error': 'Mail not found'}), 404
+    return jsonify(mail.to_dict())
+
+@app.route('/api/mail/outbox', methods=['GET'])
+def get_mail_outbox_summary():
+    """状態ごとの件数と最近の失敗 (宛先を含むのでサーバー間の内部認証が必要)"""
+    if request.headers.get('X-Internal-Auth') != app.config['SECRET_KEY']:
+        return jsonify({'error': 'Unauthorized'}), 401
+    counts = dict(db.session.query(MailOutbox.status, db.func.count(MailOutbox.id)).group_by(MailOutbox.status).all())
+    failures = (MailOutbox.query.filter(MailOutbox.last_error.isnot(None), MailOutbox.status != mailer.MAIL_SENT)
+                .order_by(MailOutbox.updated_at.desc()).limit(20).all())
+    return jsonify({
+        'counts': counts,
+        'failures': [dict(mail.to_dict(), recipients=json.loads(mail.recipients)) for mail in failures]
+    })
+
+@app.route('/api/remote/metrics', methods=['GET'])
+def get_remote_metrics():
+    """リモートの認証サーバーへの呼び出しの所要時間とサーキットブレーカーの状態 (/metrics と同じく内部向け)"""
+    if not is_internal_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    client = get_remote_client()
+    return jsonify({
+        'circuit': client.breaker.state,
+        'consecutive_failures': client.breaker.failures,
+        'endpoints': client.stats.snapshot()
+    })
+
 # ヘルパー関数: メール送信
 def send_verification_email(email, token, host_url):
-    """認証メールを送信"""
+    """認証メールを送信キューに積む"""
     # APP_BASE_URLが設定されている場合はそれを優先（サブフォルダ運用時用）
     app_base_url = os.environ.get('APP_BASE_URL', '').rstrip('/')
     if not app_base_url:
         app_base_url = host_url.rstrip('/')
     verification_url = f"{app_base_url}/verify-email?token={token}"
     
-    msg = Message(
+    return enqueue_mail(
+        'verification',
         subject="【Notest】メールアドレスの確認",
         recipients=[email],
         body=f"""
@@ -1108,10 +2633,19 @@ Notestへようこそ！
 </html>
         """
     )
-    
-    mail.send(msg)
 
 # 1. メールアドレス送信（仮登録）
+# パスワードのハッシュ計算はリクエストのスレッドではなく上限付きのプールで行う (passwords.py)
+password_hasher = passwords.PasswordHasher(
+    rounds=app.config['BCRYPT_ROUNDS'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+    use_processes=app.config['PASSWORD_HASH_POOL'] == 'process'
+)
+
+def password_hasher_busy_response():
+    return jsonify({'error': 'ただいま混み合っています。しばらくしてからもう一度お試しください'}), 503, {'Retry-After': '5'}
+
 @app.route('/api/auth/request-registration', methods=['POST'])
 def request_registration():
     """メールアドレスを受け取り、認証メールを送信"""
@@ -1151,14 +2685,14 @@ def request_registration():
             expires_at=expires_at
         )
         db.session.add(verification_token)
-        db.session.commit()
         
-        # メール送信
-        send_verification_email(email, token, request.host_url)
+        # メールを送信キューに積む (トークンと同じトランザクションでコミットされる)
+        mail = send_verification_email(email, token, request.host_url)
         
         return jsonify({
             'message': '確認メールを送信しました。メールをご確認ください。',
-            'email': email
+            'email': email,
+            'mail_id': mail.id
         }), 200
         
     except Exception as e:
@@ -1233,7 +2767,7 @@ def register():
             return jsonify({'error': 'このメールアドレスは既に登録されています'}), 400
         
         # パスワードをハッシュ化
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        password_hash = password_hasher.hash(password)
         
         # メールアドレスからユーザー名を自動生成
         username = verification.email.split('@')[0]
@@ -1261,6 +2795,9 @@ def register():
             }
         }), 201
         
+    except passwords.PasswordHasherBusy:
+        db.session.rollback()
+        return password_hasher_busy_response()
     except Exception as e:
         db.session.rollback()
         print(f"Registration error: {e}")
@@ -1270,6 +2807,105 @@ def register():
 
 # ==================== Stripe & サブスクリプション API ====================
 
+# ==================== サブスクリプション状態のキャッシュ (デスクトップ版) ====================
+# デスクトップ版の /api/user/status はリモートの状態を返すが、起動時の表示を待たせないよう
+# 取得した状態をユーザーごとに保持し、USER_STATUS_CACHE_TTL を過ぎたものは返しつつ裏で取り直す。
+# ロック中の状態だけは、支払い直後の解除をすぐ反映できるよう毎回リモートに問い合わせる。
+
+_user_status_cache = {}  # user_id -> (取得時刻 (time.monotonic), リモートの応答)
+_user_status_refreshing = set()
+_user_status_lock = threading.Lock()
+
+def forget_user_status(user_id):
+    with _user_status_lock:
+        _user_status_cache.pop(user_id, None)
+
+def apply_remote_status(user, remote_data):
+    """リモートの状態をローカルのユーザーに反映する (変わった項目がある場合だけコミットする)"""
+    values = {
+        'subscription_status': remote_data.get('subscription_status', user.subscription_status),
+        'cancel_at_period_end': remote_data.get('cancel_at_period_end', user.cancel_at_period_end),
+    }
+    for field in ('trial_end', 'current_period_end'):
+        if remote_data.get(field):
+            values[field] = datetime.fromisoformat(remote_data.get(field))
+    changed = False
+    for field, value in values.items():
+        if getattr(user, field) != value:
+            setattr(user, field, value)
+            changed = True
+    if changed:
+        db.session.commit()
+    return changed
+
+def fetch_remote_user_status(user):
+    """リモートから状態を取得し、キャッシュとローカルDBを更新する (取得できなければ None)"""
+    remote_data, status_code = proxy_auth_to_remote('/api/user/status', None, params={'email': user.email})
+    if status_code != 200:
+        return None
+    with _user_status_lock:
+        _user_status_cache[user.id] = (time.monotonic(), remote_data)
+    apply_remote_status(user, remote_data)
+    return remote_data
+
+def _refresh_user_status(user_id):
+    try:
+        with app.app_context():
+            user = db.session.get(User, user_id)
+            if user is not None:
+                fetch_remote_user_status(user)
+    except Exception as e:
+        print(f"Proxy status refresh error: {e}")
+    finally:
+        with _user_status_lock:
+            _user_status_refreshing.discard(user_id)
+
+def refresh_user_status_in_background(user_id):
+    """リモートの状態を別スレッドで取り直す (同じユーザーの取得が進行中なら何もしない)"""
+    with _user_status_lock:
+        if user_id in _user_status_refreshing:
+            return
+        _user_status_refreshing.add(user_id)
+    threading.Thread(target=_refresh_user_status, args=(user_id,), name='user-status-refresh', daemon=True).start()
+
+def remote_status_payload(user, remote_data):
+    """リモートの応答に、リモートのIDを付けた payment_link を添えて返す"""
+    payload = dict(remote_data)
+    payment_link = payload.get('payment_link', '')
+    if not payment_link:
+        payment_link = app.config.get('STRIPE_PAYMENT_LINK', '')
+
+    if payment_link and user.remote_user_id:
+        # IDが既に付いている可能性もあるのでクエリパラメータを調整
+        if '?' in payment_link:
+            payment_link += f"&client_reference_id={user.remote_user_id}"
+        else:
+            payment_link += f"?client_reference_id={user.remote_user_id}"
+    payload['payment_link'] = payment_link
+    return payload
+
+def local_status_payload(user):
+    """ローカルDBの状態から応答を作る (Web版、またはデスクトップ版でリモートに問い合わせない場合)"""
+    now = datetime.utcnow()
+    trial_days_left = 0
+    if user.trial_end and user.trial_end > now:
+        trial_days_left = (user.trial_end - now).days
+    
+    is_locked = False
+    if user.subscription_status != 'active':
+        if not user.trial_end or user.trial_end < now:
+            is_locked = True
+            
+    return {
+        'subscription_status': user.subscription_status,
+        'trial_end': user.trial_end.isoformat() if user.trial_end else None,
+        'trial_days_left': trial_days_left,
+        'current_period_end': user.current_period_end.isoformat() if user.current_period_end else None,
+        'cancel_at_period_end': user.cancel_at_period_end,
+        'is_locked': is_locked,
+        'payment_link': app.config.get('STRIPE_PAYMENT_LINK', '') + (f'?client_reference_id={user.remote_user_id or user.id}' if '?' not in app.config.get('STRIPE_PAYMENT_LINK', '') else f'&client_reference_id={user.remote_user_id or user.id}')
+    }
+
 @app.route('/api/user/status', methods=['GET'])
 def user_status():
     # 内部プロキシ用：SECRET_KEYによるメールアドレス指定での取得
@@ -1286,57 +2922,33 @@ def user_status():
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    # デスクトップアプリの場合はリモートサーバーから最新状態を取得する
+    # デスクトップアプリの場合はリモートサーバーの状態を返す
     if is_desktop_app():
         try:
-            # プロキシ経由でリモートのステータスを取得 (Emailで指定)
-            remote_data, status_code = proxy_auth_to_remote('/api/user/status', None, params={'email': user.email})
-            if status_code == 200:
-                # ローカルDBを更新
-                user.subscription_status = remote_data.get('subscription_status', user.subscription_status)
-                if remote_data.get('trial_end'):
-                    user.trial_end = datetime.fromisoformat(remote_data.get('trial_end'))
-                if remote_data.get('current_period_end'):
-                    user.current_period_end = datetime.fromisoformat(remote_data.get('current_period_end'))
-                user.cancel_at_period_end = remote_data.get('cancel_at_period_end', user.cancel_at_period_end)
-                db.session.commit()
-                
-                # リモートの payment_link にリモートのIDを付与して返す
-                payment_link = remote_data.get('payment_link', '')
-                if not payment_link:
-                    payment_link = app.config.get('STRIPE_PAYMENT_LINK', '')
-
-                if payment_link and user.remote_user_id:
-                    # IDが既に付いている可能性もあるのでクエリパラメータを調整
-                    if '?' in payment_link:
-                        payment_link += f"&client_reference_id={user.remote_user_id}"
-                    else:
-                        payment_link += f"?client_reference_id={user.remote_user_id}"
-                remote_data['payment_link'] = payment_link
-                return jsonify(remote_data)
+            with _user_status_lock:
+                cached = _user_status_cache.get(user.id)
+            if cached is not None and not cached[1].get('is_locked'):
+                # 古くなっていてもすぐに返し、裏で取り直す
+                if time.monotonic() - cached[0] >= app.config['USER_STATUS_CACHE_TTL']:
+                    refresh_user_status_in_background(user.id)
+                return jsonify(remote_status_payload(user, cached[1]))
+
+            if cached is None:
+                local_payload = local_status_payload(user)
+                if not local_payload['is_locked']:
+                    # 起動直後: 前回同期したローカルDBの状態ですぐに答え、裏でリモートに問い合わせる
+                    refresh_user_status_in_background(user.id)
+                    return jsonify(local_payload)
+
+            # ロック中はリモートに問い合わせてから答える
+            remote_data = fetch_remote_user_status(user)
+            if remote_data is not None:
+                return jsonify(remote_status_payload(user, remote_data))
         except Exception as e:
             print(f"Proxy status error: {e}")
 
     # 以下、Web版またはプロキシ失敗時のフォールバック
-    now = datetime.utcnow()
-    trial_days_left = 0
-    if user.trial_end and user.trial_end > now:
-        trial_days_left = (user.trial_end - now).days
-    
-    is_locked = False
-    if user.subscription_status != 'active':
-        if not user.trial_end or user.trial_end < now:
-            is_locked = True
-            
-    return jsonify({
-        'subscription_status': user.subscription_status,
-        'trial_end': user.trial_end.isoformat() if user.trial_end else None,
-        'trial_days_left': trial_days_left,
-        'current_period_end': user.current_period_end.isoformat() if user.current_period_end else None,
-        'cancel_at_period_end': user.cancel_at_period_end,
-        'is_locked': is_locked,
-        'payment_link': app.config.get('STRIPE_PAYMENT_LINK', '') + (f'?client_reference_id={user.remote_user_id or user.id}' if '?' not in app.config.get('STRIPE_PAYMENT_LINK', '') else f'&client_reference_id={user.remote_user_id or user.id}')
-    })
+    return jsonify(local_status_payload(user))
 
 @app.route('/api/user/cancel-subscription', methods=['POST'])
 @login_required
@@ -1346,6 +2958,7 @@ def cancel_subscription():
         return jsonify({'error': 'サブスクリプションが見つかりません'}), 400
         
     try:
+        stripe = get_stripe()
         stripe.Subscription.modify(
             user.stripe_subscription_id,
             cancel_at_period_end=True
@@ -1356,10 +2969,61 @@ def cancel_subscription():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ==================== Stripe Webhook ====================
+# 受信したイベントは台帳 (stripe_events) に記録してすぐに応答し、反映は webhooks.EventApplier が裏で行う。
+# ハンドラーは同じイベントを何度反映しても結果が変わらないように書くこと (再送・リプレイがあるため)。
+
+def stripe_event_user(event, user):
+    """反映済みのものより古いイベントなら EventSkipped、そうでなければ反映済みの時刻を進める"""
+    if user is None:
+        raise webhooks.EventSkipped('User not found')
+    if user.stripe_event_created and event['created'] < user.stripe_event_created:
+        raise webhooks.EventSkipped('Older than the last applied event')
+    user.stripe_event_created = event['created']
+    return user
+
+def apply_checkout_completed(event):
+    session = event['data']['object']
+    user_id = session.get('client_reference_id')
+    if not user_id:
+        raise webhooks.EventSkipped('No client_reference_id')
+    user = stripe_event_user(event, db.session.get(User, int(user_id)))
+    user.stripe_customer_id = session.get('customer')
+    user.stripe_subscription_id = session.get('subscription')
+    user.subscription_status = 'active'
+
+def apply_subscription_updated(event):
+    subscription = event['data']['object']
+    user = User.query.filter_by(stripe_customer_id=subscription.get('customer')).first()
+    user = stripe_event_user(event, user)
+    user.subscription_status = subscription.get('status')
+    user.current_period_end = datetime.utcfromtimestamp(subscription.get('current_period_end'))
+    user.cancel_at_period_end = subscription.get('cancel_at_period_end', False)
+
+def apply_subscription_deleted(event):
+    subscription = event['data']['object']
+    user = User.query.filter_by(stripe_customer_id=subscription.get('customer')).first()
+    user = stripe_event_user(event, user)
+    user.subscription_status = 'canceled'
+    user.cancel_at_period_end = True
+
+STRIPE_EVENT_HANDLERS = {
+    'checkout.session.completed': apply_checkout_completed,
+    'customer.subscription.updated': apply_subscription_updated,
+    'customer.subscription.deleted': apply_subscription_deleted,
+}
+
+stripe_event_applier = webhooks.EventApplier(
+    app, db.session, STRIPE_EVENT_HANDLERS,
+    batch_size=app.config['STRIPE_EVENT_BATCH_SIZE'],
+    max_attempts=app.config['STRIPE_EVENT_MAX_ATTEMPTS']
+)
+
 @app.route('/webhook/stripe', methods=['POST'])
 def stripe_webhook():
     payload = request.data
     sig_header = request.headers.get('Stripe-Signature')
+    stripe = get_stripe()
 
     try:
         event = stripe.Webhook.construct_event(
@@ -1370,36 +3034,24 @@ def stripe_webhook():
     except stripe.error.SignatureVerificationError as e:
         return 'Invalid signature', 400
 
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        
-        user_id = session.get('client_reference_id')
-        if user_id:
-            user = User.query.get(int(user_id))
-            if user:
-                user.stripe_customer_id = session.get('customer')
-                user.stripe_subscription_id = session.get('subscription')
-                user.subscription_status = 'active'
-                db.session.commit()
-                
-    elif event['type'] == 'customer.subscription.updated':
-        subscription = event['data']['object']
-        customer_id = subscription.get('customer')
-        user = User.query.filter_by(stripe_customer_id=customer_id).first()
-        if user:
-            user.subscription_status = subscription.get('status')
-            user.current_period_end = datetime.utcfromtimestamp(subscription.get('current_period_end'))
-            user.cancel_at_period_end = subscription.get('cancel_at_period_end', False)
-            db.session.commit()
-            
-    elif event['type'] == 'customer.subscription.deleted':
-        subscription = event['data']['object']
-        customer_id = subscription.get('customer')
-        user = User.query.filter_by(stripe_customer_id=customer_id).first()
-        if user:
-            user.subscription_status = 'canceled'
-            user.cancel_at_period_end = True
+    # 台帳に記録してすぐに応答する (同じイベントIDの再送は記録済みなので何もしない)
+    # 検証済みの本文をそのまま保存し、ハンドラーには JSON を読み直した dict を渡す
+    event_data = json.loads(payload)
+    if db.session.get(StripeEvent, event.id) is None:
+        db.session.add(StripeEvent(
+            id=event.id,
+            type=event.type,
+            customer_id=webhooks.event_customer_id(event_data),
+            created=event.created,
+            payload=payload.decode('utf-8'),
+            status=webhooks.EVENT_PENDING if event.type in STRIPE_EVENT_HANDLERS else webhooks.EVENT_SKIPPED
+        ))
+        try:
             db.session.commit()
+        except IntegrityError:
+            # 同時に届いた再送
+            db.session.rollback()
+    stripe_event_applier.wake()
 
     return jsonify(success=True)
 
@@ -1423,9 +3075,10 @@ def login():
             if status_code == 200:
                 user = User.query.filter_by(email=email).first()
                 if not user:
+                    # 認証はリモートで行うので、ローカルには照合できない値を入れておく (bcrypt の計算は不要)
                     user = User(email=email, 
                                 username=email.split('@')[0],
-                                password_hash=bcrypt.hashpw(secrets.token_bytes(16), bcrypt.gensalt()).decode('utf-8'))
+                                password_hash=passwords.unusable_password_hash())
                     db.session.add(user)
                 # サブスクリプション状態やリモートIDを同期
                 remote_user = remote_data.get('user', {})
@@ -1437,6 +3090,8 @@ def login():
                     user.current_period_end = datetime.fromisoformat(remote_user.get('current_period_end'))
                 user.cancel_at_period_end = remote_user.get('cancel_at_period_end', False)
                 db.session.commit()
+                # 同期したばかりなので、古いキャッシュではなくローカルDBの状態から答えさせる
+                forget_user_status(user.id)
                 
                 login_user(user, remember=remember)
                 return jsonify({'success': True, 'user': {'email': user.email}})
@@ -1450,12 +3105,17 @@ def login():
             return jsonify({'error': 'メールアドレスまたはパスワードが正しくありません'}), 401
         
         # パスワード検証
-        if not bcrypt.checkpw(password.encode('utf-8'), user.password_hash.encode('utf-8')):
+        if not password_hasher.verify(password, user.password_hash):
             return jsonify({'error': 'メールアドレスまたはパスワードが正しくありません'}), 401
         
         if not user.is_active:
             return jsonify({'error': 'このアカウントは無効化されています'}), 403
         
+        # コストの設定が変わっていれば、平文が手元にある今のうちに作り直す
+        if password_hasher.needs_rehash(user.password_hash):
+            user.password_hash = password_hasher.hash(password)
+            db.session.commit()
+        
         # ログイン
         login_user(user, remember=remember)
         
@@ -1472,6 +3132,9 @@ def login():
             }
         }), 200
         
+    except passwords.PasswordHasherBusy:
+        db.session.rollback()
+        return password_hasher_busy_response()
     except Exception as e:
         print(f"Login error: {e}")
         return jsonify({'error': 'ログインに失敗しました'}), 500
@@ -1510,13 +3173,10 @@ def forgot_password():
             expires_at=expires_at
         )
         db.session.add(reset_token)
-        db.session.commit()
         
-        # メール送信
+        # メールを送信キューに積む (トークンと同じトランザクションでコミットされる)
         reset_link = url_for('reset_password_view', token=token, _external=True)
-        msg = Message("【WowNote】パスワードの再設定",
-                    recipients=[email])
-        msg.body = f"""WowNoteをご利用いただきありがとうございます。
+        body = f"""WowNoteをご利用いただきありがとうございます。
 
 パスワードの再設定リクエストを受け付けました。
 以下のリンクから新しいパスワードを設定してください。
@@ -1526,7 +3186,7 @@ def forgot_password():
 
 ※このメールに心当たりがない場合は、破棄してください。
 """
-        mail.send(msg)
+        enqueue_mail('password_reset', "【WowNote】パスワードの再設定", [email], body=body)
         
         return jsonify({'message': 'ご入力いただいたアドレス宛に再設定用リンクを送信しました'}), 200
         
@@ -1546,11 +3206,10 @@ def test_mail():
         if not email:
             return jsonify({'error': 'emailパラメータが必要です'}), 400
             
-        msg = Message("【WowNote】メール設定テスト",
-                    recipients=[email])
-        msg.body = "これはWowNoteのメール送付テストです。このメールが届いた場合、サーバーのメール設定は正常です。"
-        mail.send(msg)
-        return jsonify({'message': f'{email} 宛にテストメールを送信しました。'}), 200
+        # 送信結果は GET /api/mail/outbox/<id> で確認する
+        mail = enqueue_mail('test', "【WowNote】メール設定テスト", [email],
+                            body="これはWowNoteのメール送付テストです。このメールが届いた場合、サーバーのメール設定は正常です。")
+        return jsonify({'message': f'{email} 宛のテストメールを送信キューに追加しました。', 'mail': mail.to_dict()}), 202
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1580,12 +3239,14 @@ def reset_password():
             return jsonify({'error': 'ユーザーが見つかりません'}), 404
             
         # パスワード更新
-        user.password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        user.password_hash = password_hasher.hash(new_password)
         reset_token.used = True
         db.session.commit()
         
         return jsonify({'message': 'パスワードを再設定しました'}), 200
         
+    except passwords.PasswordHasherBusy:
+        return password_hasher_busy_response()
     except Exception as e:
         print(f"Reset password error: {e}")
         return jsonify({'error': '再設定に失敗しました'}), 500
@@ -1627,7 +3288,7 @@ def update_current_user():
         if not current_password:
             return jsonify({'error': '現在のパスワードを入力してください'}), 400
         
-        if not bcrypt.checkpw(current_password.encode('utf-8'), current_user.password_hash.encode('utf-8')):
+        if not password_hasher.verify(current_password, current_user.password_hash):
             return jsonify({'error': '現在のパスワードが正しくありません'}), 401
         
         # ユーザー名更新
@@ -1639,8 +3300,7 @@ def update_current_user():
             if len(new_password) < 8:
                 return jsonify({'error': '新しいパスワードは8文字以上で入力してください'}), 400
             
-            password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            current_user.password_hash = password_hash
+            current_user.password_hash = password_hasher.hash(new_password)
         
         current_user.updated_at = datetime.utcnow()
         db.session.commit()
@@ -1654,6 +3314,9 @@ def update_current_user():
             }
         }), 200
         
+    except passwords.PasswordHasherBusy:
+        db.session.rollback()
+        return password_hasher_busy_response()
     except Exception as e:
         db.session.rollback()
         print(f"Update user error: {e}")
@@ -1661,46 +3324,15 @@ def update_current_user():
 
 
 def init_db():
-    """データベースとテーブルの作成および付随するマイグレーション"""
+    """データベースのスキーマを最新の状態にする
+
+    schema_version が最新なら1行読むだけで終わる。
+    マイグレーションの定義は migrations.py を参照。
+    """
+    from migrations import run_migrations
     with app.app_context():
-        db.create_all()
-        
-        # 既存テーブルへのカラム追加 (MySQLおよびSQLite両対応)
-        # SQLAlchemy + text("ALTER TABLE ...") はカラムが存在するとエラーになるので try-except で囲む
-        def add_column_safely(table, column, definition):
-            try:
-                from sqlalchemy import text
-                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
-                db.session.commit()
-                print(f"[INIT_DB] OK: Added '{column}' to '{table}'.")
-            except Exception as e:
-                db.session.rollback()
-                # 既に存在する場合はエラーになるが、その他のエラーも把握したい
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass # すでに存在する
-                else:
-                    print(f"[INIT_DB] ERROR adding '{column}' to '{table}': {str(e)}")
-
-        print("[INIT_DB] Running schema migrations...")
-        # User テーブル
-        add_column_safely('users', 'remote_user_id', 'INTEGER NULL')
-        add_column_safely('users', 'stripe_customer_id', 'VARCHAR(255) NULL')
-        add_column_safely('users', 'stripe_subscription_id', 'VARCHAR(255) NULL')
-        add_column_safely('users', 'subscription_status', "VARCHAR(50) DEFAULT 'trialing'")
-        add_column_safely('users', 'trial_end', 'DATETIME NULL')
-        add_column_safely('users', 'current_period_end', 'DATETIME NULL')
-        add_column_safely('users', 'cancel_at_period_end', 'BOOLEAN DEFAULT FALSE')
-
-        # Section テーブル (初期版から追加されたカラム)
-        add_column_safely('sections', 'memo', 'TEXT NULL')
-        add_column_safely('sections', 'width', 'INTEGER DEFAULT 300')
-        add_column_safely('sections', 'height', 'INTEGER DEFAULT 200')
-        add_column_safely('sections', 'position_x', 'INTEGER DEFAULT 0')
-        add_column_safely('sections', 'position_y', 'INTEGER DEFAULT 0')
-        
-        # 確実にDBを最新の状態に保つため、セッションををクリアして次回アクセスで反映させる
-        db.session.remove()
-        print("[INIT_DB] Schema synchronization completed.")
+        version = run_migrations(db.engine, db.metadata)
+        print(f"[INIT_DB] Schema version: {version}")
 
 # 初回起動時やインポート時にテーブル作成を確実に行う
 # init_db() # Moved to desktop_app.py or explicit call
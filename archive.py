@@ -0,0 +1,314 @@
+"""
+ZIPアーカイブの展開
+各メンバーを固定サイズのバッファで読み書きし、互いに独立したメンバーはスレッドプールで並列に展開します。
+展開の前にセントラルディレクトリだけを見て、合計サイズ・エントリ数・圧縮率の上限と
+展開先からはみ出すパスを検査し、展開中もヘッダーの申告サイズを超えて書き込まないようにします。
+"""
+import os
+import shutil
+import threading
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+
+# 上限 (max_total_size: 展開後の合計バイト数, max_entries: エントリ数, max_ratio: 展開後/圧縮後 の比)
+ExtractLimits = namedtuple('ExtractLimits', ['max_total_size', 'max_entries', 'max_ratio'])
+
+# 小さいメンバーは圧縮率が極端になりやすいので、このサイズ未満は圧縮率を見ない
+RATIO_CHECK_MIN_SIZE = 1024 * 1024
+
+
+class ArchiveError(ValueError):
+    """アーカイブが壊れている、または上限・安全性の検査に通らない"""
+
+
+def _unsafe_name(name):
+    normalized = name.replace('\\', '/')
+    if normalized.startswith('/') or (len(normalized) > 1 and normalized[1] == ':'):
+        return True
+    return any(part == '..' for part in normalized.split('/'))
+
+
+def _parent_directories(path, root):
+    """root より下にある path の親ディレクトリをすべて返す"""
+    parents = []
+    path = os.path.dirname(path)
+    while path != root and path.startswith(root + os.sep):
+        parents.append(path)
+        path = os.path.dirname(path)
+    return parents
+
+
+def plan_extraction(zf, dest_root, limits):
+    """展開するメンバーと書き込み先を決め、(ディレクトリ一覧, [(メンバー, 書き込み先)], 合計バイト数) を返す
+
+    同じ名前のメンバーが複数あれば (ZIP としては正しい)、順に展開した場合と同じく最後のものだけを展開する。
+    並列に展開するので、同じファイルに2つのスレッドが書き込むことはない。
+    あるメンバーのファイルのパスが別のメンバーのディレクトリとして使われている場合は展開しない。
+    """
+    members = zf.infolist()
+    if len(members) > limits.max_entries:
+        raise ArchiveError(f'Too many entries in ZIP: {len(members)} (limit {limits.max_entries})')
+
+    dest_root = os.path.realpath(dest_root)
+    directories = set()
+    # 書き込み先 (大文字・小文字を区別しないファイルシステムでは正規化したもの) → (メンバー, 書き込み先)
+    files = {}
+    for member in members:
+        if _unsafe_name(member.filename):
+            raise ArchiveError(f'Unsafe path in ZIP: {member.filename}')
+        target = os.path.realpath(os.path.join(dest_root, member.filename))
+        if target != dest_root and not target.startswith(dest_root + os.sep):
+            raise ArchiveError(f'Unsafe path in ZIP: {member.filename}')
+        if member.flag_bits & 0x1:
+            raise ArchiveError(f'Encrypted ZIP entries are not supported: {member.filename}')
+
+        if member.is_dir():
+            directories.add(target)
+            continue
+        if member.file_size >= RATIO_CHECK_MIN_SIZE and member.file_size > member.compress_size * limits.max_ratio:
+            raise ArchiveError(f'Suspicious compression ratio: {member.filename}')
+        directories.add(os.path.dirname(target))
+        files[os.path.normcase(target)] = (member, target)
+
+    file_keys = set(files)
+    for directory in set(directories):
+        for path in [directory] + _parent_directories(directory, dest_root):
+            directories.add(path)
+            if os.path.normcase(path) in file_keys:
+                raise ArchiveError(f'ZIP uses a path as both a file and a folder: '
+                                   f'{os.path.relpath(path, dest_root)}')
+
+    files = list(files.values())
+    total_size = sum(member.file_size for member, _ in files)
+    total_compressed = sum(member.compress_size for member, _ in files)
+    if total_size > limits.max_total_size:
+        raise ArchiveError(f'ZIP expands to {total_size} bytes (limit {limits.max_total_size})')
+    if total_size >= RATIO_CHECK_MIN_SIZE and total_size > max(total_compressed, 1) * limits.max_ratio:
+        raise ArchiveError('Suspicious compression ratio for the whole archive')
+    return sorted(directories), files, total_size
+
+
+def inspect_zip(zip_path, dest_root, limits):
+    """展開せずに検査だけ行う (リクエストの中ですぐにエラーを返すため)"""
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            return plan_extraction(zf, dest_root, limits)
+    except zipfile.BadZipFile as e:
+        raise ArchiveError(f'Invalid ZIP file: {e}')
+
+
+def unique_folder_name(parent, name):
+    """parent の中で使われていないフォルダ名を返す (name, name_1, name_2, ...)"""
+    candidate = name
+    counter = 1
+    while os.path.lexists(os.path.join(parent, candidate)):
+        candidate = f"{name}_{counter}"
+        counter += 1
+    return candidate
+
+
+class _ExtractState:
+    """展開中のスレッド間で共有する状態"""
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.local = threading.local()
+        self.handles = []        # スレッドごとに開いた ZipFile (最後にまとめて閉じる)
+        self.written_files = []  # 書き込みを始めたファイル (失敗時に削除する)
+
+
+def _extract_member(zip_path, member, target, progress, state):
+    """1メンバーを展開する (ZipFile はスレッドごとに開いたものを使う)"""
+    if state.stop.is_set():
+        return
+    zf = getattr(state.local, 'zf', None)
+    if zf is None:
+        zf = state.local.zf = zipfile.ZipFile(zip_path, 'r')
+        state.handles.append(zf)
+
+    state.written_files.append(target)
+    written = 0
+    with zf.open(member) as fsrc, open(target, 'wb') as fdst:
+        while True:
+            if state.stop.is_set():
+                return
+            chunk = fsrc.read(EXTRACT_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            # ヘッダーの申告より大きく展開されるデータは打ち切る
+            if written > member.file_size:
+                raise ArchiveError(f'Entry is larger than declared: {member.filename}')
+            fdst.write(chunk)
+            progress.add(bytes_done=len(chunk))
+    progress.add(files_done=1)
+
+
+def extract_zip(progress, zip_path, dest, limits, subfolder=None, workers=4):
+    """ZIPを展開し、結果 (展開先フォルダ名, ファイル数) を返す
+
+    subfolder を指定した場合は dest の中に新しいフォルダを作ってその中に展開する。
+    失敗・キャンセル時は、新しく作ったフォルダ (またはこのジョブで書いたファイル) を削除する。
+    """
+    created_root = None
+    if subfolder:
+        subfolder = unique_folder_name(dest, subfolder)
+        created_root = os.path.join(dest, subfolder)
+        os.makedirs(created_root)
+        dest = created_root
+        progress.set_cleanup_path(created_root)
+
+    state = _ExtractState()
+    try:
+        try:
+            with zipfile.ZipFile(zip_path, 'r') as zf:
+                directories, files, total_size = plan_extraction(zf, dest, limits)
+        except zipfile.BadZipFile as e:
+            raise ArchiveError(f'Invalid ZIP file: {e}')
+
+        free = shutil.disk_usage(dest).free
+        if total_size > free:
+            raise ArchiveError(f'Not enough disk space: {total_size} bytes needed, {free} bytes free')
+
+        progress.set_totals(total_size, len(files))
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+
+        # 大きいメンバーから始めて、スレッド間の偏りを減らす
+        files.sort(key=lambda item: -item[0].file_size)
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='unzip') as executor:
+            futures = [executor.submit(_extract_member, zip_path, member, target, progress, state)
+                       for member, target in files]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = next((f for f in done if f.exception() is not None), None)
+            if failed is not None:
+                # 他のメンバーの展開も止めてから例外を伝える
+                state.stop.set()
+                for future in futures:
+                    future.cancel()
+                raise failed.exception()
+    except BaseException:
+        state.stop.set()
+        if created_root:
+            shutil.rmtree(created_root, ignore_errors=True)
+        else:
+            for target in state.written_files:
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+        raise
+    finally:
+        for handle in state.handles:
+            handle.close()
+
+    if created_root:
+        progress.set_cleanup_path(None)
+    return {'folder': subfolder, 'files': len(files)}
+
+
+# ==================== ZIPのストリーミング作成 ====================
+# 一時ファイルを作らず、書き込まれたそばから応答として送り出す。
+# zipfile は tell/seek できない出力にはデータディスクリプタ形式で書くので、
+# バッファに溜まった分を1チャンクごとに取り出せば、アーカイブの大きさに関わらずメモリ使用量は一定になる。
+
+# すでに圧縮されている形式は再圧縮しても小さくならないので、無圧縮 (stored) で格納する
+STORED_EXTENSIONS = frozenset((
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.lz', '.zst',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.jar', '.apk',
+))
+
+
+class _StreamBuffer:
+    """zipfile の出力先 (書き込まれたバイト列を取り出すまで溜めておく)"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_folder_entries(root, skip_suffixes=()):
+    """フォルダ以下の (アーカイブ内の名前, 実パス) を列挙する (フォルダは名前が '/' で終わる)"""
+    root = os.path.abspath(root)
+    for current, dirs, files in os.walk(root):
+        dirs.sort()
+        rel = os.path.relpath(current, root)
+        prefix = '' if rel == '.' else rel.replace(os.sep, '/') + '/'
+        if prefix:
+            yield prefix, current
+        for name in sorted(files):
+            if name.endswith(skip_suffixes):
+                continue
+            yield prefix + name, os.path.join(current, name)
+
+
+def unique_arcnames(entries):
+    """アーカイブ内で名前が重複しないよう "name (1).ext" の形に付け替える"""
+    used = set()
+    for arcname, path in entries:
+        candidate = arcname
+        stem, ext = os.path.splitext(arcname)
+        counter = 1
+        while candidate.lower() in used:
+            candidate = f"{stem} ({counter}){ext}"
+            counter += 1
+        used.add(candidate.lower())
+        yield candidate, path
+
+
+def stream_zip(entries, chunk_size=EXTRACT_CHUNK_SIZE):
+    """(アーカイブ内の名前, 実パス) の列から ZIP を作りながらバイト列を順に返すジェネレータ"""
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as zf:
+        for arcname, path in entries:
+            if arcname.endswith('/'):
+                zf.writestr(zipfile.ZipInfo(arcname), b'')
+                continue
+            try:
+                st = os.stat(path)
+                src = open(path, 'rb')
+            except OSError as e:
+                # 送信を始めた後はエラーを返せないので、読めないファイルは飛ばす
+                print(f"[ZIP] Skipped {path}: {e}")
+                continue
+
+            with src:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                info.file_size = st.st_size
+                if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with zf.open(info, 'w') as dest:
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        data = buffer.take()
+                        if data:
+                            yield data
+            data = buffer.take()
+            if data:
+                yield data
+    # セントラルディレクトリ
+    data = buffer.take()
+    if data:
+        yield data
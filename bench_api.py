@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+ノート API の負荷テスト・ベンチマーク
+一時フォルダにデスクトップ版の SQLite データベースと保存先を作り、合成したノート
+(タブ × ページ × セクション、ストレージフォルダ) を入れてから、主なエンドポイントを
+WSGI アプリに対して複数スレッドで同時に呼び、シナリオごとの p50/p95/p99 と処理件数/秒を表示します。
+乱数の種を固定しているので、同じ引数なら同じデータ・同じ順序のリクエストになります。
+結果は JSON で保存し (既定: run/bench/<コミット>-<日時>.json)、--compare で以前の結果と比べられます。
+本番のデータベースには触れません。
+
+  python bench_api.py                                         # 既定の規模ですべてのシナリオ
+  python bench_api.py --tabs 20 --pages 20 --sections 30 --concurrency 8
+  python bench_api.py --scenario tabs page --requests 2000
+  python bench_api.py --compare run/bench/old.json --max-regression 20   # p95 が 20% 以上悪化したら終了コード 1
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_ROOT)
+
+# app を読み込む前に、データベースと保存先を一時フォルダに向ける
+_data_home = tempfile.mkdtemp(prefix='wownote-bench-')
+os.environ['HOME'] = _data_home
+os.environ['USERPROFILE'] = _data_home
+os.environ['WOWNOTE_DESKTOP'] = 'true'
+# 計測中はサンプリングしたアクセスログを出さない (遅いリクエストとエラーは出る)
+os.environ.setdefault('ACCESS_LOG_SAMPLE_RATE', '0')
+
+import sqlalchemy as sa  # noqa: E402
+
+from app import app, db, init_db, bump_tree_version, Tab, Page, Section  # noqa: E402
+import search  # noqa: E402
+
+SCENARIOS = ('tabs', 'page', 'section_put', 'upload', 'storage_list', 'download')
+
+WORDS = ('note', 'meeting', 'draft', 'todo', 'idea', 'review', 'plan', 'budget', 'memo', 'design',
+         '議事録', '予定', '資料', '確認', '修正', '共有', 'メモ', '課題')
+
+
+def make_text(rng, size):
+    """おおよそ size バイトの文章"""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word.encode('utf-8')) + 1
+    return ' '.join(words)
+
+
+def seed(args, rng):
+    """合成したノートを作り、シナリオで使う ID やファイル名を返す"""
+    storage_root = os.path.join(app.config['STORAGE_BASE_PATH'], 'bench')
+    fixture = {'pages': [], 'text_sections': [], 'storage': []}
+
+    for t in range(args.tabs):
+        tab = Tab(name=f'Tab {t}', order_index=t)
+        db.session.add(tab)
+        db.session.flush()
+        db.session.execute(sa.insert(Page), [
+            {'tab_id': tab.id, 'name': f'Page {t}-{p}', 'order_index': p} for p in range(args.pages)
+        ])
+    db.session.flush()
+    fixture['pages'] = [page_id for (page_id,) in db.session.query(Page.id).order_by(Page.id)]
+
+    rows = []
+    for page_id in fixture['pages']:
+        for s in range(args.sections):
+            # 内容の大きさは指定値の半分〜1.5倍でばらつかせる
+            size = int(args.content_bytes * rng.uniform(0.5, 1.5))
+            rows.append({
+                'page_id': page_id, 'name': f'Section {s}', 'content_type': 'text',
+                'content_data': json.dumps({'text': make_text(rng, size)}, ensure_ascii=False),
+                'order_index': s, 'width': 300, 'height': 200,
+                'position_x': (s % 4) * 320, 'position_y': (s // 4) * 220,
+            })
+            if len(rows) >= 1000:
+                db.session.execute(sa.insert(Section), rows)
+                rows = []
+    if rows:
+        db.session.execute(sa.insert(Section), rows)
+    fixture['text_sections'] = [section_id for (section_id,) in db.session.query(Section.id).order_by(Section.id)]
+
+    for f in range(args.storage_folders):
+        folder = os.path.join(storage_root, f'folder{f}')
+        os.makedirs(folder, exist_ok=True)
+        filenames = []
+        for n in range(args.files_per_folder):
+            filename = f'file{n:05d}.bin'
+            with open(os.path.join(folder, filename), 'wb') as out:
+                out.write(rng.randbytes(args.file_bytes))
+            filenames.append(filename)
+        section = Section(page_id=fixture['pages'][f % len(fixture['pages'])], name=f'Storage {f}',
+                          content_type='storage',
+                          content_data=json.dumps({'storage_type': 'local', 'path': folder}),
+                          order_index=args.sections + f)
+        db.session.add(section)
+        db.session.flush()
+        fixture['storage'].append({'id': section.id, 'files': filenames})
+
+    bump_tree_version()
+    db.session.commit()
+    with db.engine.begin() as conn:
+        search.rebuild_search_index(conn)
+    return fixture
+
+
+def build_requests(scenario, fixture, args, rng):
+    """シナリオのリクエスト (client.open の引数) を args.requests 件作る"""
+    requests = []
+    for i in range(args.requests):
+        if scenario == 'tabs':
+            requests.append({'path': '/api/tabs'})
+        elif scenario == 'page':
+            requests.append({'path': f"/api/pages/{rng.choice(fixture['pages'])}"})
+        elif scenario == 'section_put':
+            size = int(args.content_bytes * rng.uniform(0.5, 1.5))
+            requests.append({
+                'path': f"/api/sections/{rng.choice(fixture['text_sections'])}", 'method': 'PUT',
+                'json': {'content_data': {'text': make_text(rng, size)}}
+            })
+        elif scenario == 'upload':
+            # 毎回違う内容にして、重複排除ではなく書き込みを計る (本文は送る直前に作る)
+            requests.append({
+                'path': '/api/upload', 'method': 'POST', 'content_type': 'multipart/form-data',
+                'upload': (f'upload{i}.bin', rng.getrandbits(64))
+            })
+        elif scenario == 'storage_list':
+            requests.append({'path': f"/api/sections/{rng.choice(fixture['storage'])['id']}/files"})
+        elif scenario == 'download':
+            storage = rng.choice(fixture['storage'])
+            requests.append({'path': f"/api/sections/{storage['id']}/files/{rng.choice(storage['files'])}"})
+    return requests
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def run_scenario(requests, concurrency, warmup, upload_bytes):
+    """リクエストを concurrency スレッドで同時に送り、件数・失敗数・処理件数/秒・パーセンタイルを返す"""
+    local = threading.local()
+
+    def send(kwargs):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        if 'upload' in kwargs:
+            kwargs = dict(kwargs)
+            filename, body_seed = kwargs.pop('upload')
+            body = random.Random(body_seed).randbytes(upload_bytes)
+            kwargs['data'] = {'file': (io.BytesIO(body), filename)}
+        start = time.perf_counter()
+        response = client.open(**kwargs)
+        response.get_data()
+        # 応答本文を閉じるまでが1リクエスト
+        response.close()
+        return time.perf_counter() - start, response.status_code
+
+    for kwargs in requests[:warmup]:
+        send(kwargs)
+    measured = requests[warmup:]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, measured))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(elapsed for elapsed, _ in results)
+    errors = sum(1 for _, status in results if status >= 400)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'throughput_rps': round(len(results) / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_path, max_regression):
+    """以前の結果と比べて表示し、p95 が max_regression % を超えて悪化したシナリオの数を返す"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} (commit {baseline.get('commit', '?')})")
+    changed = sorted(key for key, value in results['params'].items()
+                     if key != 'scenario' and baseline.get('params', {}).get(key) != value)
+    if changed:
+        print(f"  warning: parameters differ ({', '.join(changed)}); the numbers are not directly comparable")
+    regressions = 0
+    for name, current in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        change = (current['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0.0
+        rps_change = ((current['throughput_rps'] - before['throughput_rps']) / before['throughput_rps'] * 100
+                      if before['throughput_rps'] else 0.0)
+        regressed = max_regression is not None and change > max_regression
+        regressions += regressed
+        print(f"  {name:<14} p95 {before['p95_ms']:>8.2f} -> {current['p95_ms']:>8.2f} ms ({change:+.1f}%)  "
+              f"rps {rps_change:+.1f}%{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ノート API のベンチマーク')
+    parser.add_argument('--tabs', type=int, default=5, help='タブ数')
+    parser.add_argument('--pages', type=int, default=10, help='タブあたりのページ数')
+    parser.add_argument('--sections', type=int, default=20, help='ページあたりのテキストセクション数')
+    parser.add_argument('--content-bytes', type=int, default=2000, help='テキストセクションの内容のおおよその大きさ')
+    parser.add_argument('--storage-folders', type=int, default=2, help='ストレージフォルダの数')
+    parser.add_argument('--files-per-folder', type=int, default=500, help='ストレージフォルダあたりのファイル数')
+    parser.add_argument('--file-bytes', type=int, default=64 * 1024, help='ストレージのファイルの大きさ')
+    parser.add_argument('--upload-bytes', type=int, default=256 * 1024, help='upload シナリオで送るファイルの大きさ')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS), help='実行するシナリオ')
+    parser.add_argument('--requests', type=int, default=500, help='シナリオあたりのリクエスト数 (ウォームアップを含む)')
+    parser.add_argument('--warmup', type=int, default=20, help='計測に含めない最初のリクエスト数')
+    parser.add_argument('--concurrency', type=int, default=4, help='同時に送るスレッド数')
+    parser.add_argument('--seed', type=int, default=1, help='乱数の種')
+    parser.add_argument('--output', help='結果の JSON の保存先 (既定: run/bench/<コミット>-<日時>.json)')
+    parser.add_argument('--compare', help='比較する以前の結果の JSON')
+    parser.add_argument('--max-regression', type=float, help='--compare で p95 の悪化をこの %% まで許す')
+    args = parser.parse_args()
+    if args.warmup >= args.requests:
+        parser.error('--warmup は --requests より小さくしてください')
+
+    rng = random.Random(args.seed)
+    init_db()
+    with app.app_context():
+        start = time.perf_counter()
+        fixture = seed(args, rng)
+        print(f"Seeded {len(fixture['pages'])} pages, {len(fixture['text_sections'])} text sections, "
+              f"{args.storage_folders} x {args.files_per_folder} storage files in {time.perf_counter() - start:.1f}s")
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'database': 'sqlite',
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'scenarios': {},
+    }
+    print(f"{'scenario':<14} {'reqs':>6} {'err':>4} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for scenario in args.scenario:
+        requests = build_requests(scenario, fixture, args, rng)
+        stats = run_scenario(requests, args.concurrency, args.warmup, args.upload_bytes)
+        results['scenarios'][scenario] = stats
+        print(f"{scenario:<14} {stats['requests']:>6} {stats['errors']:>4} {stats['throughput_rps']:>8.1f} "
+              f"{stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f} {stats['max_ms']:>8.2f}")
+
+    output = args.output or os.path.join(
+        APP_ROOT, 'run', 'bench', f"{commit}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Saved {output}")
+
+    failed = sum(stats['errors'] > 0 for stats in results['scenarios'].values())
+    if args.compare:
+        failed += compare(results, args.compare, args.max_regression)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+パスワードハッシュ (bcrypt) のベンチマーク
+コストごとに1コアあたりの処理速度と、PasswordHasher のプール経由で並列に実行したときの速度を表示します。
+BCRYPT_ROUNDS を決めるときや、PASSWORD_HASH_WORKERS の効果を確かめるときに使います。
+
+  python bench_passwords.py                       # コスト 10〜13 を計測
+  python bench_passwords.py --rounds 12 --workers 4 --pool process
+  python bench_passwords.py --json                # 結果をJSONで出力
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_ROOT)
+
+import passwords  # noqa: E402
+
+
+def bench_single(rounds, seconds):
+    """1スレッドで hash を繰り返し、1秒あたりの回数を返す"""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        passwords._hashpw(b'benchmark-password', rounds)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def bench_pool(rounds, workers, pool, count):
+    """PasswordHasher 経由で count 回を同時に要求し、1秒あたりの回数を返す"""
+    hasher = passwords.PasswordHasher(rounds=rounds, workers=workers, max_pending=count,
+                                      timeout=600, use_processes=(pool == 'process'))
+    # プロセスの起動時間を含めないよう、先に1回実行しておく
+    hasher.hash('warmup')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=count) as clients:
+        list(clients.map(lambda _: hasher.hash('benchmark-password'), range(count)))
+    elapsed = time.perf_counter() - start
+    hasher.shutdown()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bcrypt のハッシュ速度を計測します')
+    parser.add_argument('--rounds', type=int, nargs='+', default=[10, 11, 12, 13], help='計測するコスト')
+    parser.add_argument('--seconds', type=float, default=2.0, help='1コア計測の時間 (秒)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='プールのワーカー数')
+    parser.add_argument('--pool', choices=['process', 'thread'], default='process', help='プールの種類')
+    parser.add_argument('--requests', type=int, default=None, help='プール計測で同時に要求する数 (既定: ワーカー数 * 4)')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    args = parser.parse_args()
+
+    requests_count = args.requests or args.workers * 4
+    results = []
+    for rounds in args.rounds:
+        per_core = bench_single(rounds, args.seconds)
+        pooled = bench_pool(rounds, args.workers, args.pool, requests_count)
+        results.append({
+            'rounds': rounds,
+            'hashes_per_sec_per_core': round(per_core, 2),
+            'ms_per_hash': round(1000 / per_core, 1),
+            'pool': args.pool,
+            'workers': args.workers,
+            'pool_hashes_per_sec': round(pooled, 2),
+            'pool_hashes_per_sec_per_worker': round(pooled / args.workers, 2),
+        })
+
+    if args.json:
+        print(json.dumps({'cpu_count': os.cpu_count(), 'results': results}, indent=2))
+        return 0
+
+    print("=" * 72)
+    print(f"bcrypt ベンチマーク (CPU: {os.cpu_count()}, プール: {args.pool} x {args.workers})")
+    print("=" * 72)
+    print(f"{'コスト':>6} {'1コア(回/秒)':>14} {'1回(ms)':>10} {'プール(回/秒)':>16} {'ワーカーあたり':>14}")
+    for r in results:
+        print(f"{r['rounds']:>6} {r['hashes_per_sec_per_core']:>14.2f} {r['ms_per_hash']:>10.1f} "
+              f"{r['pool_hashes_per_sec']:>16.2f} {r['pool_hashes_per_sec_per_worker']:>14.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
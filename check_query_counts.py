@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+エンドポイントごとの SQL 実行回数のチェック
+一時フォルダにデスクトップ版の SQLite データベースを作り、タブ・ページ・セクションを入れてから
+主なエンドポイントを Flask のテストクライアントで呼び、実行された SQL の回数が上限以内かを確かめます。
+データの量を変えて2回計り、件数に比例して回数が増えるもの (N+1) も失敗にします。
+本番のデータベースには触れません。
+
+  python check_query_counts.py            # 上限を超えたら終了コード 1
+  python check_query_counts.py --verbose  # 実行された文の内訳も表示する
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_ROOT)
+
+# app を読み込む前に、データベースの場所を一時フォルダに向ける
+_data_home = tempfile.mkdtemp(prefix='wownote-querycheck-')
+os.environ['HOME'] = _data_home
+os.environ['USERPROFILE'] = _data_home
+os.environ['WOWNOTE_DESKTOP'] = 'true'
+
+from app import app, db, init_db, bump_tree_version, Tab, Page, Section, User  # noqa: E402
+import querylog  # noqa: E402
+
+# エンドポイントごとの SQL 実行回数の上限
+QUERY_BUDGETS = {
+    'GET /api/tabs (rebuild)': 2,
+    'GET /api/tabs (cached)': 1,
+    'GET /api/pages/<id>': 2,
+    'GET /api/auth/me': 1,
+    'DELETE /api/pages/<id>': 8,
+    'DELETE /api/tabs/<id>': 9,
+}
+
+
+def seed(tabs, pages_per_tab, sections_per_page):
+    """ツリーを作り直し、(タブID, ページID) の一覧を返す"""
+    Section.query.delete()
+    Page.query.delete()
+    Tab.query.delete()
+    db.session.commit()
+    result = []
+    for t in range(tabs):
+        tab = Tab(name=f'tab {t}', order_index=t)
+        db.session.add(tab)
+        db.session.flush()
+        for p in range(pages_per_tab):
+            page = Page(tab_id=tab.id, name=f'page {p}', order_index=p)
+            db.session.add(page)
+            db.session.flush()
+            for s in range(sections_per_page):
+                db.session.add(Section(page_id=page.id, name=f'section {s}', content_type='text',
+                                       content_data='{"text": "hello"}', order_index=s))
+            result.append((tab.id, page.id))
+    bump_tree_version()
+    db.session.commit()
+    return result
+
+
+def measure(client, user_id, size):
+    """size 倍のデータでエンドポイントを呼び、{名前: QueryCounter} を返す"""
+    with app.app_context():
+        ids = seed(tabs=2, pages_per_tab=2 * size, sections_per_page=3 * size)
+    first_tab = ids[0][0]
+    other_page = ids[-1][1]
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    calls = [
+        ('GET /api/tabs (rebuild)', 'GET', '/api/tabs'),
+        ('GET /api/tabs (cached)', 'GET', '/api/tabs'),
+        ('GET /api/pages/<id>', 'GET', f'/api/pages/{other_page}'),
+        ('GET /api/auth/me', 'GET', '/api/auth/me'),
+        ('DELETE /api/pages/<id>', 'DELETE', f'/api/pages/{other_page}'),
+        ('DELETE /api/tabs/<id>', 'DELETE', f'/api/tabs/{first_tab}'),
+    ]
+    counters = {}
+    for name, method, path in calls:
+        with querylog.count_queries() as counter:
+            response = client.open(path, method=method)
+            # 応答本文を閉じるまでが1リクエスト
+            response.close()
+        if response.status_code >= 400:
+            raise RuntimeError(f'{name} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+        counters[name] = counter
+    return counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='エンドポイントごとの SQL 実行回数を確かめます')
+    parser.add_argument('--verbose', action='store_true', help='実行された文の内訳を表示する')
+    args = parser.parse_args()
+
+    init_db()
+    with app.app_context():
+        user = User(email='querycheck@example.com', username='querycheck', password_hash='-')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    small = measure(client, user_id, 1)
+    large = measure(client, user_id, 4)
+
+    failures = 0
+    print(f"{'endpoint':<28} {'budget':>6} {'small':>6} {'large':>6}")
+    for name, budget in QUERY_BUDGETS.items():
+        count_small, count_large = small[name].count, large[name].count
+        problems = []
+        if max(count_small, count_large) > budget:
+            problems.append('over budget')
+        if count_large > count_small:
+            problems.append('grows with data (N+1?)')
+        failures += bool(problems)
+        print(f"{name:<28} {budget:>6} {count_small:>6} {count_large:>6}  {', '.join(problems) or 'ok'}")
+        if args.verbose or problems:
+            print('    ' + large[name].report().replace('\n', '\n    '))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+SQL の実行計画のチェック (SQLite の EXPLAIN QUERY PLAN)
+一時フォルダにデスクトップ版の SQLite データベースを作り、主な API を Flask のテストクライアントで一通り呼んで、
+実行された SELECT / UPDATE / DELETE をすべて記録します。Web 版だけで通る検索 (メール認証・パスワード再設定の
+トークン、Stripe の顧客ID) と、送信キュー・イベント台帳の取り出しも同じデータベースで実行して記録します。
+記録した文ごとに EXPLAIN QUERY PLAN を実行し、インデックスを使わずに表全体を走査するものがあれば失敗にします。
+本番のデータベースには触れません。
+
+  python check_query_plans.py            # 全表走査があれば終了コード 1
+  python check_query_plans.py --verbose  # すべての文の実行計画を表示する
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_ROOT)
+
+# app を読み込む前に、データベースと保存先を一時フォルダに向ける
+_data_home = tempfile.mkdtemp(prefix='wownote-plancheck-')
+os.environ['HOME'] = _data_home
+os.environ['USERPROFILE'] = _data_home
+os.environ['WOWNOTE_DESKTOP'] = 'true'
+
+import sqlalchemy as sa  # noqa: E402
+
+from app import (app, db, init_db, mail_sender, purge_expired_upload_sessions, stripe_event_applier,  # noqa: E402
+                 EmailVerificationToken, PasswordResetToken, User)
+
+# 全表走査を許す表 (すべての行が必要なもの・常に数行しかないもの)
+ALLOWED_SCANS = {
+    'tabs': 'GET /api/tabs のツリーはすべてのタブを返す',
+    'tree_version': '1行だけの表',
+    'schema_version': '1行だけの表',
+}
+
+# "SCAN sections" / "SCAN sections USING INDEX ..." (SQLite 3.36 より前は "SCAN TABLE sections")
+SCAN_PATTERN = re.compile(r'^SCAN (?:TABLE )?(\w+)(.*)$')
+
+
+class StatementRecorder:
+    """実行された文を (文, パラメーター) で重複なく記録する"""
+
+    def __init__(self):
+        self.statements = {}
+        self.sources = {}
+        self.source = None
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            return
+        if statement not in self.statements:
+            # executemany は最初の1組のパラメーターで計画を調べる
+            self.statements[statement] = parameters[0] if executemany else parameters
+            self.sources[statement] = self.source
+
+
+def full_scans(plan_rows):
+    """実行計画の中でインデックスを使わずに走査している表の名前"""
+    tables = []
+    for row in plan_rows:
+        match = SCAN_PATTERN.match(row[-1])
+        if not match:
+            continue
+        table, rest = match.groups()
+        if 'USING' in rest and 'INDEX' in rest or 'VIRTUAL TABLE' in rest:
+            continue
+        tables.append(table)
+    return tables
+
+
+def drive_api(client, recorder, user_id):
+    """主な API を一通り呼ぶ"""
+    def call(method, path, **kwargs):
+        recorder.source = f'{method} {re.sub(r"/[0-9]+", "/<id>", path.split("?")[0])}'
+        response = client.open(path, method=method, **kwargs)
+        body = response.get_json(silent=True)
+        response.close()
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {path} returned {response.status_code}: {body}')
+        return body
+
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    storage_dir = os.path.join(app.config['STORAGE_BASE_PATH'], 'plancheck')
+    os.makedirs(storage_dir, exist_ok=True)
+    with open(os.path.join(storage_dir, 'hello.txt'), 'w') as f:
+        f.write('hello')
+
+    tab = call('POST', '/api/tabs', json={'name': 'Tab'})
+    call('PUT', f"/api/tabs/{tab['id']}", json={'name': 'Tab 2'})
+    page = call('POST', '/api/pages', json={'tab_id': tab['id'], 'name': 'Page'})
+    call('PUT', f"/api/pages/{page['id']}", json={'name': 'Page 2'})
+    call('GET', '/api/tabs')
+
+    text = call('POST', '/api/sections', json={'page_id': page['id'], 'content_type': 'text',
+                                                 'content_data': {'text': 'hello world'}})
+    call('PUT', f"/api/sections/{text['id']}", json={'name': 'Text', 'content_data': {'text': 'hello again'}})
+    call('PATCH', f"/api/sections/{text['id']}/content",
+         json={'field': 'text', 'base_version': 1, 'ops': [{'offset': 0, 'delete': 5, 'insert': 'goodbye'}]})
+    call('POST', '/api/sections/batch', json={'updates': [{'id': text['id'], 'position_x': 10, 'position_y': 20}]})
+    call('GET', f"/api/pages/{page['id']}")
+    call('GET', '/api/search?q=goodbye')
+
+    uploaded = call('POST', '/api/upload', data={'file': (io.BytesIO(b'file body'), 'a.txt')},
+                    content_type='multipart/form-data')
+    file_section = call('POST', '/api/sections', json={'page_id': page['id'], 'content_type': 'file'})
+    call('PUT', f"/api/sections/{file_section['id']}", json={'content_data': uploaded})
+    call('GET', f"/api/files/{file_section['id']}")
+
+    storage = call('POST', '/api/sections', json={'page_id': page['id'], 'content_type': 'storage',
+                                                    'content_data': {'storage_type': 'local', 'path': storage_dir}})
+    call('GET', f"/api/sections/{storage['id']}/files")
+    call('GET', f"/api/sections/{storage['id']}/files/hello.txt")
+    call('POST', '/api/storage-locations', json={'name': 'Local', 'storage_type': 'local', 'path': storage_dir})
+    call('GET', '/api/storage-locations')
+
+    upload = call('POST', '/api/uploads/sessions', json={'filename': 'big.bin', 'size': 10})
+    call('GET', f"/api/uploads/sessions/{upload['upload_id']}")
+    call('DELETE', f"/api/uploads/sessions/{upload['upload_id']}")
+    call('GET', '/api/jobs')
+    call('GET', '/api/jobs?active=1')
+    call('GET', '/api/auth/me')
+
+    call('DELETE', f"/api/sections/{file_section['id']}")
+    call('DELETE', f"/api/pages/{page['id']}")
+    call('DELETE', f"/api/tabs/{tab['id']}")
+
+
+def run_background_queries(recorder):
+    """Web 版の検索と、送信キュー・イベント台帳・期限切れアップロードの取り出しを実行する"""
+    recorder.source = 'auth lookups'
+    User.query.filter_by(email='someone@example.com').first()
+    User.query.filter_by(stripe_customer_id='cus_plancheck').first()
+    EmailVerificationToken.query.filter_by(token='token', used=False).first()
+    EmailVerificationToken.query.filter_by(email='someone@example.com', used=False).delete()
+    PasswordResetToken.query.filter_by(token='token', used=False).first()
+    PasswordResetToken.query.filter_by(email='someone@example.com', used=False).delete()
+    EmailVerificationToken.query.filter(EmailVerificationToken.expires_at < datetime.utcnow()).delete()
+    PasswordResetToken.query.filter(PasswordResetToken.expires_at < datetime.utcnow()).delete()
+    db.session.rollback()
+
+    recorder.source = 'purge_expired_upload_sessions'
+    purge_expired_upload_sessions()
+    recorder.source = 'stripe_event_applier'
+    stripe_event_applier.apply_pending()
+    recorder.source = 'mail_sender'
+    mail_sender._find_next_retry()
+    mail_sender._claim_batch()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQL の実行計画に全表走査が無いかを確かめます')
+    parser.add_argument('--verbose', action='store_true', help='すべての文の実行計画を表示する')
+    args = parser.parse_args()
+
+    init_db()
+    recorder = StatementRecorder()
+    with app.app_context():
+        user = User(email='plancheck@example.com', username='plancheck', password_hash='-')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+        sa.event.listen(db.engine, 'before_cursor_execute', recorder)
+        try:
+            drive_api(app.test_client(), recorder, user_id)
+            run_background_queries(recorder)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', recorder)
+
+        failures = 0
+        raw = db.engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            for statement, parameters in recorder.statements.items():
+                plan = cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                scans = [table for table in full_scans(plan) if table not in ALLOWED_SCANS]
+                failures += bool(scans)
+                if scans or args.verbose:
+                    label = f"FULL SCAN of {', '.join(scans)}" if scans else 'ok'
+                    print(f"[{label}] ({recorder.sources[statement]}) {' '.join(statement.split())[:300]}")
+                    for row in plan:
+                        print(f"    {row[-1]}")
+        finally:
+            raw.close()
+
+    print(f"{len(recorder.statements)} statement(s) checked, {failures} with a full table scan")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,6 +5,16 @@ from datetime import timedelta
 
 class Config:
     REMOTE_SERVER_URL = os.environ.get('REMOTE_SERVER_URL', 'https://kikuoo0915.xsrv.jp/note')
+    # リモートの認証サーバーへの接続 (タイムアウト秒数は接続と応答待ちで別々)
+    REMOTE_CONNECT_TIMEOUT = float(os.environ.get('REMOTE_CONNECT_TIMEOUT', 3.05))
+    REMOTE_READ_TIMEOUT = float(os.environ.get('REMOTE_READ_TIMEOUT', 15))
+    REMOTE_RETRIES = int(os.environ.get('REMOTE_RETRIES', 2))
+    REMOTE_POOL_SIZE = int(os.environ.get('REMOTE_POOL_SIZE', 4))
+    # 続けてこの回数失敗したら、REMOTE_CIRCUIT_RESET_SECONDS のあいだ問い合わせずに失敗を返す
+    REMOTE_CIRCUIT_FAILURES = int(os.environ.get('REMOTE_CIRCUIT_FAILURES', 3))
+    REMOTE_CIRCUIT_RESET_SECONDS = int(os.environ.get('REMOTE_CIRCUIT_RESET_SECONDS', 30))
+    # デスクトップ版でリモートのサブスクリプション状態をそのまま返す秒数 (過ぎたら返しつつ裏で取り直す)
+    USER_STATUS_CACHE_TTL = int(os.environ.get('USER_STATUS_CACHE_TTL', 60))
     # SQLAlchemy設定
     if getattr(sys, 'frozen', False) or os.environ.get('WOWNOTE_DESKTOP') == 'true':
         # デスクトップアプリ用ローカルSQLite
@@ -35,6 +45,48 @@ class Config:
 
     UPLOAD_FOLDER = os.path.join(BASE_DATA_DIR, 'uploads')
     MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 500MB
+    # 分割アップロード (/api/uploads/sessions) の設定
+    CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+    CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get('CHUNKED_UPLOAD_MAX_SIZE', 20 * 1024 * 1024 * 1024))  # 20GB
+    CHUNKED_UPLOAD_EXPIRY = timedelta(days=2)
+    # アップロードストアの実体は、どのセクションからも参照されなくても最後のアップロードからこの時間は残す
+    # (アップロード後にセクションへ登録するまでの猶予)。参照されないまま過ぎたものはこの間隔で掃除する
+    UPLOAD_BLOB_GRACE = timedelta(minutes=int(os.environ.get('UPLOAD_BLOB_GRACE_MINUTES', 60)))
+    UPLOAD_BLOB_SWEEP_INTERVAL = int(os.environ.get('UPLOAD_BLOB_SWEEP_INTERVAL', 600))
+    # サムネイルキャッシュ (グリッド / サムネイル表示用の縮小画像)
+    THUMBNAIL_CACHE_FOLDER = os.path.join(BASE_DATA_DIR, 'cache', 'thumbnails')
+    THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 512 * 1024 * 1024))  # 512MB
+    THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', min(4, os.cpu_count() or 1)))
+    # コピー・移動・解凍のバックグラウンドジョブを同時に実行する数
+    FILE_JOB_WORKERS = int(os.environ.get('FILE_JOB_WORKERS', 2))
+    # これ以上更新されない待機中・実行中のジョブは、受け持つプロセスごと止まったものとみなす
+    # (受け持つプロセスは jobs.HEARTBEAT_INTERVAL ごとに更新する)
+    FILE_JOB_STALE_AFTER = timedelta(minutes=3)
+    # CGI (index.cgi) ではリクエストの処理が終わるとプロセスも終わるため、ジョブをリクエストの中で実行する。
+    # 時間のかかるもの (この合計バイト数を超えるコピー・別デバイスへの移動・解凍) は受け付けない
+    FILE_JOBS_INLINE = os.environ.get('WOWNOTE_CGI') == 'true'
+    FILE_JOB_INLINE_MAX_BYTES = int(os.environ.get('FILE_JOB_INLINE_MAX_BYTES', 200 * 1024 * 1024))  # 200MB
+    # ZIP解凍の上限 (展開後の合計サイズ・エントリ数・圧縮率) と並列数
+    ZIP_EXTRACT_MAX_SIZE = int(os.environ.get('ZIP_EXTRACT_MAX_SIZE', 10 * 1024 * 1024 * 1024))  # 10GB
+    ZIP_EXTRACT_MAX_ENTRIES = int(os.environ.get('ZIP_EXTRACT_MAX_ENTRIES', 100000))
+    ZIP_EXTRACT_MAX_RATIO = int(os.environ.get('ZIP_EXTRACT_MAX_RATIO', 100))
+    ZIP_EXTRACT_WORKERS = int(os.environ.get('ZIP_EXTRACT_WORKERS', min(4, os.cpu_count() or 1)))
+    # パスワードハッシュ (bcrypt) のコストと計算用プール
+    # PASSWORD_HASH_POOL: 'process' (常駐サーバー向け) または 'thread' (CGI・デスクトップ向け。プロセス起動の費用がかからない)
+    BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+    PASSWORD_HASH_POOL = os.environ.get('PASSWORD_HASH_POOL', 'thread')
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', min(2, os.cpu_count() or 1)))
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 16))
+    # メトリクス: プロセスが複数ある場合に集計を書き出すフォルダ (未指定ならプロセス内だけで集計する)
+    METRICS_DIR = os.environ.get('METRICS_DIR') or None
+    # アクセスログ: 出力するリクエストの割合 (5xx とこの秒数以上かかったリクエストは必ず出力)
+    ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('ACCESS_LOG_SAMPLE_RATE', 0.01))
+    ACCESS_LOG_SLOW_SECONDS = float(os.environ.get('ACCESS_LOG_SLOW_SECONDS', 1.0))
+    # SQL: この秒数以上かかった文をバインド値付きでログに出す / 1リクエストで同じ文がこの回数以上なら N+1 の疑いとしてログに出す
+    SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 0.2))
+    N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+    # Apache (mod_xsendfile) などがファイル送信を肩代わりできる場合は true にする
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', 'False') == 'True'
     ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'zip', 'rar'}
     
     # セッション・クッキー設定
@@ -58,9 +110,20 @@ class Config:
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', 'support@kikuoo0915.xsrv.jp')
+    # 送信キュー (mail_outbox) の送信スレッド: 1回に取り出す件数、再送の回数と間隔、接続を開いたまま待つ秒数
+    MAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('MAIL_OUTBOX_BATCH_SIZE', 20))
+    MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS', 6))
+    MAIL_RETRY_BASE_SECONDS = int(os.environ.get('MAIL_RETRY_BASE_SECONDS', 30))
+    MAIL_RETRY_MAX_SECONDS = int(os.environ.get('MAIL_RETRY_MAX_SECONDS', 3600))
+    MAIL_SMTP_IDLE_SECONDS = int(os.environ.get('MAIL_SMTP_IDLE_SECONDS', 10))
+    # 再送待ちのメールがあるかをテーブルで確かめる間隔 (秒、プロセスごと)
+    MAIL_OUTBOX_CHECK_SECONDS = int(os.environ.get('MAIL_OUTBOX_CHECK_SECONDS', 60))
     
     # Stripe 設定
     STRIPE_PAYMENT_LINK = os.environ.get('STRIPE_PAYMENT_LINK', 'https://buy.stripe.com/test_eVq7sLbo4gpMfWng3R0Fi00')
+    # Webhook イベントの反映 (1回のコミットで反映する件数と、失敗したイベントを自動でやり直す回数)
+    STRIPE_EVENT_BATCH_SIZE = int(os.environ.get('STRIPE_EVENT_BATCH_SIZE', 50))
+    STRIPE_EVENT_MAX_ATTEMPTS = int(os.environ.get('STRIPE_EVENT_MAX_ATTEMPTS', 5))
     
     # 外部ストレージ設定
     STORAGE_BASE_PATH = os.environ.get('STORAGE_BASE_PATH', os.path.join(BASE_DATA_DIR, 'storage'))
@@ -4,19 +4,15 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from app import db, User, EmailVerificationToken
+from app import init_db
 import sys
 
 def create_auth_tables():
-    """認証関連のテーブルを作成"""
-    from app import app
-    
+    """認証関連のテーブルを作成 (migrations.py のマイグレーションを適用する)"""
     try:
         print("認証テーブルを作成しています...")
         
-        with app.app_context():
-            # テーブルを作成
-            db.create_all()
+        init_db()
         
         print("✓ usersテーブルを作成しました")
         print("✓ email_verification_tokensテーブルを作成しました")
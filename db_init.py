@@ -17,14 +17,13 @@ sys.path.insert(0, '/home/kikuoo0915/kikuoo0915.xsrv.jp/public_html/note')
 from dotenv import load_dotenv
 load_dotenv('/home/kikuoo0915/kikuoo0915.xsrv.jp/public_html/note/.env')
 
-from app import app, db
+from app import init_db
 
-with app.app_context():
-    print("データベース接続を確認中...")
-    try:
-        db.create_all()
-        print("✅ 全テーブルの作成が完了しました！")
-    except Exception as e:
-        print(f"❌ エラーが発生しました: {e}")
-        import traceback
-        traceback.print_exc()
+print("データベース接続を確認中...")
+try:
+    init_db()
+    print("✅ 全テーブルの作成が完了しました！")
+except Exception as e:
+    print(f"❌ エラーが発生しました: {e}")
+    import traceback
+    traceback.print_exc()
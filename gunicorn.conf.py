@@ -0,0 +1,51 @@
+"""
+gunicorn 設定ファイル (常駐サーバーモード)
+環境変数で調整できます:
+  WOWNOTE_BIND     待ち受け先 (既定: unix:<アプリ直下>/run/wownote.sock。"127.0.0.1:8001" のようなTCP指定も可)
+  WOWNOTE_WORKERS  プリフォークするワーカープロセス数 (既定: CPU数 * 2 + 1)
+  WOWNOTE_THREADS  ワーカーごとのスレッド数 (既定: 4)
+  WOWNOTE_TIMEOUT  リクエストのタイムアウト秒数 (既定: 120)
+常駐サーバーではパスワードハッシュの計算をプロセスプールで行う (PASSWORD_HASH_POOL で上書き可)。
+メトリクスは run/metrics に書き出し、どのワーカーの /metrics からも全体の合計を返す (METRICS_DIR で上書き可)。
+"""
+import multiprocessing
+import os
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+RUN_DIR = os.path.join(APP_ROOT, 'run')
+os.makedirs(RUN_DIR, exist_ok=True)
+
+os.environ.setdefault('PASSWORD_HASH_POOL', 'process')
+# 各ワーカーのメトリクスをここに書き出し、/metrics ではすべてのワーカーの分を合算する
+os.environ.setdefault('METRICS_DIR', os.path.join(RUN_DIR, 'metrics'))
+
+bind = os.environ.get('WOWNOTE_BIND', 'unix:' + os.path.join(RUN_DIR, 'wownote.sock'))
+# Webサーバー (Apache/nginx) からソケットへ書き込めるようにする
+umask = 0o007
+
+workers = int(os.environ.get('WOWNOTE_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WOWNOTE_THREADS', 4))
+worker_class = 'gthread'
+timeout = int(os.environ.get('WOWNOTE_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# メモリリーク対策として一定数のリクエスト毎にワーカーを入れ替える
+max_requests = 2000
+max_requests_jitter = 200
+
+# マスターで app.py を1回だけ読み込み、ワーカーは fork で共有する
+# (SIGHUP ではアプリを読み直さない。コード更新時は server.sh reload で SIGUSR2 によりマスターごと入れ替える)
+preload_app = True
+
+pidfile = os.path.join(RUN_DIR, 'gunicorn.pid')
+accesslog = None
+errorlog = '-'
+loglevel = 'info'
+
+
+def post_fork(server, worker):
+    """fork 前にマスターで作られたDB接続をワーカー間で共有しないよう破棄する"""
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
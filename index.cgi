@@ -11,6 +11,8 @@ sys.path.insert(0, APP_ROOT)
 
 # 環境変数の読み込み
 os.environ['PYTHONIOENCODING'] = 'utf-8'
+# CGI ではリクエストが終わるとプロセスも終わるため、コピー・移動・解凍はリクエストの中で実行する (config.py)
+os.environ['WOWNOTE_CGI'] = 'true'
 
 # エラーハンドリング用のラッパー
 try:
@@ -28,6 +30,13 @@ try:
 
     # カスタムハンドラーでアプリを実行
     DebugCGIHandler().run(app)
+
+    # メール送信などのバックグラウンドスレッドが残っていても応答はここで終わらせる。
+    # 標準出力を /dev/null に差し替えてパイプを閉じる (残りのスレッドは短いものだけ。
+    # Webサーバーは終了までプロセスの枠を使い続け、CGI のタイムアウトで止めることもある)。
+    sys.stdout.flush()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
     
 except Exception as e:
     # ブラウザにエラーを表示（デバッグ用）
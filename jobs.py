@@ -0,0 +1,293 @@
+"""
+時間のかかるファイル操作 (コピー・移動・ZIP解凍) のバックグラウンド実行
+ZIPの展開処理そのものは archive.py にあります。
+リクエストスレッドを何分も占有しないよう、ジョブを file_jobs テーブルに登録してワーカースレッドで実行し、
+進捗 (バイト数・ファイル数) を一定間隔でテーブルに書き戻します。
+キャンセルは cancel_requested を立てるだけで、実行中のジョブが進捗を書き戻すときに気付いて中断します。
+状態はテーブルにあるので、gunicorn の別プロセスに届いた問い合わせにも答えられます。
+ワーカーのプロセスが終わっても (max_requests での入れ替え・reload・異常終了) 行が残らないよう、
+プロセスが受け持つ待機中・実行中のジョブの updated_at を一定間隔で更新し (ハートビート)、
+更新の途絶えたジョブは問い合わせの際に失敗扱いにして、書きかけのコピー先 (cleanup_path) を削除します。
+"""
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import sqlalchemy as sa
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# 進捗をテーブルに書き戻す間隔 (秒)
+PROGRESS_INTERVAL = 0.5
+# 受け持つジョブの updated_at を更新する間隔 (秒)。FILE_JOB_STALE_AFTER より十分短くする
+HEARTBEAT_INTERVAL = 30
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+
+class JobCancelled(Exception):
+    """キャンセルが要求された"""
+
+
+class JobProgress:
+    """ジョブの進捗カウンタ (書き戻しは PROGRESS_INTERVAL ごとにまとめる)"""
+
+    def __init__(self, engine, job_id):
+        self.engine = engine
+        self.job_id = job_id
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.files_total = 0
+        self.files_done = 0
+        self._last_flush = 0.0
+        # ZIPの並列展開では複数のスレッドから進捗が加算される
+        self._lock = threading.Lock()
+
+    def set_totals(self, bytes_total, files_total):
+        self.bytes_total = bytes_total
+        self.files_total = files_total
+        self.flush(force=True)
+
+    def add(self, bytes_done=0, files_done=0):
+        with self._lock:
+            self.bytes_done += bytes_done
+            self.files_done += files_done
+        self.flush()
+
+    def flush(self, force=False):
+        """進捗を書き戻し、キャンセルが要求されていれば JobCancelled を送出する"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_flush < PROGRESS_INTERVAL:
+                return
+            self._last_flush = now
+        with self.engine.begin() as conn:
+            conn.execute(sa.text(
+                "UPDATE file_jobs SET bytes_total = :bt, bytes_done = :bd, files_total = :ft, files_done = :fd, "
+                "updated_at = :now WHERE id = :id"
+            ), {'bt': self.bytes_total, 'bd': self.bytes_done, 'ft': self.files_total, 'fd': self.files_done,
+                'now': datetime.utcnow(), 'id': self.job_id})
+            cancel = conn.execute(sa.text("SELECT cancel_requested FROM file_jobs WHERE id = :id"),
+                                  {'id': self.job_id}).scalar()
+        if cancel:
+            raise JobCancelled()
+
+    def set_cleanup_path(self, path):
+        """プロセスごと止まったときに削除する書きかけのパスを記録する (None で取り消す)"""
+        with self.engine.begin() as conn:
+            conn.execute(sa.text("UPDATE file_jobs SET cleanup_path = :path WHERE id = :id"),
+                         {'path': path, 'id': self.job_id})
+
+
+class JobRunner:
+    """ジョブをワーカースレッドで実行し、状態遷移を file_jobs に記録する"""
+
+    def __init__(self, engine_getter, workers=2):
+        # アプリのエンジンはアプリコンテキストの中でしか取れないので、呼び出し時に取得する
+        self.engine_getter = engine_getter
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        # このプロセスが受け持つ未完了のジョブ (ハートビートの対象)
+        self._active = set()
+        self._heartbeat = None
+
+    def submit(self, job_id, func, *args):
+        """func(progress, *args) をワーカーで実行する (戻り値は result に JSON で保存)"""
+        engine = self.engine_getter()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='file-job')
+        self._track(engine, job_id)
+        self._executor.submit(self._run, engine, job_id, func, args)
+
+    def run_inline(self, job_id, func, *args):
+        """func(progress, *args) を呼び出し元のスレッドで実行し、終わるまで待つ (CGI 用)"""
+        engine = self.engine_getter()
+        self._track(engine, job_id)
+        self._run(engine, job_id, func, args)
+
+    def _track(self, engine, job_id):
+        """ジョブを受け持ちに加え、ハートビートのスレッドが止まっていれば起動する"""
+        with self._lock:
+            self._active.add(job_id)
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, args=(engine,), name='file-job-heartbeat',
+                                                   daemon=True)
+                self._heartbeat.start()
+
+    def _beat(self, engine):
+        """受け持つジョブが無くなるまで updated_at を更新し続ける"""
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self._lock:
+                job_ids = list(self._active)
+                if not job_ids:
+                    self._heartbeat = None
+                    return
+            try:
+                with engine.begin() as conn:
+                    conn.execute(sa.text(
+                        "UPDATE file_jobs SET updated_at = :now WHERE id IN :ids AND status IN (:queued, :running)"
+                    ).bindparams(sa.bindparam('ids', expanding=True)),
+                        {'now': datetime.utcnow(), 'ids': job_ids, 'queued': JOB_QUEUED, 'running': JOB_RUNNING})
+            except Exception as e:
+                print(f"[JOB] Heartbeat failed: {e}")
+
+    def _run(self, engine, job_id, func, args):
+        try:
+            self._run_job(engine, job_id, func, args)
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def _run_job(self, engine, job_id, func, args):
+        with engine.begin() as conn:
+            started = conn.execute(sa.text(
+                "UPDATE file_jobs SET status = :running, started_at = :now, updated_at = :now "
+                "WHERE id = :id AND status = :queued AND cancel_requested = :false"
+            ), {'running': JOB_RUNNING, 'queued': JOB_QUEUED, 'now': datetime.utcnow(), 'id': job_id,
+                'false': False}).rowcount
+        if not started:
+            finish_job(engine, job_id, JOB_CANCELLED)
+            return
+
+        progress = JobProgress(engine, job_id)
+        try:
+            result = func(progress, *args)
+        except JobCancelled:
+            finish_job(engine, job_id, JOB_CANCELLED, progress=progress)
+        except Exception as e:
+            print(f"[JOB] {job_id} failed: {e}")
+            finish_job(engine, job_id, JOB_FAILED, error=str(e), progress=progress)
+        else:
+            finish_job(engine, job_id, JOB_SUCCEEDED, result=result, progress=progress)
+
+
+def finish_job(engine, job_id, status, result=None, error=None, progress=None):
+    """ジョブを終了状態にする (既に終了状態のジョブは書き換えない)"""
+    params = {'status': status, 'result': json.dumps(result, ensure_ascii=False) if result is not None else None,
+              'error': error, 'now': datetime.utcnow(), 'id': job_id,
+              'succeeded': JOB_SUCCEEDED, 'failed': JOB_FAILED, 'cancelled': JOB_CANCELLED}
+    counters = ''
+    if progress is not None:
+        counters = ', bytes_done = :bd, files_done = :fd'
+        params.update({'bd': progress.bytes_done, 'fd': progress.files_done})
+    with engine.begin() as conn:
+        conn.execute(sa.text(
+            f"UPDATE file_jobs SET status = :status, result = :result, error = :error, "
+            f"finished_at = :now, updated_at = :now{counters} "
+            f"WHERE id = :id AND status NOT IN (:succeeded, :failed, :cancelled)"
+        ), params)
+
+
+# ==================== ファイル操作 ====================
+
+def measure_path(path):
+    """コピー対象の (合計バイト数, ファイル数) を数える"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path), 1
+    total_bytes = total_files = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total_bytes += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            total_files += 1
+    return total_bytes, total_files
+
+
+def copy_file_chunked(src, dst, progress):
+    """1ファイルを少しずつコピーし、進捗とキャンセルを確認する"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while True:
+            chunk = fsrc.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            fdst.write(chunk)
+            progress.add(bytes_done=len(chunk))
+    shutil.copystat(src, dst)
+    progress.add(files_done=1)
+
+
+def copy_tree_chunked(src, dst, progress):
+    os.makedirs(dst)
+    with os.scandir(src) as entries:
+        for entry in entries:
+            target = os.path.join(dst, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target)
+                progress.add(files_done=1)
+            elif entry.is_dir():
+                copy_tree_chunked(entry.path, target, progress)
+            else:
+                copy_file_chunked(entry.path, target, progress)
+    shutil.copystat(src, dst)
+
+
+def remove_path(path):
+    """途中までコピーしたものを片付ける"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, onerror=_clear_readonly)
+        elif os.path.lexists(path):
+            os.remove(path)
+    except OSError as e:
+        print(f"[JOB] Failed to clean up {path}: {e}")
+
+
+def _clear_readonly(func, path, _):
+    # Windows では読み取り専用ファイルを削除できないため属性を外して再試行する
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+def copy_path(progress, source, target):
+    """ファイルまたはフォルダをコピーする (キャンセル時はコピー先を削除)"""
+    progress.set_totals(*measure_path(source))
+    progress.set_cleanup_path(target)
+    try:
+        if os.path.isdir(source):
+            copy_tree_chunked(source, target, progress)
+        else:
+            copy_file_chunked(source, target, progress)
+    except BaseException:
+        remove_path(target)
+        raise
+    # コピーが終わったので、この後に止まってもコピー先は残す (移動では元の削除に進む)
+    progress.set_cleanup_path(None)
+    return {'target': os.path.basename(target)}
+
+
+def move_path(progress, source, target):
+    """ファイルまたはフォルダを移動する
+
+    同じデバイス内なら rename だけで済ませ、別デバイスの場合はコピーしてから元を削除する
+    (コピーの途中でキャンセルされた場合は元を残す)。
+    """
+    try:
+        os.rename(source, target)
+    except OSError:
+        # 別デバイス (shutil.move と同じく rename できなければコピーに切り替える)
+        pass
+    else:
+        progress.files_total = progress.files_done = 1
+        return {'target': os.path.basename(target)}
+
+    result = copy_path(progress, source, target)
+    if os.path.isdir(source) and not os.path.islink(source):
+        shutil.rmtree(source, onerror=_clear_readonly)
+    else:
+        os.remove(source)
+    return result
+
@@ -0,0 +1,285 @@
+"""
+送信メールのキュー (mail_outbox テーブル) とバックグラウンド送信
+リクエストの中では SMTP に接続せず、メールをテーブルに積んで送信スレッドを起こすだけにします。
+送信スレッドは認証済みの SMTP 接続を1本だけ開いたまま、溜まったメールをまとめて送り、
+一時的な失敗 (接続断・タイムアウト・4xx 応答) は間隔を倍にしながら再送します。
+しばらく送るものが無くなったら接続を閉じてスレッドも終了します (CGI のプロセスが残り続けないように)。
+状態はテーブルにあるので、gunicorn の別プロセスが積んだメールも、どのプロセスの送信スレッドからでも送れます。
+再送の予定時刻はメモリにもありますが、送信スレッドが終了したプロセスや別のプロセスでは分からないので、
+リクエストの処理前に一定間隔でテーブルの最も早い送信予定時刻を確かめます。
+CGI ではプロセスがリクエストごとに終わるため、send_mail.py を cron で定期的に実行して送ります。
+"""
+import json
+import secrets
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+MAIL_QUEUED = 'queued'
+MAIL_SENDING = 'sending'
+MAIL_SENT = 'sent'
+MAIL_FAILED = 'failed'
+
+# 送信中のまま更新されない行は、送っていたプロセスが止まったものとみなして再送する
+SENDING_STALE_AFTER = timedelta(minutes=10)
+
+
+def new_mail_id():
+    return secrets.token_hex(16)
+
+
+def is_permanent_error(error):
+    """再送しても結果が変わらない失敗なら True (宛先の拒否や 5xx 応答)"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 500 <= error.smtp_code < 600
+    return isinstance(error, (AssertionError, ValueError))
+
+
+def is_connection_error(error):
+    """接続そのものが使えなくなった失敗なら True (SMTPException も OSError の派生なので区別する)"""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class MailSender:
+    """mail_outbox のメールを1本の SMTP 接続でまとめて送る送信スレッド"""
+
+    def __init__(self, app, engine_getter, mail_getter, batch_size=20, max_attempts=6,
+                 retry_base=30, retry_max=3600, idle_timeout=10, check_interval=60):
+        self.app = app
+        # アプリのエンジンはアプリコンテキストの中でしか取れないので、呼び出し時に取得する
+        self.engine_getter = engine_getter
+        self.mail_getter = mail_getter
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.idle_timeout = idle_timeout
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        # このプロセスで再送を予定している最も早い時刻 (time.monotonic)
+        self._next_retry = None
+        # テーブルの送信予定時刻を確かめる間隔 (秒) と前回確かめた時刻 (time.monotonic)
+        self.check_interval = check_interval
+        self._last_check = time.monotonic()
+
+    def wake(self):
+        """送信スレッドを起こす (動いていなければ起動する)"""
+        with self._lock:
+            self._next_retry = None
+            if self._thread is None or not self._thread.is_alive():
+                # CGI では応答を返した後もこのスレッドの終了を待ってからプロセスが終わる
+                self._thread = threading.Thread(target=self._run, name='mail-sender')
+                self._thread.start()
+            # 終了しかけのスレッドが見落とさないよう、ロックの中で立てる
+            self._wakeup.set()
+
+    def wake_if_due(self):
+        """再送の予定時刻を過ぎていれば送信スレッドを起こす
+
+        ふだんはメモリ上の時刻を比べるだけで、check_interval ごとに1回だけテーブルの送信予定時刻を読む
+        (他のプロセスが積んだメールや、送信スレッドが終了した後に来た再送の時刻に気付くため)。
+        """
+        now = time.monotonic()
+        next_retry = self._next_retry
+        if next_retry is not None and now >= next_retry:
+            self.wake()
+            return
+        with self._lock:
+            if now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            if self._thread is not None and self._thread.is_alive():
+                # 動いている送信スレッドが自分でテーブルを確かめる
+                return
+        next_retry = self._find_next_retry()
+        if next_retry is None:
+            return
+        if next_retry <= time.monotonic():
+            self.wake()
+        else:
+            with self._lock:
+                if self._next_retry is None or next_retry < self._next_retry:
+                    self._next_retry = next_retry
+
+    def send_due(self):
+        """送信予定時刻を過ぎたメールを呼び出し元のスレッドでまとめて送り、送った件数を返す (cron 用)"""
+        sent = 0
+        with self.app.app_context():
+            connection = None
+            try:
+                while True:
+                    batch = self._claim_batch()
+                    if not batch:
+                        break
+                    connection = self._send_batch(batch, connection)
+                    sent += len(batch)
+            finally:
+                self._close(connection)
+        return sent
+
+    def _run(self):
+        with self.app.app_context():
+            connection = None
+            idle_since = time.monotonic()
+            try:
+                while True:
+                    self._wakeup.clear()
+                    batch = self._claim_batch()
+                    if batch:
+                        connection = self._send_batch(batch, connection)
+                        idle_since = time.monotonic()
+                        continue
+                    remaining = self.idle_timeout - (time.monotonic() - idle_since)
+                    next_retry = self._find_next_retry()
+                    if next_retry is not None and next_retry - time.monotonic() < remaining:
+                        # 接続を開いている間に再送の時刻が来るなら、それまで待ってから続ける
+                        self._wakeup.wait(timeout=max(0.0, next_retry - time.monotonic()))
+                        continue
+                    if remaining <= 0 or not self._wakeup.wait(timeout=remaining):
+                        # しばらく何も来なければ接続を閉じて終了する (次の wake で起動し直す)
+                        with self._lock:
+                            if not self._wakeup.is_set():
+                                self._thread = None
+                                self._next_retry = next_retry
+                                return
+            except Exception as e:
+                print(f"[MAIL] Sender stopped: {e}")
+                with self._lock:
+                    self._thread = None
+            finally:
+                self._close(connection)
+
+    def _find_next_retry(self):
+        """再送待ちのメールのうち最も早い送信予定時刻を time.monotonic の値で返す (無ければ None)"""
+        try:
+            with self.engine_getter().connect() as conn:
+                due = conn.execute(sa.text(
+                    "SELECT MIN(next_attempt_at) FROM mail_outbox WHERE status = :queued"
+                ), {'queued': MAIL_QUEUED}).scalar()
+        except sa.exc.DBAPIError as e:
+            print(f"[MAIL] Failed to read the outbox: {e}")
+            return None
+        if due is None:
+            return None
+        if isinstance(due, str):
+            # SQLite ではテキストで返る
+            due = datetime.fromisoformat(due)
+        return time.monotonic() + max(0.0, (due - datetime.utcnow()).total_seconds())
+
+    def _claim_batch(self):
+        """送信予定時刻を過ぎたメールを最大 batch_size 件取り、送信中にする"""
+        now = datetime.utcnow()
+        engine = self.engine_getter()
+        with engine.begin() as conn:
+            conn.execute(sa.text(
+                "UPDATE mail_outbox SET status = :queued, updated_at = :now "
+                "WHERE status = :sending AND updated_at < :stale"
+            ), {'queued': MAIL_QUEUED, 'sending': MAIL_SENDING, 'now': now, 'stale': now - SENDING_STALE_AFTER})
+            candidates = conn.execute(sa.text(
+                "SELECT id FROM mail_outbox WHERE status = :queued AND next_attempt_at <= :now "
+                "ORDER BY created_at LIMIT :limit"
+            ), {'queued': MAIL_QUEUED, 'now': now, 'limit': self.batch_size}).scalars().all()
+
+        claimed = []
+        for mail_id in candidates:
+            # 他のプロセスの送信スレッドと同じメールを取り合わないよう、状態を条件にして更新する
+            with engine.begin() as conn:
+                updated = conn.execute(sa.text(
+                    "UPDATE mail_outbox SET status = :sending, attempts = attempts + 1, updated_at = :now "
+                    "WHERE id = :id AND status = :queued"
+                ), {'sending': MAIL_SENDING, 'queued': MAIL_QUEUED, 'now': now, 'id': mail_id}).rowcount
+                if not updated:
+                    continue
+                row = conn.execute(sa.text(
+                    "SELECT id, sender, recipients, subject, body, html, attempts FROM mail_outbox WHERE id = :id"
+                ), {'id': mail_id}).mappings().first()
+            claimed.append(dict(row))
+        return claimed
+
+    def _connect(self):
+        connection = self.mail_getter().connect()
+        connection.__enter__()
+        return connection
+
+    def _close(self, connection):
+        if connection is None or connection.host is None:
+            return
+        try:
+            connection.host.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.host.close()
+
+    def _send_batch(self, batch, connection):
+        """まとめて送り、使い続けられる接続を返す (失敗したら None)"""
+        from flask_mail import BadHeaderError, Message
+
+        for index, row in enumerate(batch):
+            # 前のバッチから持ち越した接続は、サーバー側で切られていることがある
+            reused = connection is not None
+            try:
+                if connection is None:
+                    connection = self._connect()
+                message = Message(
+                    subject=row['subject'],
+                    recipients=json.loads(row['recipients']),
+                    body=row['body'],
+                    html=row['html'],
+                    sender=row['sender'] or None
+                )
+                try:
+                    connection.send(message)
+                except smtplib.SMTPServerDisconnected:
+                    if not reused:
+                        raise
+                    self._close(connection)
+                    connection = None
+                    connection = self._connect()
+                    connection.send(message)
+            except Exception as e:
+                if connection is None or is_connection_error(e):
+                    # 接続できない・接続が切れた場合は接続を捨て、残りのメールもまとめて後で再送する
+                    self._close(connection)
+                    for pending in batch[index:]:
+                        self._retry(pending, e)
+                    return None
+                # このメールだけの失敗 (接続はそのまま使い続ける)
+                if isinstance(e, BadHeaderError) or is_permanent_error(e):
+                    self._finish(row, MAIL_FAILED, error=e)
+                else:
+                    self._retry(row, e)
+                continue
+            self._finish(row, MAIL_SENT)
+        return connection
+
+    def _retry(self, row, error):
+        if row['attempts'] >= self.max_attempts:
+            self._finish(row, MAIL_FAILED, error=error)
+            return
+        delay = min(self.retry_base * 2 ** (row['attempts'] - 1), self.retry_max)
+        print(f"[MAIL] {row['id']} failed (attempt {row['attempts']}), retrying in {delay}s: {error}")
+        now = datetime.utcnow()
+        with self.engine_getter().begin() as conn:
+            conn.execute(sa.text(
+                "UPDATE mail_outbox SET status = :queued, last_error = :error, next_attempt_at = :next, "
+                "updated_at = :now WHERE id = :id"
+            ), {'queued': MAIL_QUEUED, 'error': str(error), 'next': now + timedelta(seconds=delay),
+                'now': now, 'id': row['id']})
+
+    def _finish(self, row, status, error=None):
+        if error is not None:
+            print(f"[MAIL] {row['id']} failed permanently: {error}")
+        now = datetime.utcnow()
+        with self.engine_getter().begin() as conn:
+            conn.execute(sa.text(
+                "UPDATE mail_outbox SET status = :status, last_error = :error, sent_at = :sent_at, "
+                "updated_at = :now WHERE id = :id"
+            ), {'status': status, 'error': str(error) if error is not None else None,
+                'sent_at': now if status == MAIL_SENT else None, 'now': now, 'id': row['id']})
@@ -0,0 +1,367 @@
+"""
+リクエストごとの計測と Prometheus 形式のメトリクス
+WSGI ミドルウェアでリクエストの開始から応答本文の送信完了までを計り、エンドポイント別に
+リクエスト数 (ステータス別)・所要時間・応答サイズ・DB の実行時間と回数・ファイル I/O の時間を集計します。
+アクセスログは一部のリクエストだけを JSON で出力します (エラーと遅いリクエストは必ず出力)。
+
+gunicorn のようにプロセスが複数ある場合は、METRICS_DIR を指定すると各プロセスが集計を
+METRICS_DIR/<pid>.json に定期的に書き出し、/metrics ではすべてのプロセスの分を合算して返します。
+終了したプロセスのファイルは _retired.json にまとめるので、ワーカーが入れ替わっても合計は減りません。
+"""
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows (デスクトップ版は単一プロセスなので使わない)
+    fcntl = None
+
+# 所要時間のバケット (秒)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 応答サイズのバケット (バイト)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+METRIC_HELP = {
+    'wownote_http_requests_total': ('counter', 'HTTP requests by endpoint, method and status'),
+    'wownote_http_request_duration_seconds': ('histogram', 'Time from request start until the body is sent'),
+    'wownote_http_response_size_bytes': ('histogram', 'Response body size'),
+    'wownote_db_duration_seconds': ('histogram', 'Time spent executing SQL per request'),
+    'wownote_db_queries_total': ('counter', 'SQL statements executed'),
+    'wownote_file_io_duration_seconds': ('histogram', 'Time spent in tracked file I/O per request'),
+}
+
+RETIRED_FILE = '_retired.json'
+
+access_logger = logging.getLogger('wownote.access')
+
+# 処理中のリクエストの DB / ファイル I/O 時間 (WSGI サーバーは1リクエストを1スレッドで処理する)
+_current = threading.local()
+
+
+def add_db_time(seconds):
+    if getattr(_current, 'active', False):
+        _current.db_seconds += seconds
+        _current.db_queries += 1
+
+
+@contextmanager
+def track_file_io():
+    """with の中の時間を、処理中のリクエストのファイル I/O 時間に加える"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if getattr(_current, 'active', False):
+            _current.file_io_seconds += time.perf_counter() - start
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    """カウンタとヒストグラムの集計 (スレッドセーフ)"""
+
+    def __init__(self):
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [バケットごとの件数..., 上限超えの件数, 合計, 件数]
+        self.buckets = {}     # name -> バケットの上限
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.buckets[name] = buckets
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [0] * (len(buckets) + 3)
+            # 累積はテキストに出すときに計算する
+            entry[bisect.bisect_left(buckets, value)] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(map(list, labels)), value]
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(map(list, labels)), list(entry)]
+                               for (name, labels), entry in self.histograms.items()],
+                'buckets': {name: list(buckets) for name, buckets in self.buckets.items()},
+            }
+
+    def merge(self, snapshot):
+        """他のプロセスの snapshot() を足し込む"""
+        with self._lock:
+            for name, buckets in snapshot.get('buckets', {}).items():
+                self.buckets.setdefault(name, tuple(buckets))
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, tuple(map(tuple, labels)))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, entry in snapshot.get('histograms', []):
+                key = (name, tuple(map(tuple, labels)))
+                current = self.histograms.get(key)
+                if current is None or len(current) != len(entry):
+                    self.histograms[key] = list(entry)
+                else:
+                    self.histograms[key] = [a + b for a, b in zip(current, entry)]
+
+    def render(self):
+        """Prometheus のテキスト形式にする"""
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self.counters} | {name for name, _ in self.histograms})
+            for name in names:
+                kind, help_text = METRIC_HELP.get(name, ('untyped', ''))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                for (metric, labels), entry in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets[name], entry):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} "
+                                     f"{cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {entry[-1]}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(entry[-2])}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {entry[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+class RequestMetrics:
+    """WSGI ミドルウェアとしてリクエストを計測し、集計とアクセスログを行う"""
+
+    def __init__(self, metrics_dir=None, flush_interval=5, log_sample_rate=0.01, slow_seconds=1.0):
+        self.registry = MetricsRegistry()
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self.log_sample_rate = log_sample_rate
+        self.slow_seconds = slow_seconds
+        self._last_flush = 0.0
+        self._flush_lock = threading.Lock()
+        if not access_logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            access_logger.addHandler(handler)
+            access_logger.setLevel(logging.INFO)
+            access_logger.propagate = False
+
+    def middleware(self, wsgi_app):
+        def metrics_app(environ, start_response):
+            _current.active = True
+            _current.db_seconds = 0.0
+            _current.db_queries = 0
+            _current.file_io_seconds = 0.0
+            start = time.perf_counter()
+            status_holder = {}
+
+            def capture_start_response(status, headers, exc_info=None):
+                status_holder['status'] = status.split(' ', 1)[0]
+                for name, value in headers:
+                    if name.lower() == 'content-length' and value.isdigit():
+                        status_holder['length'] = int(value)
+                return start_response(status, headers, exc_info)
+
+            try:
+                body = wsgi_app(environ, capture_start_response)
+            except BaseException:
+                status_holder.setdefault('status', '500')
+                self._finish(environ, status_holder, start, 0)
+                raise
+
+            if hasattr(body, 'filelike'):
+                # wsgi.file_wrapper (gunicorn の sendfile など) は包むと使われなくなるので、close だけ差し替える
+                original_close = getattr(body, 'close', None)
+
+                def close():
+                    try:
+                        if original_close is not None:
+                            original_close()
+                    finally:
+                        self._finish(environ, status_holder, start, status_holder.get('length', 0))
+                body.close = close
+                return body
+            return _MeasuredBody(body, lambda size: self._finish(environ, status_holder, start, size))
+        return metrics_app
+
+    def _finish(self, environ, status_holder, start, size):
+        duration = time.perf_counter() - start
+        db_seconds = getattr(_current, 'db_seconds', 0.0)
+        db_queries = getattr(_current, 'db_queries', 0)
+        file_io_seconds = getattr(_current, 'file_io_seconds', 0.0)
+        _current.active = False
+
+        endpoint = environ.get('wownote.endpoint') or 'unmatched'
+        status = status_holder.get('status', '500')
+        method = environ.get('REQUEST_METHOD', '')
+        labels = {'endpoint': endpoint}
+        registry = self.registry
+        registry.inc('wownote_http_requests_total', {'endpoint': endpoint, 'method': method, 'status': status})
+        registry.observe('wownote_http_request_duration_seconds', labels, duration, DURATION_BUCKETS)
+        registry.observe('wownote_http_response_size_bytes', labels, size, SIZE_BUCKETS)
+        registry.observe('wownote_db_duration_seconds', labels, db_seconds, DURATION_BUCKETS)
+        if db_queries:
+            registry.inc('wownote_db_queries_total', labels, db_queries)
+        registry.observe('wownote_file_io_duration_seconds', labels, file_io_seconds, DURATION_BUCKETS)
+
+        if status.startswith('5') or duration >= self.slow_seconds or random.random() < self.log_sample_rate:
+            access_logger.info(json.dumps({
+                'ts': round(time.time(), 3),
+                'method': method,
+                'path': environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                'endpoint': endpoint,
+                'status': int(status) if status.isdigit() else status,
+                'ms': round(duration * 1000, 1),
+                'bytes': size,
+                'db_ms': round(db_seconds * 1000, 1),
+                'db_queries': db_queries,
+                'file_io_ms': round(file_io_seconds * 1000, 1),
+            }, ensure_ascii=False))
+
+        self.maybe_flush()
+
+    # ---------- プロセス間の集約 ----------
+
+    def maybe_flush(self, force=False):
+        """METRICS_DIR/<pid>.json に集計を書き出す (flush_interval ごと)"""
+        if not self.metrics_dir:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_flush = now
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            path = os.path.join(self.metrics_dir, f"{os.getpid()}.json")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.registry.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[METRICS] Failed to write snapshot: {e}")
+        finally:
+            self._flush_lock.release()
+
+    def collect(self):
+        """全プロセスの集計を合算した MetricsRegistry を返す"""
+        if not self.metrics_dir or not os.path.isdir(self.metrics_dir):
+            return self.registry
+        self.maybe_flush(force=True)
+        self._retire_dead_processes()
+        combined = MetricsRegistry()
+        for name in os.listdir(self.metrics_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.metrics_dir, name)) as f:
+                    combined.merge(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return combined
+
+    def _retire_dead_processes(self):
+        """終了したプロセスのファイルを _retired.json に足し込んで削除する"""
+        if fcntl is None:
+            return
+        lock_path = os.path.join(self.metrics_dir, '.lock')
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                retired_path = os.path.join(self.metrics_dir, RETIRED_FILE)
+                retired = None
+                dead_files = []
+                for name in os.listdir(self.metrics_dir):
+                    pid = name[:-len('.json')] if name.endswith('.json') else ''
+                    if not pid.isdigit() or _pid_alive(int(pid)):
+                        continue
+                    if retired is None:
+                        retired = MetricsRegistry()
+                        if os.path.exists(retired_path):
+                            with open(retired_path) as f:
+                                retired.merge(json.load(f))
+                    path = os.path.join(self.metrics_dir, name)
+                    try:
+                        with open(path) as f:
+                            retired.merge(json.load(f))
+                    except (OSError, ValueError):
+                        pass
+                    dead_files.append(path)
+                if retired is None:
+                    return
+                tmp_path = f"{retired_path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(retired.snapshot(), f)
+                os.replace(tmp_path, retired_path)
+                for path in dead_files:
+                    os.remove(path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _MeasuredBody:
+    """応答本文を送りながらバイト数を数え、close() で計測を終える"""
+
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+        self._size = 0
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self._body:
+            self._size += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._on_close(self._size)
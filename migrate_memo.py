@@ -1,16 +1,8 @@
-from app import app, db
-from sqlalchemy import text
+"""
+旧マイグレーションスクリプト (sections.memo の追加)
+現在は migrations.py に統合されているため、init_db() を実行するだけです。
+"""
+from app import init_db
 
-with app.app_context():
-    try:
-        # Check if column exists
-        result = db.session.execute(text("SHOW COLUMNS FROM sections LIKE 'memo'"))
-        if result.fetchone():
-            print("Column 'memo' already exists.")
-        else:
-            print("Adding column 'memo'...")
-            db.session.execute(text("ALTER TABLE sections ADD COLUMN memo TEXT"))
-            db.session.commit()
-            print("Column 'memo' added successfully.")
-    except Exception as e:
-        print(f"Error: {e}")
+if __name__ == '__main__':
+    init_db()
@@ -0,0 +1,228 @@
+"""
+スキーマのバージョン管理とマイグレーション
+schema_version テーブルに適用済みのバージョンを1行だけ保持し、
+起動時はその1行を読むだけで最新かどうかを判定します。
+マイグレーションは必ず冪等に書くこと (途中で失敗しても再実行できるように)。
+"""
+import sqlalchemy as sa
+
+
+def table_exists(conn, table):
+    return sa.inspect(conn).has_table(table)
+
+
+def column_exists(conn, table, column):
+    return any(c['name'] == column for c in sa.inspect(conn).get_columns(table))
+
+
+def add_column(conn, table, column, definition):
+    """カラムが無い場合だけ追加する (既存カラムへの ALTER を発行しない)"""
+    if not column_exists(conn, table, column):
+        conn.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+        print(f"[MIGRATE] Added '{column}' to '{table}'.")
+
+
+def index_exists(conn, table, name):
+    return any(index['name'] == name for index in sa.inspect(conn).get_indexes(table))
+
+
+def create_index(conn, table, name, columns):
+    """インデックスが無い場合だけ作成する"""
+    if not index_exists(conn, table, name):
+        conn.execute(sa.text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+        print(f"[MIGRATE] Created index '{name}' on '{table}'.")
+
+
+def create_table(conn, metadata, table):
+    """モデル定義からテーブルを作成する (既に存在する場合は何もしない)"""
+    metadata.tables[table].create(conn, checkfirst=True)
+
+
+# ==================== マイグレーション定義 ====================
+# (バージョン, 説明, 関数) の順に追加していく。関数は (conn, metadata) を受け取る。
+
+def _baseline(conn, metadata):
+    """全テーブルを作成する (旧 create_auth_tables.py / db.create_all 相当)"""
+    metadata.create_all(conn, checkfirst=True)
+
+
+def _user_subscription_columns(conn, metadata):
+    """ユーザーのサブスクリプション管理カラム (旧 migrate_stripe.py)"""
+    add_column(conn, 'users', 'remote_user_id', 'INTEGER NULL')
+    add_column(conn, 'users', 'stripe_customer_id', 'VARCHAR(255) NULL')
+    add_column(conn, 'users', 'stripe_subscription_id', 'VARCHAR(255) NULL')
+    add_column(conn, 'users', 'subscription_status', "VARCHAR(50) DEFAULT 'trialing'")
+    trial_end_added = not column_exists(conn, 'users', 'trial_end')
+    add_column(conn, 'users', 'trial_end', 'DATETIME NULL')
+    add_column(conn, 'users', 'current_period_end', 'DATETIME NULL')
+    add_column(conn, 'users', 'cancel_at_period_end', 'BOOLEAN DEFAULT FALSE')
+
+    # trial_end を今回追加した場合だけ、既存ユーザーに30日間のトライアルを付与する。
+    # schema_version の無い既存のデータベースでもこのマイグレーションは実行されるので、
+    # 契約中 ('active' など) のユーザーや、既に trial_end を持つデータベースは書き換えない
+    if trial_end_added:
+        from datetime import datetime, timedelta
+        conn.execute(
+            sa.text("UPDATE users SET trial_end = :trial_end, subscription_status = 'trialing' "
+                    "WHERE trial_end IS NULL AND (subscription_status IS NULL OR subscription_status = 'trialing')"),
+            {'trial_end': datetime.utcnow() + timedelta(days=30)}
+        )
+
+
+def _section_layout_columns(conn, metadata):
+    """セクションのメモ欄と配置カラム (旧 migrate_memo.py)"""
+    add_column(conn, 'sections', 'memo', 'TEXT NULL')
+    add_column(conn, 'sections', 'width', 'INTEGER DEFAULT 300')
+    add_column(conn, 'sections', 'height', 'INTEGER DEFAULT 200')
+    add_column(conn, 'sections', 'position_x', 'INTEGER DEFAULT 0')
+    add_column(conn, 'sections', 'position_y', 'INTEGER DEFAULT 0')
+
+
+def _section_content_version(conn, metadata):
+    """差分保存用のセクション内容バージョン"""
+    add_column(conn, 'sections', 'content_version', 'INTEGER DEFAULT 0')
+
+
+def seed_tree_version(conn):
+    """版数の行 (id=1) が無ければ作成する (アプリは行がある前提で読み書きする)"""
+    if conn.execute(sa.text("SELECT 1 FROM tree_version WHERE id = 1")).first() is None:
+        conn.execute(sa.text("INSERT INTO tree_version (id, version) VALUES (1, 0)"))
+
+
+def _tree_version_table(conn, metadata):
+    """タブ/ページツリーの版数テーブル"""
+    create_table(conn, metadata, 'tree_version')
+    seed_tree_version(conn)
+
+
+def _section_search_index(conn, metadata):
+    """全文検索用テーブルを作成し、既存セクションを登録する"""
+    from search import create_search_index, rebuild_search_index
+    create_search_index(conn)
+    rebuild_search_index(conn)
+
+
+def _upload_store_tables(conn, metadata):
+    """内容アドレス型アップロードストアの実体と参照のテーブル"""
+    create_table(conn, metadata, 'upload_blobs')
+    create_table(conn, metadata, 'upload_refs')
+
+
+def _upload_session_tables(conn, metadata):
+    """再開可能な分割アップロードのセッションとチャンクのテーブル"""
+    create_table(conn, metadata, 'upload_sessions')
+    create_table(conn, metadata, 'upload_chunks')
+
+
+def _file_job_table(conn, metadata):
+    """バックグラウンドのファイル操作ジョブのテーブル"""
+    create_table(conn, metadata, 'file_jobs')
+
+
+def _mail_outbox_table(conn, metadata):
+    """送信メールのキューのテーブル"""
+    create_table(conn, metadata, 'mail_outbox')
+
+
+def _stripe_event_ledger(conn, metadata):
+    """Stripe Webhook のイベント台帳と、顧客IDでユーザーを引くためのインデックス"""
+    create_table(conn, metadata, 'stripe_events')
+    add_column(conn, 'users', 'stripe_event_created', 'INTEGER NULL')
+    create_index(conn, 'users', 'ix_users_stripe_customer_id', ['stripe_customer_id'])
+
+
+def _hot_lookup_indexes(conn, metadata):
+    """よく使う絞り込みのインデックス (名前は app.py のモデル定義と揃える)
+
+    users.stripe_customer_id は 11 で作成済み。
+    """
+    create_index(conn, 'pages', 'ix_pages_tab_order', ['tab_id', 'order_index'])
+    create_index(conn, 'sections', 'ix_sections_page_order', ['page_id', 'order_index'])
+    create_index(conn, 'storage_locations', 'ix_storage_locations_is_active', ['is_active'])
+    create_index(conn, 'upload_sessions', 'ix_upload_sessions_expires_at', ['expires_at'])
+    create_index(conn, 'email_verification_tokens', 'ix_email_verification_tokens_expires_at', ['expires_at'])
+    create_index(conn, 'password_reset_tokens', 'ix_password_reset_tokens_expires_at', ['expires_at'])
+
+
+def _file_job_stale_index(conn, metadata):
+    """実行中のまま止まったジョブを探すためのインデックス"""
+    create_index(conn, 'file_jobs', 'ix_file_jobs_status_updated', ['status', 'updated_at'])
+
+
+def _upload_blob_grace(conn, metadata):
+    """参照の無い実体を削除するまでの猶予に使う最終アップロード時刻"""
+    add_column(conn, 'upload_blobs', 'last_uploaded_at', 'DATETIME NULL')
+    from datetime import datetime
+    conn.execute(sa.text(
+        "UPDATE upload_blobs SET last_uploaded_at = COALESCE(created_at, :now) WHERE last_uploaded_at IS NULL"
+    ), {'now': datetime.utcnow()})
+    create_index(conn, 'upload_blobs', 'ix_upload_blobs_last_uploaded_at', ['last_uploaded_at'])
+
+
+def _tree_version_seed(conn, metadata):
+    """5 を行の作成前の版で適用したデータベースにも版数の行を作る"""
+    seed_tree_version(conn)
+
+
+def _file_job_cleanup_path(conn, metadata):
+    """プロセスごと止まったジョブの書きかけのコピー先"""
+    add_column(conn, 'file_jobs', 'cleanup_path', 'TEXT NULL')
+
+
+MIGRATIONS = [
+    (1, 'baseline tables', _baseline),
+    (2, 'user subscription columns', _user_subscription_columns),
+    (3, 'section layout columns', _section_layout_columns),
+    (4, 'section content_version', _section_content_version),
+    (5, 'tree_version table', _tree_version_table),
+    (6, 'section full-text search index', _section_search_index),
+    (7, 'upload store tables', _upload_store_tables),
+    (8, 'chunked upload session tables', _upload_session_tables),
+    (9, 'file job table', _file_job_table),
+    (10, 'mail outbox table', _mail_outbox_table),
+    (11, 'stripe event ledger', _stripe_event_ledger),
+    (12, 'hot lookup indexes', _hot_lookup_indexes),
+    (13, 'file job stale index', _file_job_stale_index),
+    (14, 'upload blob grace period', _upload_blob_grace),
+    (15, 'tree_version seed row', _tree_version_seed),
+    (16, 'file job cleanup path', _file_job_cleanup_path),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(engine):
+    """適用済みのバージョンを返す (schema_version テーブルが無ければ None)"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(sa.text("SELECT version FROM schema_version WHERE id = 1")).scalar()
+    except sa.exc.DBAPIError:
+        return None
+
+
+def run_migrations(engine, metadata):
+    """未適用のマイグレーションを順番に適用する"""
+    current = get_schema_version(engine)
+    if current is not None and current >= LATEST_VERSION:
+        return current
+
+    with engine.begin() as conn:
+        conn.execute(sa.text(
+            "CREATE TABLE IF NOT EXISTS schema_version (id INTEGER PRIMARY KEY, version INTEGER NOT NULL)"))
+        current = conn.execute(sa.text("SELECT version FROM schema_version WHERE id = 1")).scalar()
+        if current is None:
+            conn.execute(sa.text("INSERT INTO schema_version (id, version) VALUES (1, 0)"))
+            current = 0
+
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"[MIGRATE] Applying {version}: {description}")
+        # マイグレーションとバージョン更新を同じトランザクションで行う
+        # (MySQLではDDLが暗黙コミットされるため、各マイグレーションは冪等にしておく)
+        with engine.begin() as conn:
+            migrate(conn, metadata)
+            conn.execute(sa.text("UPDATE schema_version SET version = :v WHERE id = 1"), {'v': version})
+        current = version
+
+    return current
@@ -0,0 +1,116 @@
+"""
+パスワードのハッシュ化と照合 (bcrypt)
+bcrypt は意図的に重い計算なので、リクエストのスレッドで直接実行すると、ログインが集中したときに
+同じワーカーの他のリクエストまで待たされます。そのため計算は上限付きのプール (gunicorn ではプロセスプール、CGI・デスクトップではスレッドプール) に回し、
+同時に待てる数を超えた場合は PasswordHasherBusy を送出します。
+コスト (rounds) は設定で変えられ、古いコストのハッシュはログイン成功時に新しいコストで作り直します。
+"""
+import re
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# bcrypt は先頭72バイトしか使わない (bcrypt 5 以降は超えると例外になるため、従来どおり切り詰める)
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
+# ハッシュとして解釈できない値 (照合は必ず失敗する)。パスワードを持たないユーザーに使う
+UNUSABLE_PASSWORD_PREFIX = '!'
+
+_BCRYPT_COST_RE = re.compile(r'^\$2[abxy]?\$(\d{2})\$')
+
+
+class PasswordHasherBusy(Exception):
+    """ハッシュ計算の順番待ちが上限に達した"""
+
+
+def _encode(password):
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    return password[:BCRYPT_MAX_PASSWORD_BYTES]
+
+
+# プロセスプールで実行するため、モジュールのトップレベルに置く
+def _hashpw(password, rounds):
+    import bcrypt
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('ascii')
+
+
+def _checkpw(password, password_hash):
+    import bcrypt
+    try:
+        return bcrypt.checkpw(password, password_hash)
+    except ValueError:
+        # 壊れたハッシュや使えないパスワードの印
+        return False
+
+
+def hash_cost(password_hash):
+    """bcrypt ハッシュからコスト (rounds) を取り出す (bcrypt でなければ None)"""
+    match = _BCRYPT_COST_RE.match(password_hash or '')
+    return int(match.group(1)) if match else None
+
+
+def unusable_password_hash():
+    """どのパスワードとも一致しない値を返す (計算コストなし)"""
+    return UNUSABLE_PASSWORD_PREFIX + secrets.token_hex(16)
+
+
+class PasswordHasher:
+    """上限付きのプールで bcrypt を実行する"""
+
+    def __init__(self, rounds=12, workers=2, max_pending=16, timeout=10, use_processes=True):
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self.use_processes = use_processes
+        # 実行中 + 順番待ちの上限
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.use_processes:
+                    import multiprocessing
+                    # スレッドを持つプロセスから fork しないよう spawn で起動する
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    # bcrypt は計算中に GIL を解放するので、スレッドでも並列に動く
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy()
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # 待ちきれずに戻った場合も、計算が終わるまでは枠を使ったままにする
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._run(_hashpw, _encode(password), self.rounds)
+
+    def verify(self, password, password_hash):
+        if not password_hash or password_hash.startswith(UNUSABLE_PASSWORD_PREFIX):
+            return False
+        return self._run(_checkpw, _encode(password), password_hash.encode('utf-8'))
+
+    def needs_rehash(self, password_hash):
+        """設定のコストと異なるハッシュなら True"""
+        cost = hash_cost(password_hash)
+        return cost is not None and cost != self.rounds
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
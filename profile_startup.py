@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+起動時間プロファイルスクリプト
+app.py (または任意のモジュール) をクリーンなプロセスでインポートし、
+モジュールごとのインポート時間を表示します。
+
+  python profile_startup.py                 # app の読み込み時間を表示
+  python profile_startup.py --top 30        # 上位30モジュールを表示
+  python profile_startup.py --budget 1.5    # 1.5秒を超えたら終了コード1 (CIなどでのチェック用)
+
+--budget 指定時は、遅延インポートにしている重いライブラリ (stripe など) が
+起動時に読み込まれていないことも確認します。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 初回利用時まで読み込まないことにしているモジュール
+DEFERRED_MODULES = ['stripe', 'requests', 'flask_mail', 'bcrypt', 'PIL']
+
+
+def measure_import(module, env):
+    """別プロセスで -X importtime 付きでインポートし、(経過秒, 計測行) を返す"""
+    code = (
+        "import sys, json; sys.path.insert(0, %r); import %s; "
+        "print(json.dumps(sorted(sys.modules)))" % (APP_ROOT, module)
+    )
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, env=env, cwd=APP_ROOT
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit(f"❌ {module} のインポートに失敗しました")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace('import time:', '|', 1).split('|')]
+        rows.append((name, int(self_us), int(cumulative_us)))
+
+    loaded = set(json.loads(result.stdout.strip().splitlines()[-1]))
+    return elapsed, rows, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='起動時のインポート時間を計測します')
+    parser.add_argument('--module', default='app', help='計測するモジュール (既定: app)')
+    parser.add_argument('--top', type=int, default=20, help='表示するモジュール数')
+    parser.add_argument('--runs', type=int, default=3, help='計測回数 (最小値を採用)')
+    parser.add_argument('--budget', type=float, default=None, help='許容するインポート時間 (秒)')
+    parser.add_argument('--desktop', action='store_true', help='デスクトップ版の設定で計測する')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    if args.desktop:
+        env['WOWNOTE_DESKTOP'] = 'true'
+
+    best = None
+    for _ in range(max(1, args.runs)):
+        measured = measure_import(args.module, env)
+        if best is None or measured[0] < best[0]:
+            best = measured
+    elapsed, rows, loaded = best
+
+    total_us = next((cum for name, _, cum in rows if name == args.module), 0)
+    print("=" * 60)
+    print(f"{args.module} のインポート時間: {total_us / 1e6:.3f}秒 (プロセス全体: {elapsed:.3f}秒)")
+    print("=" * 60)
+
+    # トップレベルのパッケージ単位で集計 (self時間の合計)
+    by_package = {}
+    for name, self_us, _ in rows:
+        top = name.strip().split('.')[0]
+        by_package[top] = by_package.get(top, 0) + self_us
+    print(f"{'パッケージ':<30} {'時間(ms)':>10}")
+    for name, self_us in sorted(by_package.items(), key=lambda x: -x[1])[:args.top]:
+        print(f"{name:<30} {self_us / 1000:>10.1f}")
+
+    if args.budget is None:
+        return 0
+
+    failed = False
+    eager = [m for m in DEFERRED_MODULES if m in loaded]
+    if eager:
+        print(f"❌ 遅延インポート対象のモジュールが起動時に読み込まれています: {', '.join(eager)}")
+        failed = True
+    if total_us / 1e6 > args.budget:
+        print(f"❌ インポート時間が予算 {args.budget:.3f}秒 を超えています")
+        failed = True
+    if not failed:
+        print(f"✅ 予算 {args.budget:.3f}秒 以内です")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
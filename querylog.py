@@ -0,0 +1,163 @@
+"""
+SQL の実行回数・時間の記録 (SQLAlchemy のエンジンイベント)
+リクエストごとに実行した文を数え、同じ文が何度も実行されていれば N+1 の疑いとしてログに出し、
+しきい値より遅い文はバインド値とエンドポイントを添えてログに出します。
+count_queries() / assert_max_queries() はリクエストの外でも使える計数用のヘルパーです
+(チェック用スクリプトで、エンドポイントごとの実行回数の上限を確かめるのに使います)。
+"""
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+
+sql_logger = logging.getLogger('wownote.sql')
+
+# ログに出すバインド値の最大文字数
+MAX_PARAMS_LENGTH = 500
+
+# 処理中のリクエストの記録 (WSGI サーバーは1リクエストを1スレッドで処理する)
+_current = threading.local()
+
+_counters = []
+_counters_lock = threading.Lock()
+
+
+class QueryCounter:
+    """実行された文の回数と時間"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        """threshold 回以上実行された文を (文, 回数) の多い順で返す"""
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+    def report(self, limit=10):
+        lines = [f"{self.count} statement(s), {self.seconds * 1000:.1f} ms"]
+        for statement, count in self.statements.most_common(limit):
+            lines.append(f"  {count:>4}x {_one_line(statement)}")
+        return '\n'.join(lines)
+
+
+def _one_line(statement, length=200):
+    text = ' '.join(statement.split())
+    return text if len(text) <= length else text[:length] + '...'
+
+
+def _format_params(parameters):
+    text = repr(parameters)
+    return text if len(text) <= MAX_PARAMS_LENGTH else text[:MAX_PARAMS_LENGTH] + '...'
+
+
+class QueryLog:
+    """エンジンイベントで SQL を記録し、リクエストの終わりに N+1 の疑いを報告する"""
+
+    def __init__(self, slow_seconds=0.2, repeat_threshold=5, on_query=None):
+        self.slow_seconds = slow_seconds
+        self.repeat_threshold = repeat_threshold
+        # 文ごとに呼ぶ追加の処理 (経過秒を受け取る)。メトリクスへの加算に使う
+        self.on_query = on_query
+        # 同じ疑いを何度も出さないよう、報告済みの (エンドポイント, 文) を覚えておく
+        self._reported = set()
+        self._reported_lock = threading.Lock()
+        if not sql_logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            sql_logger.addHandler(handler)
+            sql_logger.setLevel(logging.INFO)
+            sql_logger.propagate = False
+
+    def install(self):
+        """すべてのエンジンの実行イベントに登録する"""
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute', self._before_cursor_execute)
+        sa.event.listen(sa.engine.Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        if self.on_query is not None:
+            self.on_query(elapsed)
+
+        counter = getattr(_current, 'counter', None)
+        if counter is not None:
+            counter.add(statement, elapsed)
+        if _counters:
+            with _counters_lock:
+                for active in _counters:
+                    active.add(statement, elapsed)
+
+        if elapsed >= self.slow_seconds:
+            sql_logger.warning(json.dumps({
+                'slow_query_ms': round(elapsed * 1000, 1),
+                'endpoint': getattr(_current, 'endpoint', None),
+                'statement': _one_line(statement, 1000),
+                'params': _format_params(parameters),
+                'executemany': executemany,
+            }, ensure_ascii=False))
+
+    def begin_request(self, endpoint):
+        _current.counter = QueryCounter()
+        _current.endpoint = endpoint
+
+    def end_request(self):
+        """リクエストの記録を終えて QueryCounter を返す (同じ文の繰り返しがあればログに出す)"""
+        counter = getattr(_current, 'counter', None)
+        endpoint = getattr(_current, 'endpoint', None)
+        _current.counter = None
+        _current.endpoint = None
+        if counter is None:
+            return None
+        for statement, count in counter.repeated(self.repeat_threshold):
+            key = (endpoint, statement)
+            with self._reported_lock:
+                if key in self._reported:
+                    continue
+                self._reported.add(key)
+            sql_logger.warning(json.dumps({
+                'possible_n_plus_one': endpoint,
+                'repeated': count,
+                'statement': _one_line(statement, 1000),
+                'request_statements': counter.count,
+                'request_db_ms': round(counter.seconds * 1000, 1),
+            }, ensure_ascii=False))
+        return counter
+
+
+@contextmanager
+def count_queries():
+    """with の中で実行された SQL を数える (どのスレッドで実行されたものも数える)"""
+    counter = QueryCounter()
+    with _counters_lock:
+        _counters.append(counter)
+    try:
+        yield counter
+    finally:
+        with _counters_lock:
+            _counters.remove(counter)
+
+
+@contextmanager
+def assert_max_queries(limit, label=''):
+    """with の中で実行された SQL が limit 件を超えたら AssertionError にする
+
+        with assert_max_queries(3, 'GET /api/tabs'):
+            client.get('/api/tabs')
+    """
+    with count_queries() as counter:
+        yield counter
+    if counter.count > limit:
+        raise AssertionError(f"{label or 'block'} executed {counter.count} queries (limit {limit})\n"
+                             + counter.report())
@@ -0,0 +1,184 @@
+"""
+リモートの認証サーバー (REMOTE_SERVER_URL) への HTTP クライアント
+デスクトップ版のログイン・登録・ステータス確認は毎回リモートに問い合わせるため、
+接続を使い回す (keep-alive) セッションを1つだけ持ち、接続と応答待ちのタイムアウトを分けて設定します。
+再送は安全なもの (接続前の失敗、GET の失敗) に限り、リモートが続けて失敗した場合は
+しばらく問い合わせずにすぐ失敗を返します (サーキットブレーカー)。
+呼び出しごとの所要時間はエンドポイント別に集計します。
+requests は初回の呼び出し時に読み込みます。
+"""
+import threading
+import time
+from collections import deque
+
+# リモートが落ちている・過負荷とみなす応答
+FAILURE_STATUSES = (502, 503, 504)
+# パーセンタイルの計算に使う直近の件数
+LATENCY_SAMPLES = 200
+
+
+class CircuitOpen(Exception):
+    """リモートが失敗し続けているため、問い合わせずに失敗させた"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Remote server is unavailable (retry in {retry_after:.0f}s)')
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """連続した失敗が failure_threshold 回に達したら reset_timeout 秒のあいだ呼び出しを止める
+
+    時間が経ったら1回だけ試しに通し (half-open)、成功すれば元に戻り、失敗すればまた止める。
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        """呼び出してよければ何もせず、止めている間は CircuitOpen を送出する"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_timeout:
+                raise CircuitOpen(self.reset_timeout - waited)
+            if self._trial_running:
+                # 試しの呼び出しは1つだけ
+                raise CircuitOpen(0)
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"[REMOTE] Circuit opened after {self.failures} failure(s)")
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class LatencyStats:
+    """エンドポイント別の呼び出し回数・失敗数・所要時間"""
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, elapsed_ms, ok):
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = {
+                    'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'samples': deque(maxlen=LATENCY_SAMPLES)
+                }
+            entry['calls'] += 1
+            if not ok:
+                entry['errors'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            entry['samples'].append(elapsed_ms)
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for endpoint, entry in self._endpoints.items():
+                samples = sorted(entry['samples'])
+                result[endpoint] = {
+                    'calls': entry['calls'],
+                    'errors': entry['errors'],
+                    'avg_ms': round(entry['total_ms'] / entry['calls'], 1),
+                    'max_ms': round(entry['max_ms'], 1),
+                    'p50_ms': round(_percentile(samples, 50), 1),
+                    'p95_ms': round(_percentile(samples, 95), 1),
+                }
+            return result
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+class RemoteClient:
+    """接続を使い回すセッション + 再送 + サーキットブレーカー + 所要時間の集計"""
+
+    def __init__(self, base_url, headers=None, connect_timeout=3.05, read_timeout=15,
+                 retries=2, pool_size=4, failure_threshold=3, reset_timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.headers = headers or {}
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.stats = LatencyStats()
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                # 接続前の失敗はどのメソッドでも再送し、応答待ちの失敗や 502/503/504 は GET だけ再送する
+                retry = Retry(
+                    total=self.retries, connect=self.retries, read=self.retries, status=self.retries,
+                    allowed_methods=frozenset(('GET', 'HEAD')), status_forcelist=FAILURE_STATUSES,
+                    backoff_factor=0.2, raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.headers.update(self.headers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def request(self, method, endpoint, **kwargs):
+        """リモートに問い合わせて requests の Response を返す
+
+        止めている間は CircuitOpen、接続できなければ requests の例外を送出する。
+        """
+        self.breaker.before_call()
+        session = self._get_session()
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = session.request(method, self.base_url + endpoint, timeout=self.timeout, **kwargs)
+            ok = response.status_code not in FAILURE_STATUSES
+            return response
+        finally:
+            self.stats.record(endpoint, (time.perf_counter() - start) * 1000, ok)
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Stripe Webhook イベントのリプレイ
+台帳 (stripe_events) のイベントを反映待ちに戻して、このプロセスで反映し直します。
+--fetch を付けると、Stripe API からイベントを取得して台帳に無いものを追加します
+(Webhook を受け取れなかった期間の取り込みや、新しい環境への移行時に使います)。
+ハンドラーは反映済みのものより古いイベントを読み飛ばすので、同じイベントを何度流しても状態は巻き戻りません。
+
+  python replay_stripe_events.py --status failed                # 失敗したイベントをやり直す
+  python replay_stripe_events.py --event-id evt_123 evt_456     # 指定したイベントをやり直す
+  python replay_stripe_events.py --since 2026-10-01 --fetch     # Stripe から取り込んでから反映する
+  python replay_stripe_events.py --since 2026-10-01 --dry-run   # 対象を表示するだけ
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_ROOT)
+
+from app import app, db, init_db, StripeEvent, STRIPE_EVENT_HANDLERS, stripe_event_applier, get_stripe  # noqa: E402
+import webhooks  # noqa: E402
+
+
+def utc_timestamp(value):
+    """タイムゾーンの無い日時は UTC とみなして UNIX 秒にする"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def fetch_events(since, types):
+    """Stripe API から since 以降のイベントを取得し、台帳に無いものを反映待ちで追加する"""
+    stripe = get_stripe()
+    added = 0
+    params = {'created': {'gte': utc_timestamp(since)}, 'limit': 100}
+    if types:
+        params['types'] = types
+    for event in stripe.Event.list(**params).auto_paging_iter():
+        if db.session.get(StripeEvent, event.id) is not None:
+            continue
+        # 古い stripe ライブラリの to_dict は入れ子のオブジェクトを dict にしない
+        payload = event.to_dict_recursive() if hasattr(event, 'to_dict_recursive') else event.to_dict()
+        db.session.add(StripeEvent(
+            id=event.id,
+            type=event.type,
+            customer_id=webhooks.event_customer_id(payload),
+            created=event.created,
+            payload=json.dumps(payload),
+            status=webhooks.EVENT_PENDING if event.type in STRIPE_EVENT_HANDLERS else webhooks.EVENT_SKIPPED
+        ))
+        added += 1
+        if added % 100 == 0:
+            db.session.commit()
+    db.session.commit()
+    return added
+
+
+def select_events(args):
+    query = StripeEvent.query
+    if args.event_id:
+        query = query.filter(StripeEvent.id.in_(args.event_id))
+    if args.status:
+        query = query.filter(StripeEvent.status.in_(args.status))
+    if args.type:
+        query = query.filter(StripeEvent.type.in_(args.type))
+    if args.since:
+        query = query.filter(StripeEvent.created >= utc_timestamp(args.since))
+    return query.order_by(StripeEvent.created, StripeEvent.id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stripe Webhook イベントを反映し直します')
+    parser.add_argument('--event-id', nargs='+', help='対象のイベントID')
+    parser.add_argument('--status', nargs='+',
+                        choices=[webhooks.EVENT_PENDING, webhooks.EVENT_APPLIED, webhooks.EVENT_SKIPPED,
+                                 webhooks.EVENT_FAILED],
+                        help='対象の状態')
+    parser.add_argument('--type', nargs='+', help='対象のイベント種別 (既定: 反映対象の全種別)')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='この日時 (UTC) 以降に作成されたイベント')
+    parser.add_argument('--fetch', action='store_true', help='先に Stripe API から --since 以降のイベントを取り込む')
+    parser.add_argument('--dry-run', action='store_true', help='対象を表示するだけで反映しない')
+    args = parser.parse_args()
+
+    if not (args.event_id or args.status or args.since):
+        parser.error('--event-id, --status, --since のいずれかを指定してください')
+    if args.fetch and not args.since:
+        parser.error('--fetch には --since が必要です')
+    if not args.type:
+        args.type = sorted(STRIPE_EVENT_HANDLERS)
+
+    init_db()
+    with app.app_context():
+        if args.fetch and not args.dry_run:
+            print(f"Fetched {fetch_events(args.since, args.type)} new event(s) from Stripe")
+
+        events = select_events(args).all()
+        for event in events:
+            created = datetime.utcfromtimestamp(event.created).isoformat()
+            print(f"{event.id}  {created}  {event.type:<32} {event.status:<8} {event.customer_id or '-'}")
+        print(f"{len(events)} event(s)")
+        if args.dry_run or not events:
+            return 0
+
+        for event in events:
+            event.status = webhooks.EVENT_PENDING
+            event.attempts = 0
+            event.error = None
+        db.session.commit()
+
+        start = time.perf_counter()
+        totals = stripe_event_applier.apply_pending()
+        print(f"Applied {totals[webhooks.EVENT_APPLIED]}, skipped {totals[webhooks.EVENT_SKIPPED]}, "
+              f"failed {totals[webhooks.EVENT_FAILED]} in {time.perf_counter() - start:.2f}s")
+        return 1 if totals[webhooks.EVENT_FAILED] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
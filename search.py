@@ -0,0 +1,209 @@
+"""
+セクションの全文検索
+デスクトップ版 (SQLite) は FTS5 の trigram トークナイザ、
+Web版 (MySQL) は ngram パーサの FULLTEXT インデックスを使います。
+どちらも section_search テーブルに セクション名 / content_data 内のテキスト / メモ を保持し、
+セクションの作成・更新・削除のたびに同じトランザクション内で更新します。
+"""
+import html
+import json
+import re
+
+import sqlalchemy as sa
+
+# content_data の中で検索対象にするキー (text/notepad の本文、リンクのタイトルとURL、ファイル名)
+SEARCH_TEXT_KEYS = ('title', 'text', 'url', 'filename')
+
+# trigram トークナイザは3文字未満の語をインデックスから引けない
+MIN_FTS_TERM_LENGTH = 3
+
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+SNIPPET_WIDTH = 60
+
+
+def extract_search_text(content_data):
+    """content_data (JSON文字列または dict) から検索対象のテキストを取り出す"""
+    if not content_data:
+        return ''
+    if isinstance(content_data, str):
+        try:
+            content_data = json.loads(content_data)
+        except ValueError:
+            return content_data
+    if not isinstance(content_data, dict):
+        return ''
+    parts = [content_data[key] for key in SEARCH_TEXT_KEYS if isinstance(content_data.get(key), str)]
+    return '\n'.join(part for part in parts if part)
+
+
+def create_search_index(conn):
+    """検索用テーブルを作成する (既に存在する場合は何もしない)"""
+    if conn.dialect.name == 'sqlite':
+        conn.execute(sa.text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS section_search "
+            "USING fts5(name, body, memo, tokenize='trigram')"))
+    else:
+        conn.execute(sa.text(
+            "CREATE TABLE IF NOT EXISTS section_search ("
+            " section_id INTEGER NOT NULL PRIMARY KEY,"
+            " name VARCHAR(255) NULL,"
+            " body MEDIUMTEXT NULL,"
+            " memo TEXT NULL,"
+            " FULLTEXT KEY ft_section_search (name, body, memo) WITH PARSER ngram"
+            ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"))
+
+
+def index_section(conn, section_id, name, content_data, memo):
+    """1セクション分の検索データを登録・更新する"""
+    params = {
+        'id': section_id,
+        'name': name or '',
+        'body': extract_search_text(content_data),
+        'memo': memo or '',
+    }
+    if conn.dialect.name == 'sqlite':
+        # FTS5 は UPSERT に対応していないので削除してから追加する
+        conn.execute(sa.text("DELETE FROM section_search WHERE rowid = :id"), params)
+        conn.execute(sa.text(
+            "INSERT INTO section_search (rowid, name, body, memo) VALUES (:id, :name, :body, :memo)"), params)
+    else:
+        conn.execute(sa.text(
+            "REPLACE INTO section_search (section_id, name, body, memo) VALUES (:id, :name, :body, :memo)"), params)
+
+
+def unindex_sections(conn, section_ids=None, page_ids=None):
+    """削除されるセクション (またはページ配下の全セクション) を検索データから除く"""
+    key = 'rowid' if conn.dialect.name == 'sqlite' else 'section_id'
+    if section_ids:
+        stmt = sa.text(f"DELETE FROM section_search WHERE {key} IN :ids").bindparams(
+            sa.bindparam('ids', expanding=True))
+        conn.execute(stmt, {'ids': list(section_ids)})
+    if page_ids:
+        stmt = sa.text(
+            f"DELETE FROM section_search WHERE {key} IN (SELECT id FROM sections WHERE page_id IN :pids)"
+        ).bindparams(sa.bindparam('pids', expanding=True))
+        conn.execute(stmt, {'pids': list(page_ids)})
+
+
+def rebuild_search_index(conn, batch_size=500):
+    """全セクションから検索データを作り直す (マイグレーションや復旧用)"""
+    conn.execute(sa.text("DELETE FROM section_search"))
+    last_id = 0
+    while True:
+        rows = conn.execute(sa.text(
+            "SELECT id, name, content_data, memo FROM sections WHERE id > :last ORDER BY id LIMIT :limit"
+        ), {'last': last_id, 'limit': batch_size}).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            index_section(conn, row[0], row[1], row[2], row[3])
+        last_id = rows[-1][0]
+
+
+def _split_terms(query):
+    return [term for term in re.split(r'\s+', query.strip()) if term]
+
+
+def _make_snippet(text, terms):
+    """最初にヒットした語の周辺を切り出してHTMLエスケープし、ヒット箇所を <mark> で囲む"""
+    if not text:
+        return ''
+    lowered = text.lower()
+    positions = [lowered.find(term.lower()) for term in terms]
+    positions = [p for p in positions if p >= 0]
+    center = min(positions) if positions else 0
+    start = max(0, center - SNIPPET_WIDTH // 3)
+    end = min(len(text), start + SNIPPET_WIDTH)
+    fragment = text[start:end]
+
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    marked = pattern.sub(lambda m: SNIPPET_START + m.group(0) + SNIPPET_END, fragment)
+    snippet = _render_snippet(marked)
+    return ('…' if start > 0 else '') + snippet + ('…' if end < len(text) else '')
+
+
+def _pick_snippet_source(texts, terms):
+    """ヒットした語を含む最初のフィールドを返す (本文 → メモ → 名前の順)"""
+    lowered_terms = [term.lower() for term in terms]
+    for text in texts:
+        if text and any(term in text.lower() for term in lowered_terms):
+            return text
+    return next((text for text in texts if text), '')
+
+
+def _render_snippet(marked):
+    return html.escape(marked).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+
+def search_sections(conn, query, limit=20, offset=0):
+    """検索を実行し、関連度順の (結果リスト, 続きがあるか) を返す
+
+    結果は section_id / page_id / tab_id / 各名前 / snippet (HTMLエスケープ済み) を持つ dict。
+    """
+    terms = _split_terms(query)
+    if not terms:
+        return [], False
+
+    params = {'limit': limit + 1, 'offset': offset}
+    if conn.dialect.name == 'sqlite':
+        if all(len(term) >= MIN_FTS_TERM_LENGTH for term in terms):
+            # 各語をフレーズとして AND 検索し、名前 > メモ > 本文 の重みで並べる
+            params['match'] = ' AND '.join('"%s"' % term.replace('"', '""') for term in terms)
+            sql = (
+                "SELECT s.id, s.page_id, p.tab_id, s.name, p.name, t.name, "
+                f" snippet(section_search, -1, '{SNIPPET_START}', '{SNIPPET_END}', '…', 16) "
+                "FROM section_search "
+                "JOIN sections s ON s.id = section_search.rowid "
+                "JOIN pages p ON p.id = s.page_id "
+                "JOIN tabs t ON t.id = p.tab_id "
+                "WHERE section_search MATCH :match "
+                "ORDER BY bm25(section_search, 5.0, 1.0, 2.0) "
+                "LIMIT :limit OFFSET :offset")
+            rows = conn.execute(sa.text(sql), params).fetchall()
+            results = [_row_to_result(row, _render_snippet(row[6] or '')) for row in rows]
+            return results[:limit], len(results) > limit
+
+        # 短い語はインデックスを使えないので、検索テーブルへの部分一致で探す
+        conditions = []
+        for i, term in enumerate(terms):
+            params[f't{i}'] = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            conditions.append(
+                f"(f.name LIKE :t{i} ESCAPE '\\' OR f.body LIKE :t{i} ESCAPE '\\' OR f.memo LIKE :t{i} ESCAPE '\\')")
+        sql = (
+            "SELECT s.id, s.page_id, p.tab_id, s.name, p.name, t.name, f.body, f.memo "
+            "FROM section_search f "
+            "JOIN sections s ON s.id = f.rowid "
+            "JOIN pages p ON p.id = s.page_id "
+            "JOIN tabs t ON t.id = p.tab_id "
+            f"WHERE {' AND '.join(conditions)} "
+            "ORDER BY s.updated_at DESC "
+            "LIMIT :limit OFFSET :offset")
+    else:
+        params['match'] = ' '.join('+"%s"' % term.replace('"', '') for term in terms)
+        sql = (
+            "SELECT s.id, s.page_id, p.tab_id, s.name, p.name, t.name, f.body, f.memo "
+            "FROM section_search f "
+            "JOIN sections s ON s.id = f.section_id "
+            "JOIN pages p ON p.id = s.page_id "
+            "JOIN tabs t ON t.id = p.tab_id "
+            "WHERE MATCH(f.name, f.body, f.memo) AGAINST (:match IN BOOLEAN MODE) "
+            "ORDER BY MATCH(f.name, f.body, f.memo) AGAINST (:match IN BOOLEAN MODE) DESC "
+            "LIMIT :limit OFFSET :offset")
+
+    rows = conn.execute(sa.text(sql), params).fetchall()
+    results = [_row_to_result(row, _make_snippet(_pick_snippet_source((row[6], row[7], row[3]), terms), terms))
+               for row in rows]
+    return results[:limit], len(results) > limit
+
+
+def _row_to_result(row, snippet):
+    return {
+        'section_id': row[0],
+        'page_id': row[1],
+        'tab_id': row[2],
+        'section_name': row[3],
+        'page_name': row[4],
+        'tab_name': row[5],
+        'snippet': snippet,
+    }
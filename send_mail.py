@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+送信キュー (mail_outbox) の送信
+送信予定時刻を過ぎたメール (再送待ちのものを含む) をこのプロセスでまとめて送ります。
+CGI ではリクエストごとにプロセスが終わるため、一時的な失敗で再送待ちになったメールは
+次にメールを積むリクエストが来るまで送られません。cron で定期的に実行してください。
+
+  python send_mail.py            # 送信予定時刻を過ぎたメールを送る
+  python send_mail.py --dry-run  # 送信待ちの件数と最も早い送信予定時刻を表示するだけ
+
+  # crontab の例 (5分ごと)
+  */5 * * * * /path/to/note/venv/bin/python3 /path/to/note/send_mail.py
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_ROOT)
+
+from app import app, db, init_db, mail_sender, MailOutbox  # noqa: E402
+import mailer  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='送信予定時刻を過ぎたメールを送ります')
+    parser.add_argument('--dry-run', action='store_true', help='送信待ちの件数を表示するだけで送らない')
+    args = parser.parse_args()
+
+    init_db()
+    with app.app_context():
+        queued = MailOutbox.query.filter_by(status=mailer.MAIL_QUEUED)
+        due = queued.filter(MailOutbox.next_attempt_at <= datetime.utcnow()).count()
+        earliest = db.session.query(db.func.min(MailOutbox.next_attempt_at)).filter(
+            MailOutbox.status == mailer.MAIL_QUEUED).scalar()
+        print(f"{queued.count()} queued mail(s), {due} due, earliest {earliest.isoformat() if earliest else '-'}")
+        if args.dry_run:
+            return 0
+
+    processed = mail_sender.send_due()
+    print(f"Processed {processed} mail(s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
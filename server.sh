@@ -0,0 +1,75 @@
+#!/bin/bash
+# WowNote 常駐サーバーの起動・停止・再読み込みスクリプト
+#   ./server.sh start    サーバーを起動 (デーモン化)
+#   ./server.sh stop     サーバーを停止
+#   ./server.sh reload   新しいコードでサーバーを起動し直す (処理中のリクエストは落とさない。コード更新後に実行)
+#   ./server.sh status   起動状態を表示
+
+cd "$(dirname "$0")"
+
+PIDFILE="run/gunicorn.pid"
+
+if [ -d "venv" ]; then
+    source venv/bin/activate
+fi
+
+is_running() {
+    [ -f "$PIDFILE" ] && kill -0 "$(cat "$PIDFILE")" 2>/dev/null
+}
+
+case "$1" in
+    start)
+        if is_running; then
+            echo "既に起動しています (PID: $(cat "$PIDFILE"))"
+            exit 0
+        fi
+        gunicorn -c gunicorn.conf.py --daemon wsgi:application
+        echo "サーバーを起動しました"
+        ;;
+    stop)
+        if is_running; then
+            # SIGTERM: 処理中のリクエストを graceful_timeout まで待ってから終了
+            kill -TERM "$(cat "$PIDFILE")"
+            echo "サーバーを停止しました"
+        else
+            echo "サーバーは起動していません"
+        fi
+        ;;
+    reload)
+        if ! is_running; then
+            echo "サーバーは起動していません"
+            exit 1
+        fi
+        # preload_app ではワーカーがマスターの読み込んだアプリを fork するため、SIGHUP では新しいコードにならない。
+        # SIGUSR2 で新しいマスターを起動してアプリを読み込み直させ (新しいマスターは古いマスターが終わるまで
+        # pidfile.2 に PID を書く)、起動を確かめてから古いマスターのワーカーを止め (WINCH)、
+        # 古いマスターを終了する (TERM: 処理中のリクエストは待つ)
+        OLD_PID="$(cat "$PIDFILE")"
+        rm -f "$PIDFILE.2"
+        kill -USR2 "$OLD_PID"
+        for _ in $(seq 1 60); do
+            sleep 1
+            if [ -f "$PIDFILE.2" ] && kill -0 "$(cat "$PIDFILE.2")" 2>/dev/null; then
+                NEW_PID="$(cat "$PIDFILE.2")"
+                kill -WINCH "$OLD_PID"
+                kill -TERM "$OLD_PID"
+                echo "サーバーを再読み込みしました (PID: $OLD_PID -> $NEW_PID)"
+                exit 0
+            fi
+        done
+        echo "新しいサーバーが起動しませんでした。古いサーバーで処理を続けます (PID: $OLD_PID)"
+        exit 1
+        ;;
+    status)
+        if is_running; then
+            echo "起動中 (PID: $(cat "$PIDFILE"))"
+        else
+            echo "停止中"
+            exit 1
+        fi
+        ;;
+    *)
+        echo "使い方: $0 {start|stop|reload|status}"
+        exit 1
+        ;;
+esac
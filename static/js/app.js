@@ -262,10 +262,35 @@ window.apiCall = async function(url, options = {}) {
 }
 
 // タブ関連
+// /api/tabs は ETag 付きで返るので、前回の結果を保持して If-None-Match で再検証する
+let tabsCache = { etag: null, data: null };
+
+async function fetchTabs() {
+    const headers = { 'Content-Type': 'application/json' };
+    if (tabsCache.etag && tabsCache.data) {
+        headers['If-None-Match'] = tabsCache.etag;
+    }
+    const response = await fetch(window.getApiUrl('/api/tabs'), {
+        headers,
+        credentials: 'include',
+        cache: 'no-store'
+    });
+    if (response.status === 304) {
+        window.debugLog('API Not Modified (/api/tabs)');
+        return structuredClone(tabsCache.data);
+    }
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    const data = await response.json();
+    tabsCache = { etag: response.headers.get('ETag'), data };
+    return structuredClone(data);
+}
+
 async function loadTabs() {
     try {
         console.log('Start loading tabs...');
-        tabs = await apiCall('/api/tabs');
+        tabs = await fetchTabs();
         console.log('Tabs loaded:', tabs);
         renderTabs();
 
@@ -938,7 +963,7 @@ function renderSectionContent(section) {
             return `
                 <div class="image-paste-container">
                     ${imageUrl ? `
-                        <img src="${escapeHtml(imageUrl)}" class="pasted-image" alt="貼り付けた画像">
+                        <img src="${escapeHtml(sectionImageDisplayUrl(imageUrl))}" class="pasted-image" alt="貼り付けた画像" decoding="async">
                         <button class="btn-secondary" onclick="clearSectionImage(${section.id})" style="margin-top: 10px;">画像を削除</button>
                     ` : `
                         <div class="image-paste-placeholder" onclick="triggerImagePaste(${section.id})">
@@ -1007,15 +1032,7 @@ window.createNewSection = async function(sectionType = 'text', x = null, y = nul
 
                 try {
                     // アップロード
-                    const formData = new FormData();
-                    formData.append('file', file);
-                    const response = await fetch('/note/api/upload', {
-                        method: 'POST',
-                        body: formData,
-                        credentials: 'include'
-                    });
-                    if (!response.ok) throw new Error('Upload failed');
-                    const fileData = await response.json();
+                    const fileData = await uploadFileToServer(file);
 
                     // セクション作成
                     const section = await apiCall('/api/sections', {
@@ -1171,6 +1188,8 @@ function showPageContextMenu(e) {
         <div class="context-menu-item" onclick="createNewSection('notepad', ${x}, ${y})">📒 メモ帳を作成</div>
         <div class="context-menu-item" onclick="createNewSection('image', ${x}, ${y})">🖼️ 画像を貼り付け</div>
         <div class="context-menu-item" onclick="createNewSection('text', ${x}, ${y})">📝 テキスト入力領域を配置</div>
+        <div class="context-menu-divider"></div>
+        <div class="context-menu-item" onclick="downloadPageFilesZip(currentPageId); hideContextMenu();">🗜️ 添付ファイルをZIPでダウンロード</div>
     `;
 
     document.body.appendChild(contextMenu);
@@ -1306,17 +1325,50 @@ function showUnifiedNotepadContextMenu(e, sectionId) {
 }
 
 
+// セクションの位置・サイズ・重なり順の更新をまとめて /api/sections/batch に送る
+let pendingSectionBatch = {};
+let sectionBatchTimer = null;
+let sectionBatchWaiters = [];
+
+function queueSectionUpdate(sectionId, fields) {
+    pendingSectionBatch[sectionId] = { ...(pendingSectionBatch[sectionId] || {}), ...fields };
+    if (!sectionBatchTimer) {
+        sectionBatchTimer = setTimeout(flushSectionUpdates, 100);
+    }
+    return new Promise((resolve, reject) => sectionBatchWaiters.push({ resolve, reject }));
+}
+
+async function flushSectionUpdates() {
+    const updates = Object.entries(pendingSectionBatch).map(([id, fields]) => ({ id: parseInt(id), ...fields }));
+    const waiters = sectionBatchWaiters;
+    pendingSectionBatch = {};
+    sectionBatchWaiters = [];
+    sectionBatchTimer = null;
+    if (updates.length === 0) return;
+
+    try {
+        const result = await apiCall('/api/sections/batch', {
+            method: 'POST',
+            body: JSON.stringify({ updates }),
+            showAlert: false
+        });
+        if (result.errors && Object.keys(result.errors).length > 0) {
+            console.error('Some section updates failed:', result.errors);
+        }
+        waiters.forEach(w => w.resolve(result));
+    } catch (err) {
+        waiters.forEach(w => w.reject(err));
+    }
+}
+
 // 最前面へ移動
 async function bringSectionToFront(sectionId) {
     sectionZIndex += 1;
     const sectionEl = document.getElementById(`section-${sectionId}`);
     if (sectionEl) {
         sectionEl.style.zIndex = sectionZIndex;
-        // Save using API
-        apiCall(`/api/sections/${sectionId}`, {
-            method: 'PUT',
-            body: JSON.stringify({ order_index: sectionZIndex })
-        }).catch(err => console.error('Failed to save z-index:', err));
+        queueSectionUpdate(sectionId, { order_index: sectionZIndex })
+            .catch(err => console.error('Failed to save z-index:', err));
     }
 }
 
@@ -1325,11 +1377,8 @@ async function sendSectionToBack(sectionId) {
     const sectionEl = document.getElementById(`section-${sectionId}`);
     if (sectionEl) {
         sectionEl.style.zIndex = 1;
-        // Save using API
-        apiCall(`/api/sections/${sectionId}`, {
-            method: 'PUT',
-            body: JSON.stringify({ order_index: 1 })
-        }).catch(err => console.error('Failed to save z-index:', err));
+        queueSectionUpdate(sectionId, { order_index: 1 })
+            .catch(err => console.error('Failed to save z-index:', err));
     }
 }
 
@@ -1387,7 +1436,7 @@ document.addEventListener('DOMContentLoaded', async () => {
     await loadSubscriptionStatus();
 
     // タブ情報の取得
-    tabs = await apiCall('/api/tabs');
+    tabs = await fetchTabs();
 
     // バージョン表示
     const title = document.getElementById('appTitle');
@@ -1602,32 +1651,104 @@ window.addEventListener('beforeunload', () => {
     }
 });
 
+// 差分保存: サーバーに保存済みのテキストとバージョンをセクションごとに保持する
+function getSavedTextState(section, field) {
+    if (!section._savedText) section._savedText = {};
+    if (!section._savedText[field]) {
+        const text = field === 'memo'
+            ? (section.memo || '')
+            : ((section.content_data && section.content_data.text) || '');
+        section._savedText[field] = { text, version: section.content_version || 0 };
+    }
+    return section._savedText[field];
+}
+
+function markTextSaved(section, field, value, version) {
+    const state = getSavedTextState(section, field);
+    state.text = value;
+    state.version = version;
+    section.content_version = version;
+    // 同じセクションの他フィールドもサーバー側のバージョンに追従させる
+    Object.values(section._savedText).forEach(s => { s.version = version; });
+}
+
+// 先頭・末尾の共通部分を除いた1つの置換操作を作る (offsetはUTF-16単位)
+function computeTextOps(oldText, newText) {
+    const minLen = Math.min(oldText.length, newText.length);
+    let start = 0;
+    while (start < minLen && oldText.charCodeAt(start) === newText.charCodeAt(start)) start++;
+    let oldEnd = oldText.length;
+    let newEnd = newText.length;
+    while (oldEnd > start && newEnd > start && oldText.charCodeAt(oldEnd - 1) === newText.charCodeAt(newEnd - 1)) {
+        oldEnd--;
+        newEnd--;
+    }
+    if (start === oldEnd && start === newEnd) return [];
+    return [{ offset: start, delete: oldEnd - start, insert: newText.slice(start, newEnd) }];
+}
+
+// PATCHで差分だけを送る。競合などで失敗した場合は false を返し、呼び出し元で全文保存する
+async function saveSectionTextDelta(section, field, value) {
+    const state = getSavedTextState(section, field);
+    const ops = computeTextOps(state.text, value);
+    if (ops.length === 0) return true;
+    try {
+        const response = await fetch(window.getApiUrl(`/api/sections/${section.id}/content`), {
+            method: 'PATCH',
+            headers: { 'Content-Type': 'application/json' },
+            credentials: 'include',
+            body: JSON.stringify({ field, base_version: state.version, ops })
+        });
+        if (!response.ok) {
+            window.debugLog(`Delta save rejected (${response.status}), falling back to full save`);
+            return false;
+        }
+        const result = await response.json();
+        markTextSaved(section, field, value, result.content_version);
+        return true;
+    } catch (e) {
+        return false;
+    }
+}
+
 async function updateSectionContent(sectionId, contentType, value) {
     const section = sections.find(s => s.id === sectionId);
     if (!section) return;
 
     try {
+        const field = contentType === 'memo' ? 'memo' : 'text';
+        const savedByDelta = await saveSectionTextDelta(section, field, value);
+
         if (contentType === 'text') {
             const contentData = { text: value };
             section.content_data = contentData;
-            await apiCall(`/api/sections/${sectionId}`, {
-                method: 'PUT',
-                body: JSON.stringify({ content_data: contentData })
-            });
+            if (!savedByDelta) {
+                const result = await apiCall(`/api/sections/${sectionId}`, {
+                    method: 'PUT',
+                    body: JSON.stringify({ content_data: contentData })
+                });
+                markTextSaved(section, field, value, result.content_version);
+            }
         } else if (contentType === 'notepad') {
             const contentData = section.content_data || {};
             contentData.text = value;
             section.content_data = contentData;
-            await apiCall(`/api/sections/${sectionId}`, {
-                method: 'PUT',
-                body: JSON.stringify({ content_data: contentData })
-            });
+            if (!savedByDelta) {
+                const result = await apiCall(`/api/sections/${sectionId}`, {
+                    method: 'PUT',
+                    body: JSON.stringify({ content_data: contentData })
+                });
+                markTextSaved(section, field, value, result.content_version);
+            }
         } else if (contentType === 'memo') {
             section.memo = value;
-            await apiCall(`/api/sections/${sectionId}`, {
-                method: 'PUT',
-                body: JSON.stringify({ memo: value })
-            });
+            if (!savedByDelta) {
+                const result = await apiCall(`/api/sections/${sectionId}`, {
+                    method: 'PUT',
+                    body: JSON.stringify({ memo: value })
+                });
+                markTextSaved(section, field, value, result.content_version);
+            }
         }
 
         // サーバーへの保存が成功した場合のみドラフトを削除
@@ -1772,14 +1893,11 @@ async function updateSectionPosition(sectionId, x, y, width, height) {
     const section = sections.find(s => s.id === sectionId);
     if (!section) return;
 
-    await apiCall(`/api/sections/${sectionId}`, {
-        method: 'PUT',
-        body: JSON.stringify({
-            position_x: x,
-            position_y: y,
-            width: width,
-            height: height
-        })
+    await queueSectionUpdate(sectionId, {
+        position_x: x,
+        position_y: y,
+        width: width,
+        height: height
     });
 
     section.position_x = x;
@@ -1841,6 +1959,78 @@ function setupDropZone(element, sectionId) {
 }
 
 // 画像貼り付けトリガー
+// ファイルをサーバーにアップロードし、/api/upload と同じ形式の結果を返す
+// 大きなファイルは分割アップロードAPIを使い、チャンクを並列送信する (失敗したチャンクだけ再送)
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const CHUNKED_UPLOAD_PARALLEL = 3;
+const CHUNKED_UPLOAD_RETRIES = 3;
+
+async function uploadFileToServer(file) {
+    if (file.size <= CHUNKED_UPLOAD_THRESHOLD) {
+        const formData = new FormData();
+        formData.append('file', file);
+        const response = await fetch('/note/api/upload', {
+            method: 'POST',
+            body: formData,
+            credentials: 'include'
+        });
+        if (!response.ok) throw new Error('Upload failed');
+        return await response.json();
+    }
+
+    const session = await apiCall('/api/uploads/sessions', {
+        method: 'POST',
+        body: JSON.stringify({ filename: file.name, size: file.size }),
+        showAlert: false
+    });
+    const { upload_id: uploadId, chunk_size: chunkSize } = session;
+
+    const sendChunk = async (index) => {
+        const blob = file.slice(index * chunkSize, Math.min(file.size, (index + 1) * chunkSize));
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch(window.getApiUrl(`/api/uploads/sessions/${uploadId}/chunks/${index}`), {
+                    method: 'PUT',
+                    body: blob,
+                    headers: { 'Content-Type': 'application/octet-stream' },
+                    credentials: 'include'
+                });
+                if (response.ok) return;
+                if (response.status < 500 || attempt >= CHUNKED_UPLOAD_RETRIES) {
+                    throw new Error(`Chunk ${index} failed: ${response.status}`);
+                }
+            } catch (e) {
+                if (attempt >= CHUNKED_UPLOAD_RETRIES) throw e;
+            }
+            await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+        }
+    };
+
+    // 未受信のチャンクが無くなるまで送る (接続が切れた場合も続きから再開する)
+    for (let round = 0; round < CHUNKED_UPLOAD_RETRIES; round++) {
+        const status = await apiCall(`/api/uploads/sessions/${uploadId}`, { showAlert: false });
+        const queue = [...status.missing];
+        if (queue.length === 0) break;
+        const workers = Array.from({ length: CHUNKED_UPLOAD_PARALLEL }, async () => {
+            while (queue.length > 0) {
+                await sendChunk(queue.shift());
+            }
+        });
+        try {
+            await Promise.all(workers);
+        } catch (e) {
+            console.warn('Chunk upload interrupted, resuming:', e);
+        }
+    }
+
+    const result = await apiCall(`/api/uploads/sessions/${uploadId}/complete`, {
+        method: 'POST',
+        body: JSON.stringify({ file_type: file.type }),
+        showAlert: false
+    });
+    return result;
+}
+
 function triggerImagePaste(sectionId) {
     const input = document.createElement('input');
     input.type = 'file';
@@ -1854,19 +2044,8 @@ function triggerImagePaste(sectionId) {
 }
 
 async function uploadImageToSection(file, sectionId) {
-    const formData = new FormData();
-    formData.append('file', file);
-
     try {
-        const response = await fetch('/note/api/upload', {
-            method: 'POST',
-            body: formData,
-            credentials: 'include'
-        });
-
-        if (!response.ok) throw new Error('Upload failed');
-
-        const fileData = await response.json();
+        const fileData = await uploadFileToServer(file);
         const imageUrl = `/api/files/${sectionId}`; // This might be wrong if /api/files/ID expects file content type
 
         // Update section to be an image section with the file URL
@@ -1979,19 +2158,8 @@ async function clearSectionImage(sectionId) {
 }
 
 async function uploadFileToSection(file, sectionId) {
-    const formData = new FormData();
-    formData.append('file', file);
-
     try {
-        const response = await fetch('/note/api/upload', {
-            method: 'POST',
-            body: formData,
-            credentials: 'include'
-        });
-
-        if (!response.ok) throw new Error('Upload failed');
-
-        const fileData = await response.json();
+        const fileData = await uploadFileToServer(file);
 
         await apiCall(`/api/sections/${sectionId}`, {
             method: 'PUT',
@@ -2022,6 +2190,51 @@ async function uploadFileToSection(file, sectionId) {
 // ローカルフォルダを選択する
 // (Obsolete pickLocalFolder removed. Use window.openDirectoryBrowser)
 
+// サーバー側ストレージの1エントリ分のHTML
+// サムネイル/プレビュー表示の画像は原寸ではなくサーバーで縮小したものを読み込む
+function renderServerFileEntry(sectionId, entry, viewMode) {
+    if (entry.is_directory) {
+        return `
+            <div class="file-item folder-item"
+                 title="${escapeHtml(entry.name)}"
+                 ondblclick="navigateToFolder(${sectionId}, '${escapeHtml(entry.name)}')">
+                <div class="file-icon">📁</div>
+                <div class="file-info">
+                    <div class="file-name">${escapeHtml(entry.name)}</div>
+                    <div class="file-meta">フォルダ</div>
+                </div>
+            </div>`;
+    }
+    const isImage = /\.(jpg|jpeg|png|gif|webp|svg)$/i.test(entry.name);
+    const isPdf = /\.pdf$/i.test(entry.name);
+    const isZip = /\.(zip|rar|7z)$/i.test(entry.name);
+    const isOffice = /\.(xlsx|xls|docx|doc|pptx|ppt)$/i.test(entry.name);
+    let icon = isImage ? '🖼' : isPdf ? '📕' : isZip ? '📦' : isOffice ? '📊' : '📄';
+    if (isImage && (viewMode === 'thumbnails' || viewMode === 'previews')) {
+        const thumbSize = viewMode === 'previews' ? 512 : 256;
+        const thumbUrl = window.getApiUrl(`/api/sections/${sectionId}/thumbnails/${encodeURIComponent(entry.name)}?size=${thumbSize}`);
+        icon = `<img class="file-thumbnail" loading="lazy" decoding="async" src="${escapeHtml(thumbUrl)}" alt="">`;
+    }
+    return `
+        <div class="file-item"
+             title="${escapeHtml(entry.name)}"
+             data-filename="${escapeHtml(entry.name)}"
+             onclick="showFilePreview(${sectionId}, this.dataset.filename)"
+             ondblclick="window.isLocalServer() ? openFileNativeOS(${sectionId}, this.dataset.filename) : (['xlsx','xls','docx','doc','pptx','ppt'].includes(this.dataset.filename.split('.').pop().toLowerCase()) ? openFileNativeOS(${sectionId}, this.dataset.filename) : showFilePreview(${sectionId}, this.dataset.filename))"
+             oncontextmenu="showFileContextMenu(event, ${sectionId}, this.dataset.filename)">
+            <div class="file-icon">${icon}</div>
+            <div class="file-info">
+                <div class="file-name">${escapeHtml(entry.name)}</div>
+                <div class="file-meta">${formatFileSize(entry.size)}</div>
+            </div>
+        </div>`;
+}
+
+// 画像セクションの表示用URL (アップロード済みの画像は縮小版を使う)
+function sectionImageDisplayUrl(imageUrl) {
+    return /^\/api\/files\/\d+$/.test(imageUrl) ? `${imageUrl}/thumbnail?size=1024` : imageUrl;
+}
+
 async function fetchSectionFiles(sectionId) {
     const listEl = document.getElementById(`file-list-${sectionId}`);
     if (!listEl) return;
@@ -2094,46 +2307,28 @@ async function fetchSectionFiles(sectionId) {
 
     if (data.path) {
         try {
-            const files = await apiCall(`/api/sections/${sectionId}/files`, { showAlert: false });
+            // 大きなフォルダでも最初の画面をすぐ出せるよう、ページ単位で取得して追記していく
+            const pageSize = 500;
+            const baseUrl = `/api/sections/${sectionId}/files?limit=${pageSize}`;
+            const loadToken = {};
+            listEl._loadToken = loadToken;
+            let page = await apiCall(baseUrl, { showAlert: false });
+            if (listEl._loadToken !== loadToken) return;
             listEl.className = 'file-list' + (viewMode !== 'list' ? ' ' + viewMode : '');
             listEl.oncontextmenu = (e) => showStorageViewContextMenu(e, sectionId);
 
-            if (files.length === 0) {
+            if (page.items.length === 0) {
                 listEl.innerHTML = '<div style="padding:10px;color:#999;">ファイルがありません</div>';
                 return;
             }
 
-            listEl.innerHTML = files.map(entry => {
-                if (entry.is_directory) {
-                    return `
-                        <div class="file-item folder-item"
-                             title="${escapeHtml(entry.name)}"
-                             ondblclick="navigateToFolder(${sectionId}, '${escapeHtml(entry.name)}')">
-                            <div class="file-icon">📁</div>
-                            <div class="file-info">
-                                <div class="file-name">${escapeHtml(entry.name)}</div>
-                                <div class="file-meta">フォルダ</div>
-                            </div>
-                        </div>`;
-                }
-                const isImage = /\\.(jpg|jpeg|png|gif|webp|svg)$/i.test(entry.name);
-                const isPdf = /\\.pdf$/i.test(entry.name);
-                const isOffice = /\\.(xlsx|xls|docx|doc|pptx|ppt)$/i.test(entry.name);
-                let icon = isImage ? '🖼' : isPdf ? '📕' : isZip ? '📦' : isOffice ? '📊' : '📄';
-                return `
-                    <div class="file-item"
-                         title="${escapeHtml(entry.name)}"
-                         data-filename="${escapeHtml(entry.name)}"
-                         onclick="showFilePreview(${sectionId}, this.dataset.filename)"
-                         ondblclick="window.isLocalServer() ? openFileNativeOS(${sectionId}, this.dataset.filename) : (['xlsx','xls','docx','doc','pptx','ppt'].includes(this.dataset.filename.split('.').pop().toLowerCase()) ? openFileNativeOS(${sectionId}, this.dataset.filename) : showFilePreview(${sectionId}, this.dataset.filename))"
-                         oncontextmenu="showFileContextMenu(event, ${sectionId}, this.dataset.filename)">
-                        <div class="file-icon">${icon}</div>
-                        <div class="file-info">
-                            <div class="file-name">${escapeHtml(entry.name)}</div>
-                            <div class="file-meta">${formatFileSize(entry.size)}</div>
-                        </div>
-                    </div>`;
-            }).join('');
+            listEl.innerHTML = page.items.map(entry => renderServerFileEntry(sectionId, entry, viewMode)).join('');
+            while (page.next_cursor) {
+                page = await apiCall(`${baseUrl}&cursor=${encodeURIComponent(page.next_cursor)}`, { showAlert: false });
+                // 読み込み中に再取得が始まった場合は古い結果を捨てる
+                if (listEl._loadToken !== loadToken) return;
+                listEl.insertAdjacentHTML('beforeend', page.items.map(entry => renderServerFileEntry(sectionId, entry, viewMode)).join(''));
+            }
             return;
         } catch (error) {
             // パスが見つからない場合は、ユーザーが選べるようにフレンドリーなUIを表示
@@ -2523,6 +2718,7 @@ function showFolderContextMenu(e, sectionId, folderName) {
         <div class="context-menu-item" onclick="navigateToFolder(${sectionId}, '${escapeHtml(folderName)}')">📂 開く</div>
         <div class="context-menu-item" onclick="copyFile(${sectionId}, '${escapeHtml(folderName)}')">📋 コピー</div>
         <div class="context-menu-item" onclick="cutFile(${sectionId}, '${escapeHtml(folderName)}')">✂️ 切り取り</div>
+        <div class="context-menu-item" onclick="downloadStorageFolderZip(${sectionId}, '${escapeHtml(folderName)}'); hideContextMenu();">🗜️ ZIPでダウンロード</div>
     `;
 
     // 貼り付けは常に表示（クリップボードが空の場合は無効化）
@@ -2666,6 +2862,17 @@ function downloadStorageFile(sectionId, filename) {        // ファイルをダ
     window.open(window.getApiUrl(`/api/sections/${sectionId}/files/${encodeURIComponent(filename)}?download=1`), '_blank');
 }
 
+// フォルダ (省略時はセクションで表示中のフォルダ) をZIPにしてダウンロード
+function downloadStorageFolderZip(sectionId, folderName = '') {
+    const query = folderName ? `?path=${encodeURIComponent(folderName)}` : '';
+    window.open(window.getApiUrl(`/api/sections/${sectionId}/archive${query}`), '_blank');
+}
+
+// ページ内のファイル/画像セクションの添付ファイルをZIPにしてダウンロード
+function downloadPageFilesZip(pageId) {
+    window.open(window.getApiUrl(`/api/pages/${pageId}/archive`), '_blank');
+}
+
 async function deleteStorageFile(sectionId, filename) {
     if (!confirm(`ファイル "${filename}" を削除しますか？`)) return;
 
@@ -2728,16 +2935,61 @@ function handleFileDragStart(e, sectionId, filename) {
     e.dataTransfer.effectAllowed = 'copyMove';
 }
 
-async function moveFileBetweenSections(sourceSectionId, targetSectionId, filename) {
+// ==================== バックグラウンドジョブ ====================
+// コピー・移動・解凍はサーバーのバックグラウンドジョブになるので、完了までポーリングして進捗を表示する
+async function runFileJob(url, body, label) {
+    const data = await apiCall(url, {
+        method: 'POST',
+        body: JSON.stringify(body),
+        showAlert: false
+    });
+    return data.job ? await waitForFileJob(data.job, label) : data;
+}
+
+async function waitForFileJob(job, label) {
+    const el = document.createElement('div');
+    el.className = 'file-job-progress';
+    el.style.cssText = 'position:fixed; right:20px; bottom:20px; z-index:10000; min-width:240px; padding:10px 14px; background:#fff; border:1px solid #ddd; border-radius:8px; box-shadow:0 4px 12px rgba(0,0,0,0.15); font-size:12px;';
+    document.body.appendChild(el);
     try {
-        const response = await fetch(`/note/api/sections/${sourceSectionId}/files/${encodeURIComponent(filename)}/move`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ target_section_id: targetSectionId }),
-            credentials: 'include'
-        });
+        while (true) {
+            const percent = job.bytes_total
+                ? Math.floor(job.bytes_done * 100 / job.bytes_total)
+                : (job.files_total ? Math.floor(job.files_done * 100 / job.files_total) : 0);
+            el.innerHTML = `
+                <div style="white-space:nowrap; overflow:hidden; text-overflow:ellipsis;">${escapeHtml(label)}: ${escapeHtml(job.filename)}</div>
+                <div style="margin:6px 0; height:6px; background:#eee; border-radius:3px; overflow:hidden;">
+                    <div style="width:${percent}%; height:100%; background:#4a90e2;"></div>
+                </div>
+                <div style="display:flex; justify-content:space-between; align-items:center; gap:10px;">
+                    <span>${percent}% (${job.files_done}/${job.files_total} ファイル)</span>
+                    <button class="btn-secondary" style="padding:2px 8px; font-size:11px;" onclick="cancelFileJob('${job.id}')">キャンセル</button>
+                </div>`;
 
-        if (!response.ok) throw new Error('Move failed');
+            if (job.status === 'succeeded') return job;
+            if (job.status === 'cancelled') throw new Error('キャンセルされました');
+            if (job.status === 'failed') throw new Error(job.error || `${label}に失敗しました`);
+
+            await new Promise(resolve => setTimeout(resolve, 500));
+            job = await apiCall(`/api/jobs/${job.id}`, { showAlert: false });
+        }
+    } finally {
+        el.remove();
+    }
+}
+
+async function cancelFileJob(jobId) {
+    try {
+        await apiCall(`/api/jobs/${jobId}/cancel`, { method: 'POST', showAlert: false });
+    } catch (error) {
+        console.error('Cancel job error:', error);
+    }
+}
+
+async function moveFileBetweenSections(sourceSectionId, targetSectionId, filename) {
+    try {
+        await runFileJob(`/api/sections/${sourceSectionId}/files/${encodeURIComponent(filename)}/move`,
+            { target_section_id: targetSectionId }, '移動');
 
         // 両方のセクションをリロード
         await fetchSectionFiles(sourceSectionId);
@@ -2796,6 +3048,7 @@ function showFileContextMenu(e, sectionId, filename) {
     // ZIPファイルの場合は解凍オプションを追加
     if (isZipFile) {
         menuItems += `<div class="context-menu-item" onclick="extractZipFile(${sectionId}, '${escapeHtml(filename)}')">📦 解凍</div>`;
+        menuItems += `<div class="context-menu-item" onclick="extractZipFile(${sectionId}, '${escapeHtml(filename)}', true)">📂 フォルダに解凍</div>`;
     }
 
     menuItems += `<div class="context-menu-item delete" onclick="deleteStorageFileAndHide(${sectionId}, '${escapeHtml(filename)}')">🗑️ 削除</div>`;
@@ -2875,14 +3128,8 @@ async function pasteFile(targetSectionId) {
     hideContextMenu();
 
     try {
-        const response = await fetch(`/note/api/sections/${clipboardFile.sectionId}/files/${encodeURIComponent(clipboardFile.filename)}/copy`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ target_section_id: targetSectionId }),
-            credentials: 'include'
-        });
-
-        if (!response.ok) throw new Error('Copy failed');
+        await runFileJob(`/api/sections/${clipboardFile.sectionId}/files/${encodeURIComponent(clipboardFile.filename)}/copy`,
+            { target_section_id: targetSectionId }, 'コピー');
 
         await fetchSectionFiles(targetSectionId);
 
@@ -2922,23 +3169,19 @@ function shareFile(url, filename) {
 }
 
 // ZIPファイル解凍
-async function extractZipFile(sectionId, filename) {
+// intoFolder が true の場合はZIPと同じ名前の新しいフォルダの中に解凍する
+async function extractZipFile(sectionId, filename, intoFolder = false) {
     hideContextMenu();
 
-    if (!confirm(`${filename} を解凍しますか？`)) return;
+    if (!confirm(`${filename} を${intoFolder ? '新しいフォルダに' : ''}解凍しますか？`)) return;
 
     try {
-        const response = await fetch(`/note/api/sections/${sectionId}/files/${encodeURIComponent(filename)}/extract`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ filename: filename }),
-            credentials: 'include'
-        });
-
-        if (!response.ok) throw new Error('Extract failed');
+        const job = await runFileJob(`/api/sections/${sectionId}/files/${encodeURIComponent(filename)}/extract`,
+            { filename: filename, subfolder: intoFolder }, '解凍');
 
         await fetchSectionFiles(sectionId);
-        alert(`${filename} を解凍しました`);
+        const folder = job.result && job.result.folder;
+        alert(folder ? `${filename} を「${folder}」に解凍しました` : `${filename} を解凍しました`);
     } catch (error) {
         console.error('Extract error:', error);
         alert('解凍に失敗しました: ' + error.message);
@@ -2984,6 +3227,7 @@ function showStorageBackgroundContextMenu(e, sectionId) {
     }
 
     menuItems += `<div class="context-menu-item" onclick="fetchSectionFiles(${sectionId})">🔄 更新</div>`;
+    menuItems += `<div class="context-menu-item" onclick="downloadStorageFolderZip(${sectionId}); hideContextMenu();">🗜️ フォルダをZIPでダウンロード</div>`;
 
     contextMenu.innerHTML = menuItems;
 
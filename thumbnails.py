@@ -0,0 +1,183 @@
+"""
+画像サムネイルの生成とディスクキャッシュ
+グリッド / サムネイル表示で原寸画像を転送しないよう、決まったサイズの縮小画像を
+ワーカースレッドで作り、元ファイルのパス・更新時刻・サイズをキーにしてディスクに保存します。
+キャッシュ全体が上限バイト数を超えたら、最後に使われた時刻 (ファイルの mtime) が古いものから削除します。
+Pillow は初回の生成時に読み込みます (未インストールの場合は ThumbnailUnavailable)。
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# 許可するサムネイルの長辺 (px)
+THUMBNAIL_SIZES = (128, 256, 512, 1024)
+DEFAULT_THUMBNAIL_SIZE = 256
+
+THUMBNAIL_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff')
+
+JPEG_QUALITY = 82
+# 削除するときは上限のこの割合まで減らす (毎回の書き込みで削除が走らないように)
+EVICT_TARGET_RATIO = 0.9
+
+
+class ThumbnailUnavailable(Exception):
+    """サムネイルを作れない (Pillow が無い、画像として読めない など)"""
+
+
+class ThumbnailTimeout(Exception):
+    """生成待ちが時間切れになった (生成自体はワーカーで続いている)"""
+
+
+def is_thumbnail_source(filename):
+    return filename.lower().endswith(THUMBNAIL_EXTENSIONS)
+
+
+def render_thumbnail(source_path, size, dest_base):
+    """縮小画像を作って dest_base + 拡張子 に保存し、そのパスを返す"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise ThumbnailUnavailable('Pillow is not installed')
+
+    try:
+        with Image.open(source_path) as img:
+            # JPEG はデコード時に縮小させる (カメラ写真で最も効果が大きい)
+            img.draft('RGB', (size, size))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size))
+            has_alpha = img.mode in ('RGBA', 'LA', 'P') and (
+                img.mode != 'P' or 'transparency' in img.info)
+            if has_alpha:
+                img = img.convert('RGBA')
+                dest_path, fmt, options = dest_base + '.png', 'PNG', {'optimize': True}
+            else:
+                img = img.convert('RGB')
+                dest_path, fmt, options = dest_base + '.jpg', 'JPEG', {'quality': JPEG_QUALITY}
+
+            # 書き込み途中のファイルを配信しないよう、一時ファイルから置き換える
+            tmp_path = f"{dest_path}.{threading.get_ident()}.tmp"
+            img.save(tmp_path, fmt, **options)
+    except ThumbnailUnavailable:
+        raise
+    except Exception as e:
+        raise ThumbnailUnavailable(str(e))
+
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+
+class ThumbnailCache:
+    """サムネイルのディスクキャッシュと生成用ワーカープール"""
+
+    def __init__(self, root, max_bytes, workers=2):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._executor = None
+        self._pending = {}
+        # 完了済みの future に add_done_callback するとその場で呼ばれるため再入可能にしておく
+        self._lock = threading.RLock()
+        self._total_bytes = None
+
+    def cache_key(self, source_path, stat_result, size):
+        raw = f"{os.path.abspath(source_path)}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}\0{size}"
+        return hashlib.sha1(raw.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def _base_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def lookup(self, key):
+        """キャッシュ済みのサムネイルのパスを返す (無ければ None)"""
+        base = self._base_path(key)
+        for ext in ('.jpg', '.png'):
+            path = base + ext
+            try:
+                # 最後に使われた時刻として mtime を更新する (LRU)
+                os.utime(path)
+                return path
+            except FileNotFoundError:
+                continue
+        return None
+
+    def get(self, source_path, size, timeout=30):
+        """サムネイルのパスとキャッシュキーを返す (無ければワーカーで作って待つ)"""
+        stat_result = os.stat(source_path)
+        key = self.cache_key(source_path, stat_result, size)
+        path = self.lookup(key)
+        if path is not None:
+            return path, key
+
+        # 同じサムネイルを同時に要求された場合は1回だけ作る
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='thumbnail')
+                future = self._executor.submit(self._build, source_path, size, key)
+                self._pending[key] = future
+                future.add_done_callback(lambda _: self._forget(key))
+        try:
+            return future.result(timeout=timeout), key
+        except FutureTimeoutError:
+            raise ThumbnailTimeout(source_path)
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _build(self, source_path, size, key):
+        base = self._base_path(key)
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        path = render_thumbnail(source_path, size, base)
+        self._account(path)
+        return path
+
+    def _account(self, added_path):
+        added_bytes = os.path.getsize(added_path)
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._scan())
+            else:
+                self._total_bytes += added_bytes
+            if self._total_bytes <= self.max_bytes:
+                return
+            self._total_bytes = self.evict(int(self.max_bytes * EVICT_TARGET_RATIO), keep=added_path)
+
+    def _scan(self):
+        """キャッシュ内の (パス, サイズ, 最終使用時刻) を列挙する"""
+        if not os.path.isdir(self.root):
+            return
+        with os.scandir(self.root) as buckets:
+            for bucket in buckets:
+                if not bucket.is_dir():
+                    continue
+                with os.scandir(bucket.path) as entries:
+                    for entry in entries:
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        yield entry.path, st.st_size, st.st_mtime
+
+    def evict(self, target_bytes, keep=None):
+        """最後に使われた時刻が古いものから削除し、残りの合計バイト数を返す
+
+        実際のディスクを数え直すので、複数プロセスで同じキャッシュを共有していても合計は補正される。
+        """
+        entries = sorted(self._scan(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= target_bytes:
+                break
+            if path == keep:
+                # これから返すサムネイルは残す
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                total -= size
+            except OSError:
+                continue
+        return total
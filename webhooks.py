@@ -0,0 +1,161 @@
+"""
+Stripe Webhook のイベント台帳 (stripe_events テーブル) と反映処理
+Webhook の受信では署名を確かめて台帳に記録するだけですぐに応答し、ユーザーへの反映は
+反映スレッドがまとめて行います。台帳はイベントIDを主キーにしているので、Stripe の再送は記録の時点で重複として捨てられます。
+反映はイベントの作成時刻順に行い、さらに各ユーザーに最後に反映したイベントの作成時刻を持たせて、
+それより古いイベントが後から届いても状態を巻き戻さないようにします (ハンドラー側で EventSkipped を送出する)。
+"""
+import json
+import threading
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+EVENT_PENDING = 'pending'
+EVENT_APPLYING = 'applying'
+EVENT_APPLIED = 'applied'
+EVENT_SKIPPED = 'skipped'
+EVENT_FAILED = 'failed'
+
+# 反映中のまま更新されない行は、反映していたプロセスが止まったものとみなしてやり直す
+APPLYING_STALE_AFTER = timedelta(minutes=10)
+# 失敗したイベントを自動でやり直すまでの間隔
+FAILED_RETRY_AFTER = timedelta(minutes=1)
+
+
+class EventSkipped(Exception):
+    """反映する必要がないイベント (対象のユーザーがいない、反映済みのものより古い など)"""
+
+
+def event_customer_id(event):
+    """イベントの対象の Stripe 顧客ID (無ければ None)"""
+    customer = (event.get('data') or {}).get('object', {}).get('customer')
+    if isinstance(customer, dict):
+        # expand された顧客オブジェクト
+        customer = customer.get('id')
+    return customer
+
+
+class EventApplier:
+    """台帳の未反映イベントを作成時刻順にまとめて反映する"""
+
+    def __init__(self, app, session, handlers, batch_size=50, max_attempts=5):
+        self.app = app
+        # Flask-SQLAlchemy の db.session (ハンドラーの変更と台帳の更新を同じトランザクションでコミットする)
+        self.session = session
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def wake(self):
+        """反映スレッドを起こす (動いていなければ起動する)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                # CGI では応答を返した後もこのスレッドの終了を待ってからプロセスが終わる
+                self._thread = threading.Thread(target=self._run, name='stripe-events')
+                self._thread.start()
+            self._wakeup.set()
+
+    def _run(self):
+        try:
+            with self.app.app_context():
+                while True:
+                    self._wakeup.clear()
+                    self.apply_pending()
+                    with self._lock:
+                        if not self._wakeup.is_set():
+                            self._thread = None
+                            return
+        except Exception as e:
+            print(f"[STRIPE] Event applier stopped: {e}")
+            with self._lock:
+                self._thread = None
+
+    def apply_pending(self):
+        """未反映のイベントが無くなるまで反映し、(反映, スキップ, 失敗) の件数を返す"""
+        totals = {EVENT_APPLIED: 0, EVENT_SKIPPED: 0, EVENT_FAILED: 0}
+        while True:
+            rows = self._claim_batch()
+            if not rows:
+                return totals
+            for status in self._apply_batch(rows):
+                totals[status] += 1
+
+    def _claim_batch(self):
+        """反映待ちのイベントを作成時刻順に最大 batch_size 件取り、反映中にする"""
+        now = datetime.utcnow()
+        session = self.session
+        session.execute(sa.text(
+            "UPDATE stripe_events SET status = :pending, updated_at = :now "
+            "WHERE (status = :applying AND updated_at < :stale) "
+            "OR (status = :failed AND attempts < :max_attempts AND updated_at < :retry)"
+        ), {'pending': EVENT_PENDING, 'applying': EVENT_APPLYING, 'failed': EVENT_FAILED, 'now': now,
+            'stale': now - APPLYING_STALE_AFTER, 'retry': now - FAILED_RETRY_AFTER,
+            'max_attempts': self.max_attempts})
+        candidates = session.execute(sa.text(
+            "SELECT id FROM stripe_events WHERE status = :pending ORDER BY created, id LIMIT :limit"
+        ), {'pending': EVENT_PENDING, 'limit': self.batch_size}).scalars().all()
+
+        claimed = []
+        for event_id in candidates:
+            # 他のプロセスの反映スレッドと同じイベントを取り合わないよう、状態を条件にして更新する
+            updated = session.execute(sa.text(
+                "UPDATE stripe_events SET status = :applying, attempts = attempts + 1, updated_at = :now "
+                "WHERE id = :id AND status = :pending"
+            ), {'applying': EVENT_APPLYING, 'pending': EVENT_PENDING, 'now': now, 'id': event_id}).rowcount
+            if updated:
+                claimed.append(event_id)
+        session.commit()
+        if not claimed:
+            return []
+        rows = session.execute(sa.text(
+            "SELECT id, type, payload, attempts FROM stripe_events WHERE id IN :ids ORDER BY created, id"
+        ).bindparams(sa.bindparam('ids', expanding=True)), {'ids': claimed}).mappings().all()
+        return [dict(row) for row in rows]
+
+    def _apply_one(self, row):
+        """1件をセッションに反映し、台帳の状態を返す (コミットは呼び出し側)"""
+        handler = self.handlers.get(row['type'])
+        status, error = EVENT_APPLIED, None
+        if handler is None:
+            status = EVENT_SKIPPED
+        else:
+            try:
+                handler(json.loads(row['payload']))
+            except EventSkipped as e:
+                status, error = EVENT_SKIPPED, str(e) or None
+        self._mark(row['id'], status, error)
+        return status
+
+    def _apply_batch(self, rows):
+        """まとめて1回のコミットで反映する (失敗したら1件ずつやり直し、失敗したイベントだけを記録する)"""
+        try:
+            statuses = [self._apply_one(row) for row in rows]
+            self.session.commit()
+            return statuses
+        except Exception:
+            self.session.rollback()
+
+        statuses = []
+        for row in rows:
+            try:
+                statuses.append(self._apply_one(row))
+                self.session.commit()
+            except Exception as e:
+                self.session.rollback()
+                print(f"[STRIPE] Failed to apply {row['id']} ({row['type']}): {e}")
+                self._mark(row['id'], EVENT_FAILED, str(e))
+                self.session.commit()
+                statuses.append(EVENT_FAILED)
+        return statuses
+
+    def _mark(self, event_id, status, error=None):
+        now = datetime.utcnow()
+        self.session.execute(sa.text(
+            "UPDATE stripe_events SET status = :status, error = :error, applied_at = :applied_at, "
+            "updated_at = :now WHERE id = :id"
+        ), {'status': status, 'error': error, 'applied_at': now if status != EVENT_FAILED else None,
+            'now': now, 'id': event_id})
@@ -0,0 +1,24 @@
+"""
+常駐型アプリケーションサーバー用の WSGI エントリポイント
+index.cgi (リクエスト毎に app.py を再インポート) の代わりに、
+gunicorn などからこのモジュールを読み込んでプロセスを常駐させます。
+
+  gunicorn -c gunicorn.conf.py wsgi:application
+"""
+import os
+import sys
+
+# アプリのルートディレクトリをパスに追加
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_ROOT)
+
+# .envを読み込む (app.py より先に読み込んで Config に反映させる)
+from dotenv import load_dotenv
+load_dotenv(os.path.join(APP_ROOT, '.env'))
+
+from app import app, init_db
+
+# スキーマが最新なら schema_version を1行読むだけで終わる
+init_db()
+
+application = app